@@ -0,0 +1,70 @@
+"""
+Time to first result and total discovery time of `SSDPClient` against a pool of local responders,
+compared with collecting every response until the timeout before returning them.
+
+Each responder is a `SSDPServer` on its own loopback socket, searched with unicast M-SEARCHes.
+
+    python -m benchmarks.bench_client
+"""
+import asyncio
+import logging
+import socket
+import time
+
+from upnp.ssdp import SSDPServer, SSDPClient
+
+RESPONDERS = 200
+MX = 1
+
+
+async def start_pool(size):
+    pool = []
+    for n in range(size):
+        server = SSDPServer('127.0.0.1')
+        server.register_device('uuid:responder-%d' % n, 'http://127.0.0.1:%d/description.xml' % (9000 + n))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        await server.start(sock)
+        pool.append((server, sock.getsockname()))
+    return pool
+
+
+async def streaming(targets):
+    client = SSDPClient(st='upnp:rootdevice', mx=MX, repeat=1, targets=targets)
+    start = time.perf_counter()
+    first = last = None
+    results = 0
+    async for _ in client.search():
+        last = time.perf_counter() - start
+        if first is None:
+            first = last
+        results += 1
+    return results, first, last, time.perf_counter() - start
+
+
+async def collect(targets):
+    """Wait out the whole search, then return everything."""
+    client = SSDPClient(st='upnp:rootdevice', mx=MX, repeat=1, targets=targets)
+    start = time.perf_counter()
+    results = [headers async for headers in client.search()]
+    total = time.perf_counter() - start
+    return len(results), total, total, total
+
+
+async def run():
+    pool = await start_pool(RESPONDERS)
+    targets = [address for _, address in pool]
+    for name, search in (('collect', collect), ('streaming', streaming)):
+        results, first, last, total = await search(targets)
+        print('%-10s %4d results  first %6.3fs  last %6.3fs  search done %6.3fs' % (name, results, first, last, total))
+    for server, _ in pool:
+        server.stop()
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Start-up time and memory per device when one process hosts 1, 100 and 1000 devices.
+
+Each device gets its own yaml (a copy of examples/m87.yaml with another UDN), and is loaded, served
+and registered the way `upnp.__main__.main` does it, without opening the sockets.
+
+    python -m benchmarks.bench_devices
+"""
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+from upnp.description import host, load_descriptions
+from upnp.http_server import AsyncUPNPHTTPServer
+from upnp.ssdp import SSDPServer
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'examples', 'm87.yaml')
+ADDRESS = ('10.0.0.2', 8088)
+
+
+def write_descriptions(directory, count):
+    with open(EXAMPLE) as f:
+        values = yaml.safe_load(f)
+    for n in range(count):
+        values.update(serial='AE%05d' % n, MAC='00407F%06X' % n)
+        with open(os.path.join(directory, 'device-%04d.yaml' % n), 'w') as f:
+            yaml.safe_dump(values, f)
+
+
+def start(directory):
+    descriptions = load_descriptions(directory, ADDRESS)
+    http_server = AsyncUPNPHTTPServer(ADDRESS, None)
+    ssdp = SSDPServer(ADDRESS[0])
+    host(descriptions, http_server, ssdp)
+    return descriptions, http_server, ssdp
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    print('%8s %12s %14s %14s' % ('devices', 'start-up ms', 'ms/device', 'KiB/device'))
+    for count in (1, 100, 1000):
+        with tempfile.TemporaryDirectory() as directory:
+            write_descriptions(directory, count)
+            start(directory)  # warm up (imports, template)
+
+            begin = time.perf_counter()
+            served = start(directory)
+            elapsed = time.perf_counter() - begin
+            # served from a directory, each device has its own path (more may be added to it), plus
+            # /description.xml for the first one
+            assert len(served[0]) == count and len(served[1].descriptions) == count + 1
+            del served
+
+            tracemalloc.start()
+            served = start(directory)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del served
+        print('%8d %12.1f %14.3f %14.1f' % (count, elapsed * 1000, elapsed * 1000 / count, memory / 1024. / count))
+
+
+if __name__ == '__main__':
+    main()
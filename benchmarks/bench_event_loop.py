@@ -0,0 +1,122 @@
+"""
+Reply latency and idle CPU of the SSDP engine: the old sleep-polling loop vs the asyncio endpoint.
+
+A socket bound to 127.0.0.1 stands in for the multicast group, so this runs anywhere:
+
+    python -m benchmarks.bench_event_loop
+"""
+import asyncio
+import logging
+import resource
+import socket
+import statistics
+import threading
+import time
+
+from upnp.ssdp import SSDPServer
+
+MSEARCH = ('M-SEARCH * HTTP/1.1\r\n'
+           'HOST: 239.255.255.250:1900\r\n'
+           'MAN: "ssdp:discover"\r\n'
+           'MX: 0\r\n'
+           'ST: upnp:rootdevice\r\n\r\n').encode()
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def loopback_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    return sock
+
+
+def make_server():
+    server = SSDPServer('127.0.0.1')
+    # one client searching as fast as it can: the loop is measured, not the rate limit
+    server.limiter = None
+    server.register('local', 'uuid:bench::upnp:rootdevice', 'upnp:rootdevice', 'http://127.0.0.1:8088/description.xml')
+    return server
+
+
+class _SocketTransport:
+    """Just enough of a transport for the legacy loop to send replies."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def sendto(self, data, addr):
+        self.sock.sendto(data, addr)
+
+
+def legacy_engine(server, sock, stop):
+    """The pre-asyncio `register_multicast` loop: non-blocking socket and `time.sleep(0.2)` on EWOULDBLOCK."""
+    server.transport = _SocketTransport(sock)
+    sock.setblocking(False)
+    wakeups = 0
+    while not stop.is_set():
+        wakeups += 1
+        try:
+            data, addr = sock.recvfrom(1024)
+            server.datagram_received(data, addr)
+        except BlockingIOError:
+            time.sleep(0.2)
+    return wakeups
+
+
+def asyncio_engine(server, sock, stop):
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        await server.start(sock)
+        # block a helper thread on the event, the loop itself stays idle
+        await loop.run_in_executor(None, stop.wait)
+        server.stop()
+
+    loop.run_until_complete(serve())
+    loop.close()
+
+
+def measure(engine, requests=50, idle=3.0):
+    server = make_server()
+    sock = loopback_socket()
+    target = sock.getsockname()
+    stop = threading.Event()
+    thread = threading.Thread(target=engine, args=(server, sock, stop), daemon=True)
+    thread.start()
+    time.sleep(0.3)
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2)
+    latencies = []
+    for i in range(requests):
+        # spread the requests so they land at random points of the polling period
+        time.sleep(0.013 * (i % 7))
+        start = time.perf_counter()
+        client.sendto(MSEARCH, target)
+        client.recvfrom(2048)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    before = cpu_time()
+    time.sleep(idle)
+    idle_cpu = (cpu_time() - before) / idle * 100
+
+    stop.set()
+    thread.join()
+    client.close()
+    sock.close()
+    return latencies, idle_cpu
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    for name, engine in (('sleep-polling', legacy_engine), ('asyncio', asyncio_engine)):
+        latencies, idle_cpu = measure(engine)
+        print('%-14s reply latency p50 %7.2f ms  max %7.2f ms  idle cpu %.3f%%' % (
+            name, statistics.median(latencies), max(latencies), idle_cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+GENA fan-out: state changes of one service sent to hundreds of local stub subscribers, with the NotifyPool
+keeping its connections open, and closing them after each NOTIFY (a connection per NOTIFY, as without a pool).
+
+The subscribers are spread over a few stub hosts (ports), and run on the same loop as the publisher: the
+numbers are for the whole exchange.
+
+    python -m benchmarks.bench_gena
+"""
+import asyncio
+import logging
+import time
+
+from upnp.gena import EventPublisher, NotifyPool
+
+SUBSCRIBERS = 500
+HOSTS = 10
+EVENTS = 20
+PATH = '/camera/event'
+
+
+class Stubs:
+    """Control points: count the NOTIFYs they get, per SEQ."""
+
+    def __init__(self):
+        self.servers = []
+        self.by_seq = {}  # seq -> NOTIFYs received
+        self.connections = 0
+
+    async def start(self, hosts):
+        for _ in range(hosts):
+            self.servers.append(await asyncio.start_server(self._connection, '127.0.0.1', 0, backlog=1024))
+        return [server.sockets[0].getsockname()[1] for server in self.servers]
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+    async def _connection(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = seq = 0
+                for line in head.split(b'\r\n'):
+                    if line.startswith(b'SEQ:'):
+                        seq = int(line[4:])
+                    elif line.startswith(b'CONTENT-LENGTH:'):
+                        length = int(line[15:])
+                await reader.readexactly(length)
+                self.by_seq[seq] = self.by_seq.get(seq, 0) + 1
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def wait(self, seq, count, timeout=30):
+        deadline = time.perf_counter() + timeout
+        while self.by_seq.get(seq, 0) < count:
+            assert time.perf_counter() < deadline, 'seq %d: %d of %d' % (seq, self.by_seq.get(seq, 0), count)
+            await asyncio.sleep(0.001)
+
+
+async def fan_out(keep_alive, connections_per_host):
+    loop = asyncio.get_running_loop()
+    stubs = Stubs()
+    ports = await stubs.start(HOSTS)
+    pool = NotifyPool(connections_per_host=connections_per_host, keep_alive=keep_alive)
+    publisher = EventPublisher(moderation=0, pool=pool, max_subscriptions=SUBSCRIBERS)
+    publisher.add_service(PATH, {'Zoom': 0, 'Power': True})
+    publisher.start(loop)
+    for n in range(SUBSCRIBERS):
+        publisher.subscribe(PATH, [('127.0.0.1', ports[n % HOSTS], '/cb/%d' % n)])
+    await stubs.wait(0, SUBSCRIBERS)
+
+    latencies = []
+    start = time.perf_counter()
+    for seq in range(1, EVENTS + 1):
+        changed = time.perf_counter()
+        publisher.update(PATH, {'Zoom': seq})
+        await stubs.wait(seq, SUBSCRIBERS)
+        latencies.append(time.perf_counter() - changed)
+    elapsed = time.perf_counter() - start
+    publisher.stop()
+    stubs.close()
+    return {
+        'notifies_per_s': EVENTS * SUBSCRIBERS / elapsed,
+        'fan_out_ms': 1000 * sum(latencies) / len(latencies),
+        'fan_out_max_ms': 1000 * max(latencies),
+        'connections': pool.stats['opened'],
+        'failed': pool.stats['failed'],
+    }
+
+
+async def moderation():
+    """A burst of changes: how many events do the subscribers get?"""
+    loop = asyncio.get_running_loop()
+    stubs = Stubs()
+    ports = await stubs.start(1)
+    publisher = EventPublisher(moderation=0.05)
+    publisher.add_service(PATH, {'Zoom': 0})
+    publisher.start(loop)
+    for n in range(10):
+        publisher.subscribe(PATH, [('127.0.0.1', ports[0], '/cb/%d' % n)])
+    await stubs.wait(0, 10)
+    for n in range(1000):
+        publisher.update(PATH, {'Zoom': n})
+        if n % 100 == 0:
+            await asyncio.sleep(0.01)
+    await asyncio.sleep(0.3)
+    publisher.stop()
+    stubs.close()
+    return publisher.stats['events'], sum(stubs.by_seq.values()) - 10
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    print('%d subscribers on %d hosts, %d state changes' % (SUBSCRIBERS, HOSTS, EVENTS))
+    print('%-28s %12s %12s %12s %12s' % ('', 'NOTIFY/s', 'fan-out ms', 'max ms', 'connections'))
+    for name, keep_alive, per_host in (('connection per NOTIFY', False, 2), ('pooled, 1 per host', True, 1),
+                                       ('pooled, 2 per host', True, 2), ('pooled, 8 per host', True, 8)):
+        result = asyncio.run(fan_out(keep_alive, per_host))
+        assert not result['failed'], result
+        print('%-28s %12.0f %12.1f %12.1f %12d' % (name, result['notifies_per_s'], result['fan_out_ms'],
+                                                   result['fan_out_max_ms'], result['connections']))
+    events, notifies = asyncio.run(moderation())
+    print('1000 changes in 0.1s to 10 subscribers: %d events, %d NOTIFYs' % (events, notifies))
+
+
+if __name__ == '__main__':
+    main()
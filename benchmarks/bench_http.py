@@ -0,0 +1,109 @@
+"""
+Latency of description.xml and /bi-cgi requests under hundreds of concurrent local clients, for the
+threaded UPNPHTTPServer and the asyncio AsyncUPNPHTTPServer.
+
+One extra client is slow: it connects and takes a second to send its request, as a sluggish control
+point would.
+
+    python -m benchmarks.bench_http
+"""
+import asyncio
+import logging
+import statistics
+import time
+
+from upnp.http_server import UPNPHTTPServer, UPNPHTTPServerBase, AsyncUPNPHTTPServer
+
+CLIENTS = 200
+REQUESTS = 10
+PATHS = ['/description.xml', '/bi-cgi?keepalive.jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6',
+         '/bi-cgi?axis.t.displacement=-32,duration=0']
+DESCRIPTION = open('examples/m87.xml').read()
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    close = head.startswith(b'HTTP/1.0')
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'connection':
+            close = value.strip().lower() == b'close'
+    if length:
+        await reader.readexactly(length)
+    else:
+        await reader.read()
+        close = True
+    return close
+
+
+async def client(port, latencies):
+    reader = writer = None
+    for n in range(REQUESTS):
+        start = time.perf_counter()
+        if writer is None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        path = PATHS[n % len(PATHS)]
+        writer.write(('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: keep-alive\r\n\r\n' % path).encode())
+        if await read_response(reader):
+            writer.close()
+            writer = None
+        latencies.append(time.perf_counter() - start)
+    if writer is not None:
+        writer.close()
+
+
+async def slow_client(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /description.xml HTTP/1.1\r\n')
+    await asyncio.sleep(1)
+    writer.write(b'Host: 127.0.0.1\r\nConnection: close\r\n\r\n')
+    await read_response(reader)
+    writer.close()
+
+
+async def load(port):
+    latencies = []
+    slow = asyncio.ensure_future(slow_client(port))
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, latencies) for _ in range(CLIENTS)))
+    elapsed = time.perf_counter() - start
+    await slow
+    return latencies, elapsed
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print('%-9s %5d requests in %6.2fs  p50 %8.2f ms  p99 %8.2f ms' % (
+        name, len(latencies), elapsed, statistics.median(latencies) * 1000, p99 * 1000))
+
+
+async def run_async():
+    server = AsyncUPNPHTTPServer(('127.0.0.1', 0), DESCRIPTION)
+    await server.start()
+    try:
+        return await load(server.address[1])
+    finally:
+        server.close()
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+
+    # a listen backlog large enough for all the clients
+    UPNPHTTPServerBase.request_queue_size = CLIENTS * 2
+    threaded = UPNPHTTPServer(('127.0.0.1', 0), DESCRIPTION)
+    threaded.start()
+    report('threaded', *asyncio.run(load(threaded.address[1])))
+    threaded.server.shutdown()
+
+    report('asyncio', *asyncio.run(run_async()))
+
+
+if __name__ == '__main__':
+    main()
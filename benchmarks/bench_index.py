@@ -0,0 +1,67 @@
+"""
+Search target matching with 50,000 remote entries in the registry: linear scan vs the ST index.
+
+    python -m benchmarks.bench_index
+"""
+import logging
+import random
+import time
+
+from upnp.ssdp import SSDPServer
+
+REMOTE = 50000
+LOCAL_DEVICES = 10
+QUERIES = ['ssdp:all', 'upnp:rootdevice', 'urn:schemas-upnp-org:device:Basic:1',
+           'urn:schemas-upnp-org:service:Bench:1', 'urn:schemas-upnp-org:service:Missing:1',
+           'uuid:local-3', 'uuid:remote-42']
+
+
+def linear_search(server, st):
+    """The matching loop `discovery_request` used before the index."""
+    matches = []
+    for i in server.known.values():
+        if i['MANIFESTATION'] == 'remote':
+            continue
+        if st == 'ssdp:all' and i['SILENT']:
+            continue
+        if i['ST'] == st or st == 'ssdp:all':
+            matches.append(i)
+    return matches
+
+
+def make_server():
+    server = SSDPServer('127.0.0.1')
+    for n in range(REMOTE):
+        st = QUERIES[n % 4]
+        server.register('remote', 'uuid:remote-%d::%s' % (n, st), st, 'http://10.0.%d.%d/d.xml' % (n // 250, n % 250))
+    for n in range(LOCAL_DEVICES):
+        for st in ('upnp:rootdevice', 'urn:schemas-upnp-org:device:Basic:1', 'urn:schemas-upnp-org:service:Bench:1'):
+            server.register('local', 'uuid:local-%d::%s' % (n, st), st, 'http://127.0.0.1:8088/%d/description.xml' % n)
+    return server
+
+
+def queries_per_second(search, queries, duration=1.0):
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for st in queries:
+            for _ in search(st):
+                pass
+        done += len(queries)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    server = make_server()
+    queries = QUERIES * 10
+    random.Random(0).shuffle(queries)
+    linear = queries_per_second(lambda st: linear_search(server, st), queries)
+    indexed = queries_per_second(server.index.search, queries)
+    print('%d remote, %d local entries' % (REMOTE, LOCAL_DEVICES * 3))
+    print('linear scan   %10.0f queries/s' % linear)
+    print('indexed       %10.0f queries/s' % indexed)
+
+
+if __name__ == '__main__':
+    main()
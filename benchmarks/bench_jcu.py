@@ -0,0 +1,106 @@
+"""
+JCU queries answered per second: the cached single pass parser vs the split/float/json.dumps it replaced.
+
+The trace follows what a couple of joysticks send: connect once (jcu_config is not parsed), a keepalive every 2s,
+axis updates every `commandrepeat` (500ms) while a stick is moved, and a few button presses.
+
+    python -m benchmarks.bench_jcu
+"""
+import json
+import random
+import time
+
+from upnp.jcu import compile_jcu_query, parse_jcu_command
+
+
+def legacy_parse(path):
+    """`parse_jcu_command` before the tokenizer (it did not handle chained commands)."""
+    commands = {}
+    _commands = commands
+    _path = path.split('.')
+
+    _v = _path[-1].split(',', 1)
+    if '=' not in _v[0]:
+        _command = _path[:-1] + [_v[0]]
+        _values = _v[1]
+    else:
+        _command = _path[:-1]
+        _values = _path[-1]
+
+    values = dict(v.split('=') for v in _values.split(','))
+
+    while _command:
+        k = _command.pop(0)
+        _commands[k] = {}
+        _commands = _commands[k]
+    for k, v in values.items():
+        try:
+            v = float(v)
+        except:
+            pass
+        _commands[k] = v
+    return commands
+
+
+def trace(jcus=2, seconds=600, seed=0):
+    """A command trace of `seconds` of joystick use, one query per element."""
+    rnd = random.Random(seed)
+    udns = ['uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3%02X' % i for i in range(jcus)]
+    queries = []
+    for udn in udns:
+        queries.append('connect.jcuudn=%s' % udn)
+    moving = dict.fromkeys(udns)
+    for tick in range(seconds * 2):  # every 500ms
+        for udn in udns:
+            if tick % 4 == 0:
+                queries.append('keepalive.jcuudn=%s' % udn)
+            if moving[udn] is None and rnd.random() < 0.1:
+                moving[udn] = (rnd.choice('xyzt'), rnd.randint(5, 30))
+            if moving[udn]:
+                axis, left = moving[udn]
+                # the stick is mostly at full deflection, or coming back
+                displacement = rnd.choice((-100, 100, 100, -100, rnd.randint(-100, 100)))
+                queries.append('axis.%s.displacement=%d,duration=0' % (axis, displacement))
+                moving[udn] = (axis, left - 1) if left > 1 else None
+                if not left > 1:
+                    queries.append('axis.%s.displacement=0,duration=0' % axis)
+            if rnd.random() < 0.01:
+                duration = rnd.randint(100, 3000)
+                queries.append('button.F,state=DOWN,duration=0,jcuudn={0}'.format(udn))
+                queries.append('button.F,state=UP,duration={1},jcuudn={0}'.format(udn, duration))
+    return queries
+
+
+def legacy(query):
+    return json.dumps(legacy_parse(query)).encode()
+
+
+def uncached(query):
+    return json.dumps(parse_jcu_command(query), separators=(',', ':')).encode()
+
+
+def cached(query):
+    return compile_jcu_query(query)[1]
+
+
+def queries_per_second(handler, queries, duration=1.0):
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for query in queries:
+            handler(query)
+        done += len(queries)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    queries = trace()
+    print('%d queries, %d distinct' % (len(queries), len(set(queries))))
+    compile_jcu_query.cache_clear()
+    for name, handler in (('legacy', legacy), ('uncached', uncached), ('cached', cached)):
+        print('%-8s %10.0f queries/s' % (name, queries_per_second(handler, queries)))
+    print(compile_jcu_query.cache_info())
+
+
+if __name__ == '__main__':
+    main()
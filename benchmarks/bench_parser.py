@@ -0,0 +1,58 @@
+"""
+Datagrams parsed per second: the bytes parser vs the decode/split/map parsing it replaced.
+
+    python -m benchmarks.bench_parser
+"""
+import time
+
+from benchmarks.corpus import TRAFFIC
+from upnp.ssdp_parser import parse_datagram, M_SEARCH, NOTIFY
+
+
+def legacy_parse(data):
+    """What `datagram_received` did before `parse_datagram`, minus the logging and dispatch."""
+    try:
+        header, payload = data.decode().split('\r\n\r\n')[:2]
+    except ValueError:
+        return None
+
+    lines = header.split('\r\n')
+    cmd = lines[0].split(' ')
+    lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
+    lines = filter(lambda x: len(x) > 0, lines)
+
+    headers = [x.split(':', 1) for x in lines]
+    headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+    return cmd[0], cmd[1], headers
+
+
+def parse(data):
+    message = parse_datagram(data)
+    # the dispatcher always looks at the headers of searches and notifications
+    if message is not None and message.method in (M_SEARCH, NOTIFY):
+        return message.headers
+    return message
+
+
+def packets_per_second(parser, duration=1.0):
+    done = errors = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for data in TRAFFIC:
+            try:
+                parser(data)
+            except Exception:
+                # the old parser raises on some malformed start lines
+                errors += 1
+        done += len(TRAFFIC)
+    return done / (time.perf_counter() - start), errors
+
+
+def main():
+    for name, parser in (('legacy', legacy_parse), ('bytes', parse)):
+        rate, errors = packets_per_second(parser)
+        print('%-8s %10.0f packets/s  %d exceptions' % (name, rate, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Scaling of the prefork mode: M-SEARCH replies and description requests per second with 1 to 8 workers.
+
+The workers are forked as `--workers` does (upnp.prefork.Supervisor), each with its own multicast socket on
+the loopback and a SO_REUSEPORT HTTP listener; the load comes from this process. With fewer cores than
+workers (plus one for the load), the numbers cannot scale.
+
+    python -m benchmarks.bench_prefork [max workers]
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from upnp.http_server import AsyncUPNPHTTPServer
+from upnp.prefork import Supervisor
+from upnp.ssdp import SSDPServer, SSDP_ADDR
+
+SSDP_PORT = 19001  # not the real one: nothing else on the host should answer
+HTTP_PORT = 18088
+DEVICES = 20  # registered by each worker: 3 registrations each, so ssdp:all gets 60 replies
+SEARCHES = 2000
+CLIENT_SOCKETS = 32
+CONNECTIONS = 100
+REQUESTS = 20  # per connection
+DESCRIPTION = open('examples/m87.xml').read()
+
+
+def multicast_socket(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(SSDP_ADDR) + socket.inet_aton('127.0.0.1'))
+    sock.bind(('', port))
+    return sock
+
+
+def worker(index, workers):
+    ssdp = SSDPServer('127.0.0.1')
+    for n in range(DEVICES):
+        ssdp.register_device('uuid:bench-%d' % n, 'http://127.0.0.1:%d/description.xml' % HTTP_PORT,
+                             'urn:schemas-upnp-org:device:Bench:1')
+    # a few sources searching as fast as they can: the capacity is measured, not the rate limit
+    ssdp.limiter = None
+    ssdp.set_worker(index, workers)
+    http_server = AsyncUPNPHTTPServer(('127.0.0.1', HTTP_PORT), DESCRIPTION, max_connections=4096, reuse_port=True)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(http_server.start())
+    loop.run_until_complete(ssdp.start(multicast_socket(SSDP_PORT)))
+    # (the announcements go to the real SSDP port, and are not what is measured)
+    ssdp.announcer.stop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.run_forever()
+
+
+class Replies(asyncio.DatagramProtocol):
+    def __init__(self, counter):
+        self.counter = counter
+
+    def datagram_received(self, data, addr):
+        self.counter[0] += 1
+        self.counter[1] = time.perf_counter()
+
+
+async def search_load():
+    loop = asyncio.get_running_loop()
+    counter = [0, 0.0]  # replies, time of the last one
+    transports = []
+    for _ in range(CLIENT_SOCKETS):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        sock.bind(('127.0.0.1', 0))
+        transport, _ = await loop.create_datagram_endpoint(lambda: Replies(counter), sock=sock)
+        transports.append(transport)
+    start = time.perf_counter()
+    for n in range(SEARCHES):
+        # a different ST each time on a socket: nothing is coalesced
+        st = 'ssdp:all' if n // CLIENT_SOCKETS % 2 else 'urn:schemas-upnp-org:device:Bench:1'
+        transports[n % CLIENT_SOCKETS].sendto(
+            ('M-SEARCH * HTTP/1.1\r\nHOST: %s:%d\r\nMAN: "ssdp:discover"\r\nMX: 0\r\nST: %s\r\n\r\n' %
+             (SSDP_ADDR, SSDP_PORT, st)).encode(), (SSDP_ADDR, SSDP_PORT))
+        if n % CLIENT_SOCKETS == CLIENT_SOCKETS - 1:
+            await asyncio.sleep(0.001)
+    while True:
+        seen = counter[0]
+        await asyncio.sleep(0.5)
+        if counter[0] == seen:
+            break
+    for transport in transports:
+        transport.close()
+    expected = SEARCHES // 2 * DEVICES * 3 + SEARCHES // 2 * DEVICES
+    return counter[0] / (counter[1] - start), counter[0] / expected
+
+
+async def http_load():
+    async def client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', HTTP_PORT)
+        for _ in range(REQUESTS):
+            writer.write(b'GET /description.xml HTTP/1.1\r\nHost: x\r\n\r\n')
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = [line for line in head.split(b'\r\n') if line.lower().startswith(b'content-length')]
+            await reader.readexactly(int(length[0].split(b':')[1]))
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(CONNECTIONS)))
+    return CONNECTIONS * REQUESTS / (time.perf_counter() - start)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    print('%d cores; %d searches (%d registrations), %d connections x %d requests' %
+          (os.cpu_count(), SEARCHES, DEVICES * 3, CONNECTIONS, REQUESTS))
+    print('%8s %14s %10s %14s' % ('workers', 'replies/s', 'received', 'requests/s'))
+    for workers in (1, 2, 4, 8):
+        if workers > top:
+            break
+        supervisor = Supervisor(workers, lambda index: worker(index, workers))
+        supervisor.start()
+        try:
+            time.sleep(0.5 + 0.1 * workers)
+            replies, received = asyncio.run(search_load())
+            requests = asyncio.run(http_load())
+        finally:
+            supervisor.stop()
+        print('%8d %14.0f %9.0f%% %14.0f' % (workers, replies, 100 * received, requests))
+
+
+if __name__ == '__main__':
+    main()
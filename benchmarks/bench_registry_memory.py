@@ -0,0 +1,97 @@
+"""
+Memory of the registry with 100,000 remote entries (25,000 devices, 4 search targets each): the per-USN
+dicts it used to hold vs the Registration records, and the whole server (registry, indexes, expiry heap).
+
+The headers are built anew for each entry, as parsing a datagram does, so the strings repeated across
+entries (ST, SERVER, the LOCATION and HOST of a device) are only shared when interned.
+
+    python -m benchmarks.bench_registry_memory
+"""
+import gc
+import logging
+import time
+import tracemalloc
+
+from upnp.registry import Registration
+from upnp.ssdp import SSDPServer
+
+ENTRIES = 100000
+TARGETS = ['upnp:rootdevice', 'urn:schemas-upnp-org:device:MediaRenderer:1',
+           'urn:schemas-upnp-org:service:AVTransport:1', 'urn:schemas-upnp-org:service:RenderingControl:1']
+SERVERS = ['Linux/%d.%d UPnP/1.0 Vendor-%d/1.%d' % (n, n % 10, n, n % 3) for n in range(20)]
+
+
+def announcements():
+    """(usn, st, headers, host) of the NOTIFYs of the devices"""
+    for n in range(ENTRIES):
+        device, target = divmod(n, len(TARGETS))
+        host = '10.%d.%d.%d' % (device >> 16 & 255, device >> 8 & 255, device & 255)
+        st = ''.join(TARGETS[target])  # a copy, as parsed
+        headers = {
+            'location': 'http://%s:49152/description.xml' % host,
+            'server': ''.join(SERVERS[device % len(SERVERS)]),
+            'cache-control': 'max-age=%d' % 1800,
+        }
+        yield 'uuid:%08x-0000-1000-8000-000000000000::%s' % (device, st), st, headers, host
+
+
+def legacy(usn, st, headers, host):
+    """An entry as `remember` built it before the records"""
+    return {
+        'USN': usn,
+        'LOCATION': headers['location'],
+        'ST': st,
+        'EXT': '',
+        'SERVER': headers.get('server', ''),
+        'CACHE-CONTROL': headers['cache-control'],
+        'MANIFESTATION': 'remote',
+        'SILENT': False,
+        'HOST': host,
+        'last-seen': time.time(),
+    }
+
+
+def record(usn, st, headers, host):
+    return Registration(usn, headers['location'], st, headers.get('server', ''), headers['cache-control'],
+                        'remote', host=host)
+
+
+def measure(build):
+    """:return: the bytes per entry still allocated after `build`, and what it returned"""
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory / ENTRIES, kept
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    # the announcements are made while measuring and dropped as they are used, as received datagrams are:
+    # whatever the registry keeps of them is counted
+    dicts, kept = measure(lambda: {usn: legacy(usn, st, headers, host) for usn, st, headers, host in announcements()})
+    del kept
+    records, kept = measure(lambda: {usn: record(usn, st, headers, host) for usn, st, headers, host in announcements()})
+    last = next(iter(reversed(kept.values())))
+    assert last == dict(legacy(*list(announcements())[-1]), **{'last-seen': last['last-seen']})
+    del kept, last
+
+    def serve():
+        server = SSDPServer('127.0.0.1', max_remote=ENTRIES)
+        for usn, st, headers, host in announcements():
+            server.remember(usn, st, headers, host)
+        return server
+
+    server, kept = measure(serve)
+    assert len(kept.remote_devices()) == ENTRIES
+    del kept
+
+    print('%d remote entries' % ENTRIES)
+    print('dicts         %8.0f bytes/entry' % dicts)
+    print('records       %8.0f bytes/entry (%.0f%%)' % (records, 100 * records / dicts))
+    print('whole server  %8.0f bytes/entry (registry, indexes, expiry)' % server)
+
+
+if __name__ == '__main__':
+    main()
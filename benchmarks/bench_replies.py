@@ -0,0 +1,73 @@
+"""
+M-SEARCH replies per second with 1, 100 and 10,000 registered services, for the precompiled datagrams
+and for the per-request formatting they replaced.
+
+    python -m benchmarks.bench_replies
+"""
+import logging
+import time
+from email.utils import formatdate
+
+from upnp.ssdp import SSDPServer
+
+
+class NullTransport:
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, data, addr):
+        self.sent += 1
+
+
+def legacy_discovery_request(server, headers, host_port):
+    """The reply path before the datagrams were precompiled."""
+    for i in server.known.values():
+        if i['MANIFESTATION'] == 'remote':
+            continue
+        if headers['st'] == 'ssdp:all' and i['SILENT']:
+            continue
+        if i['ST'] == headers['st'] or headers['st'] == 'ssdp:all':
+            response = ['HTTP/1.1 200 OK']
+            for k, v in i.items():
+                if k not in ('MANIFESTATION', 'SILENT', 'HOST'):
+                    response.append('%s: %s' % (k, v))
+            response.append('DATE: %s' % formatdate(timeval=None, localtime=False, usegmt=True))
+            response.extend(('', ''))
+            server.transport.sendto('\r\n'.join(response).encode(), host_port)
+
+
+def make_server(services):
+    server = SSDPServer('127.0.0.1')
+    for n in range(services):
+        server.register('local', 'uuid:bench-%d::urn:schemas-upnp-org:service:Bench:1' % n,
+                        'urn:schemas-upnp-org:service:Bench:1',
+                        'http://127.0.0.1:8088/%d/description.xml' % n)
+    server.transport = NullTransport()
+    # the same source searching over and over: not what is measured here
+    server.limiter = None
+    return server
+
+
+def replies_per_second(server, search, duration=1.0):
+    headers = {'st': 'ssdp:all', 'mx': '0', 'man': '"ssdp:discover"'}
+    start = time.perf_counter()
+    server.transport.sent = 0
+    port = 0
+    while time.perf_counter() - start < duration:
+        port += 1
+        search(headers, ('127.0.0.1', port))
+    return server.transport.sent / (time.perf_counter() - start)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    print('%10s %16s %16s' % ('services', 'legacy rep/s', 'compiled rep/s'))
+    for services in (1, 100, 10000):
+        server = make_server(services)
+        legacy = replies_per_second(server, lambda h, a: legacy_discovery_request(server, h, a))
+        compiled = replies_per_second(server, server.discovery_request)
+        print('%10d %16.0f %16.0f' % (services, legacy, compiled))
+
+
+if __name__ == '__main__':
+    main()
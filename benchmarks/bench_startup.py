@@ -0,0 +1,70 @@
+"""
+Start-up cost, measured in fresh interpreters: what `python -X importtime` says about our modules, and the
+time to load a description with an empty and with a warm DescriptionCache.
+
+    python -m benchmarks.bench_startup
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RUNS = 7
+
+MODULES = ('upnp.__main__', 'upnp.ssdp', 'upnp.http_server', 'upnp.description', 'yaml')
+
+LOAD = '''
+import sys, time
+start = time.perf_counter()
+from upnp.description import DescriptionCache, ServiceDescription
+ServiceDescription('examples/m87.yaml', ('10.0.0.2', 8088), cache=DescriptionCache(sys.argv[1]))
+print(time.perf_counter() - start, 'yaml' in sys.modules)
+'''
+
+
+def import_time(module):
+    """Microseconds to import `module` (and what it imports), median of RUNS fresh interpreters."""
+    times = []
+    for _ in range(RUNS):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                                cwd=ROOT, capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split('|')
+            if len(parts) == 3 and parts[2].strip() == module:
+                times.append(int(parts[1]))
+    return statistics.median(times)
+
+
+def load_time(cache_directory):
+    """Seconds to import and load a description in a fresh interpreter, and whether yaml was imported."""
+    result = subprocess.run([sys.executable, '-c', LOAD, cache_directory],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    elapsed, yaml_imported = result.stdout.split()
+    return float(elapsed), yaml_imported == 'True'
+
+
+def main():
+    # compile the .pyc first, it is not what we want to measure
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', 'upnp'], cwd=ROOT, check=True)
+    print('%-20s %12s' % ('import', 'ms'))
+    for module in MODULES:
+        print('%-20s %12.1f' % (module, import_time(module) / 1000.))
+
+    print()
+    print('%-20s %12s %8s' % ('description', 'ms', 'yaml'))
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('cold cache', 'warm cache'):
+            runs = []
+            for _ in range(RUNS):
+                if name == 'cold cache':
+                    for entry in os.listdir(directory):
+                        os.unlink(os.path.join(directory, entry))
+                runs.append(load_time(directory))
+            print('%-20s %12.1f %8s' % (name, statistics.median(r[0] for r in runs) * 1000, runs[-1][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+Sample SSDP traffic, as seen on a busy segment: searches from control points, NOTIFYs from TVs and
+media players, search responses, and some garbage.
+"""
+
+MSEARCH_ALL = (b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\n'
+               b'ST: ssdp:all\r\n\r\n')
+MSEARCH_ROOT = (b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 3\r\n'
+                b'ST: upnp:rootdevice\r\nUSER-AGENT: Microsoft-Windows/10.0 UPnP/1.0\r\n\r\n')
+MSEARCH_DIAL = (b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\n'
+                b'ST: urn:dial-multiscreen-org:service:dial:1\r\n'
+                b'USER-AGENT: Google Chrome/118.0.5993.117 Linux\r\n\r\n')
+NOTIFY_ALIVE = (b'NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nCACHE-CONTROL: max-age=1800\r\n'
+                b'LOCATION: http://192.168.1.23:8008/ssdp/device-desc.xml\r\nNT: upnp:rootdevice\r\n'
+                b'NTS: ssdp:alive\r\nSERVER: Linux/3.8.13+, UPnP/1.0, Portable SDK for UPnP devices/1.6.18\r\n'
+                b'X-User-Agent: redsonic\r\nUSN: uuid:3e1cc7c3-f2b9-9e5f-7d2e-5a2a1cb1bf4a::upnp:rootdevice\r\n'
+                b'BOOTID.UPNP.ORG: 7339\r\nCONFIGID.UPNP.ORG: 7339\r\n\r\n')
+NOTIFY_BYEBYE = (b'NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nNT: urn:schemas-upnp-org:device:MediaRenderer:1\r\n'
+                 b'NTS: ssdp:byebye\r\nUSN: uuid:5f9ec1b3-ed59-1900-4530-00a0dee1d2e4::'
+                 b'urn:schemas-upnp-org:device:MediaRenderer:1\r\n\r\n')
+RESPONSE = (b'HTTP/1.1 200 OK\r\nCACHE-CONTROL: max-age=1800\r\nDATE: Tue, 17 Oct 2023 10:00:00 GMT\r\nEXT:\r\n'
+            b'LOCATION: http://192.168.1.40:1400/xml/device_description.xml\r\n'
+            b'SERVER: Linux UPnP/1.0 Sonos/75.1-43010 (ZPS1)\r\nST: upnp:rootdevice\r\n'
+            b'USN: uuid:RINCON_000E58A0B1C201400::upnp:rootdevice\r\n\r\n')
+
+MALFORMED = [
+    b'',
+    b'M-SEARCH',
+    b'M-SEARCH\r\n\r\n',
+    b'GET / HTTP/1.1\r\nHost: 239.255.255.250\r\n\r\n',
+    b'\x00\x01\x02\x03' * 16,
+    b'NOTIFY * HTTP/1.1\r\nNT upnp:rootdevice\r\n',
+]
+
+# relative frequencies of a chatty network: mostly NOTIFYs
+TRAFFIC = [NOTIFY_ALIVE] * 10 + [NOTIFY_BYEBYE] * 2 + [MSEARCH_ALL, MSEARCH_ROOT, MSEARCH_DIAL] + [RESPONSE] * 3 + MALFORMED
@@ -0,0 +1,374 @@
+"""
+SSDP load generator: replays synthetic or recorded traffic at a `SSDPServer` and reports packets per second,
+reply latency percentiles and CPU/memory use, as JSON that can be compared across commits.
+
+Scenarios:
+    msearch     M-SEARCH storm, varying ST (ssdp:all, rootdevice, device type, uuid, unknown) and MX
+    notify      NOTIFY flood from `--devices` simulated devices (alive, byebye, some updates)
+    malformed   truncated, bit-flipped and garbage datagrams
+    mixed       all of the above and search responses, in the proportions of a chatty network
+
+The traffic goes straight into `datagram_received` (`--transport inprocess`, replies are recorded instead
+of sent), or through real UDP sockets on the loopback (`--transport loopback`).
+
+    python -m benchmarks.loadgen --scenario mixed --packets 50000 --json before.json
+    python -m benchmarks.loadgen --scenario mixed --packets 50000 --compare before.json
+    python -m benchmarks.loadgen --scenario notify --record notify.jsonl   # then --replay notify.jsonl
+
+Latency is measured for the answered MX: 0 searches only (the others wait a random part of MX on purpose), from the
+time the search is handed over to the first reply; `reply_lag` is how late replies leave on their schedule.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks.corpus import MALFORMED, MSEARCH_ALL, NOTIFY_ALIVE, RESPONSE
+from upnp.ssdp import SSDPServer, DATAGRAMS
+
+SCENARIOS = ('msearch', 'notify', 'malformed', 'mixed')
+DEVICE_TYPE = 'urn:schemas-upnp-org:device:Bench:1'
+SERVICE_TYPE = 'urn:schemas-upnp-org:service:Bench:1'
+UNKNOWN_TYPE = 'urn:schemas-upnp-org:device:Nothing:1'  # searched for, never answered
+CLIENT_SOCKETS = 256  # loopback: sources of the traffic
+TIMED_SOCKETS = 64  # loopback: sources of the MX: 0 searches only, so that their replies are not mixed up
+GRACE = 0.5  # seconds to wait for the last replies
+
+
+def msearch(st, mx):
+    return ('M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\n'
+            'MX: %s\r\nST: %s\r\n\r\n' % (mx, st)).encode()
+
+
+def notify(usn, nt, nts, max_age=1800):
+    lines = ['NOTIFY * HTTP/1.1', 'HOST: 239.255.255.250:1900', 'NT: %s' % nt, 'NTS: %s' % nts, 'USN: %s' % usn]
+    if nts != 'ssdp:byebye':
+        lines += ['CACHE-CONTROL: max-age=%d' % max_age, 'LOCATION: http://10.1.%d.%d/d.xml' % (hash(usn) % 250, 1),
+                  'SERVER: Linux/5.10 UPnP/1.0 loadgen/1.0']
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def response(usn, st):
+    return ('HTTP/1.1 200 OK\r\nCACHE-CONTROL: max-age=1800\r\nEXT:\r\nLOCATION: http://10.2.0.1/d.xml\r\n'
+            'ST: %s\r\nUSN: %s\r\n\r\n' % (st, usn)).encode()
+
+
+def search_traffic(rnd, count, services):
+    targets = ['ssdp:all', 'upnp:rootdevice', DEVICE_TYPE, SERVICE_TYPE, UNKNOWN_TYPE]
+    for _ in range(count):
+        st = rnd.choice(targets + ['uuid:bench-%d' % rnd.randrange(max(services, 1))])
+        yield msearch(st, rnd.choice((0, 0, 0, 1, 2, 3, 9, 'x')))
+
+
+def notify_traffic(rnd, count, devices):
+    for _ in range(count):
+        device = rnd.randrange(devices)
+        usn, nt = 'uuid:sim-%d::upnp:rootdevice' % device, 'upnp:rootdevice'
+        kind = rnd.random()
+        if kind < 0.8:
+            yield notify(usn, nt, 'ssdp:alive', rnd.choice((60, 1800)))
+        elif kind < 0.9:
+            yield notify(usn, nt, 'ssdp:update')
+        else:
+            yield notify(usn, nt, 'ssdp:byebye')
+
+
+def malformed_traffic(rnd, count):
+    seeds = [MSEARCH_ALL, NOTIFY_ALIVE, RESPONSE]
+    for n in range(count):
+        if n % 3 == 0:
+            yield rnd.choice(MALFORMED)
+            continue
+        data = bytearray(rnd.choice(seeds))
+        for _ in range(rnd.randint(1, 4)):
+            position = rnd.randrange(len(data))
+            if rnd.random() < 0.5:
+                data[position] = rnd.randrange(256)
+            else:
+                del data[position:]
+            if not data:
+                break
+        yield bytes(data)
+
+
+def traffic(scenario, count, devices, services, seed):
+    """The datagrams of a scenario."""
+    rnd = random.Random(seed)
+    if scenario == 'msearch':
+        return list(search_traffic(rnd, count, services))
+    if scenario == 'notify':
+        return list(notify_traffic(rnd, count, devices))
+    if scenario == 'malformed':
+        return list(malformed_traffic(rnd, count))
+    parts = [
+        list(notify_traffic(rnd, count * 60 // 100, devices)),
+        list(search_traffic(rnd, count * 25 // 100, services)),
+        [response('uuid:sim-%d::upnp:rootdevice' % rnd.randrange(devices), 'upnp:rootdevice')
+         for _ in range(count * 10 // 100)],
+    ]
+    parts.append(list(malformed_traffic(rnd, count - sum(map(len, parts)))))
+    mixed = [data for part in parts for data in part]
+    rnd.shuffle(mixed)
+    return mixed
+
+
+def record(path, datagrams, rate):
+    with open(path, 'w') as f:
+        for n, data in enumerate(datagrams):
+            f.write(json.dumps({'t': n / rate if rate else 0, 'data': base64.b64encode(data).decode()}) + '\n')
+
+
+def replay(path):
+    """:return: [(t, data)] from a file written by `--record`: one json object per line"""
+    with open(path) as f:
+        return [(entry['t'], base64.b64decode(entry['data'])) for entry in map(json.loads, f) if entry]
+
+
+class Recorder:
+    """In process transport: timestamps the replies instead of sending them."""
+
+    def __init__(self, timing):
+        self.timing = timing
+        self.sent = 0
+
+    def sendto(self, data, addr=None):
+        self.sent += 1
+        self.timing.reply(addr, time.perf_counter())
+
+    def close(self):
+        pass
+
+
+class Timing:
+    """Search to first reply, for the MX: 0 searches that get one: at most one is timed per source at a time."""
+
+    def __init__(self):
+        self.pending = {}  # source -> send time
+        self.latencies = []
+
+    @staticmethod
+    def timed(data):
+        return b'\r\nMX: 0\r\n' in data and UNKNOWN_TYPE.encode() not in data
+
+    def search(self, source, data, now):
+        if source not in self.pending and self.timed(data):
+            self.pending[source] = now
+
+    def reply(self, destination, now):
+        sent = self.pending.pop(destination[:2], None)
+        if sent is not None:
+            self.latencies.append(now - sent)
+
+
+def percentiles(values, scale=1000.):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * scale, 3)
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(values[-1] * scale, 3)}
+
+
+def received():
+    return sum(DATAGRAMS.values.values())
+
+
+def make_server(services, limit=False):
+    server = SSDPServer('127.0.0.1')
+    if not limit:
+        server.limiter = None
+    for n in range(services):
+        server.register_device('uuid:bench-%d' % n, 'http://127.0.0.1:8088/%d/description.xml' % n, DEVICE_TYPE,
+                               (SERVICE_TYPE,))
+    return server
+
+
+async def run(schedule, transport, services, rate, limit=False):
+    """
+    :param schedule: [(t, data)], t in seconds from the start (None: as fast as `rate` allows)
+    :param limit: keep the search rate limit of the server
+    """
+    loop = asyncio.get_running_loop()
+    server = make_server(services, limit)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    await server.start(sock)
+    # not measuring our own announcements
+    server.announcer.stop()
+    timing = Timing()
+
+    clients = []
+    real_transport = server.transport
+    if transport == 'inprocess':
+        server.transport = Recorder(timing)
+    else:
+        for _ in range(CLIENT_SOCKETS + TIMED_SOCKETS):
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.bind(('127.0.0.1', 0))
+            client.setblocking(False)
+            loop.add_reader(client.fileno(), _drain, client, timing)
+            clients.append(client)
+    destination = sock.getsockname()
+
+    start_received = received()
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    for n, (t, data) in enumerate(schedule):
+        due = start + (t if t is not None else (n / rate if rate else 0))
+        now = time.perf_counter()
+        if due > now + 0.001:
+            await asyncio.sleep(due - now)
+        elif n % 64 == 0:
+            # let the loop run the replies (and, on the loopback, read the socket)
+            await asyncio.sleep(0)
+        if transport == 'inprocess':
+            source = ('10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255), 1024 + n % 60000)
+            now = time.perf_counter()
+            timing.search(source, data, now)
+            server.datagram_received(data, source)
+        else:
+            if timing.timed(data):
+                client = clients[CLIENT_SOCKETS + n % TIMED_SOCKETS]
+            else:
+                client = clients[n % CLIENT_SOCKETS]
+            now = time.perf_counter()
+            timing.search(client.getsockname(), data, now)
+            try:
+                client.sendto(data, destination)
+            except BlockingIOError:
+                pass
+    # everything handed over: wait for the server to read it all (loopback) and for the last replies
+    deadline = time.perf_counter() + 5
+    while received() - start_received < len(schedule) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    await asyncio.sleep(GRACE)
+
+    processed = received() - start_received
+    stats = server.responses.stats
+    for client in clients:
+        loop.remove_reader(client.fileno())
+        client.close()
+    server.stop()
+    real_transport.close()
+    cpu = (usage.ru_utime - start_usage.ru_utime) + (usage.ru_stime - start_usage.ru_stime)
+    return {
+        'packets': len(schedule),
+        'processed': processed,
+        'lost': len(schedule) - processed,
+        'elapsed_s': round(elapsed, 4),
+        'packets_per_s': round(processed / elapsed, 1),
+        'replies': stats['sent'],
+        'reply_latency_ms': percentiles(timing.latencies),
+        'reply_lag_ms': {
+            'mean': round(stats['lag_total'] / stats['sent'] * 1000, 3) if stats['sent'] else None,
+            'max': round(stats['lag_max'] * 1000, 3),
+        },
+        'coalesced': stats['coalesced'],
+        'rate_limited': server.limiter.stats if server.limiter is not None else None,
+        'remote_devices': len(server.index.by_manifestation.get('remote', ())),
+        'cpu_s': round(cpu, 3),
+        'cpu_percent': round(100 * cpu / elapsed, 1),
+        'max_rss_kib': usage.ru_maxrss,
+    }
+
+
+def _drain(client, timing):
+    while True:
+        try:
+            data = client.recv(8192)
+        except BlockingIOError:
+            return
+        if data:
+            timing.reply(client.getsockname(), time.perf_counter())
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(result, baseline):
+    print('%-20s %12s %12s %8s' % ('', 'baseline', 'now', 'ratio'))
+    for key, path in (('packets/s', ('packets_per_s',)), ('latency p50 ms', ('reply_latency_ms', 'p50')),
+                      ('latency p99 ms', ('reply_latency_ms', 'p99')), ('cpu s', ('cpu_s',)),
+                      ('max rss KiB', ('max_rss_kib',))):
+        values = []
+        for data in (baseline, result):
+            for name in path:
+                data = data.get(name) if data else None
+            values.append(data)
+        ratio = '%.2f' % (values[1] / values[0]) if values[0] and values[1] is not None else '-'
+        print('%-20s %12s %12s %8s' % (key, values[0], values[1], ratio))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay SSDP traffic at a SSDPServer.')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+    parser.add_argument('--transport', choices=('inprocess', 'loopback'), default='inprocess')
+    parser.add_argument('--packets', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0, help='packets per second, 0 for as fast as possible')
+    parser.add_argument('--devices', type=int, default=5000, help='simulated remote devices')
+    parser.add_argument('--services', type=int, default=100, help='devices registered on the server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--limit', action='store_true', help='with the search rate limit of the server (off: '
+                                                             'the capacity is measured)')
+    parser.add_argument('--replay', help='a traffic file written by --record, instead of --scenario')
+    parser.add_argument('--record', help='write the traffic to this file and exit')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.disable(logging.CRITICAL)
+    if args.replay:
+        schedule = replay(args.replay)
+    else:
+        schedule = [(None, data) for data in
+                    traffic(args.scenario, args.packets, args.devices, args.services, args.seed)]
+    if args.record:
+        record(args.record, [data for _, data in schedule], args.rate)
+        return
+
+    result = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'scenario': 'replay:%s' % os.path.basename(args.replay) if args.replay else args.scenario,
+        'transport': args.transport,
+        'rate': args.rate,
+        'services': args.services,
+        'devices': args.devices,
+        'seed': args.seed,
+        'limit': args.limit,
+    }
+    result.update(asyncio.run(run(schedule, args.transport, args.services, args.rate, args.limit)))
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
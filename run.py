@@ -1,4 +1,5 @@
-import upnp.__main__
+from upnp.__main__ import run
 
 # ONLY USED TO DEBUG FROM PYCHARM - you can run by `python -m upnp`  # command line available soon...
-# or i could put the real running code in __init__ and import main from there?
+if __name__ == '__main__':
+    run()
@@ -1,23 +1,28 @@
-import argparse
-import os
-import uuid
-import json
-import yaml
-from time import sleep
+"""
+The server: `python -m upnp`, or `main()` from your own code.
+
+Importing this module has no side effects, and the heavy modules (yaml, the HTTP stack...) are only imported
+when needed: on small boards they are what delays the first announcement.
+"""
 import logging
+from time import sleep
 
-try:
-    import netifaces
-except:
-    netifaces = None
-    print("netifaces not available. You need to specify an IP address to bind to.")
+logger = logging.getLogger()
 
-from .ssdp import SSDPServer
-from .http_server import UPNPHTTPServer
+_netifaces = False  # not imported yet
 
 
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+def get_netifaces():
+    """The netifaces module, None if it is not available."""
+    global _netifaces
+    if _netifaces is False:
+        try:
+            import netifaces
+            _netifaces = netifaces
+        except ImportError:
+            _netifaces = None
+            logger.warning("netifaces not available. You need to specify an IP address to bind to.")
+    return _netifaces
 
 
 def get_network_interface_ip_address(interface):
@@ -26,6 +31,7 @@ def get_network_interface_ip_address(interface):
     :param interface: The name of the interface.
     :return: The IP address.
     """
+    netifaces = get_netifaces()
     if not netifaces:
         # you will have to set your own uip address, or I can guess one from a local socket
         return None
@@ -45,77 +51,152 @@ def get_network_interface_ip_address(interface):
         return interface[2][0]['addr']
 
 
-# @TODO once clean, move into separate file
-class ServiceDescription:
-
-    def __init__(self, dscr, address):
-        with open(dscr) as f:
-            values = self._description_data = yaml.load(f)
-        if values.get('template'):
-            # a template in the json will override the template
-            template = values.get('template')
-        else:
-            # not sure if this the best place to put it
-            template = "examples/service.template.xml"
-
-        values.update({'presentation_url': 'http://{}:{}/description.xml'.format(*address)})
-        self._values = values
-        path = os.path.dirname(__file__)
-        with open(os.path.join(path, "..", template)) as f:
-            _template = f.read()
-        self.description = _template.format(**values)
-
-    def __getattr__(self, item):
-        return self._values[item]
-
-    @property
-    def usn(self):
-        # USN: uuid:Upnp-IRCamera-1_0-858fba00-d3a0-11dd-a001-00407F401ABA::upnp:rootdevice
-        return 'uuid:{}-{}::upnp:rootdevice'.format(self._values['UDN'], self._values['MAC'])
+def get_network_interface_ip_addresses(interfaces):
+    """
+    Get the first IP address of several network interfaces.
+    :param interfaces: The names of the interfaces, `all` for every interface with an IPv4 address (but loopback).
+    :return: The IP addresses.
+    """
+    netifaces = get_netifaces()
+    if not netifaces:
+        return []
 
+    if 'all' in interfaces:
+        addresses = []
+        for interface in netifaces.interfaces():
+            for address in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+                if not address['addr'].startswith('127.'):
+                    addresses.append(address['addr'])
+        return addresses
+    return [get_network_interface_ip_address(interface) for interface in interfaces]
 
 
-def main(description_file, interface=None, address=None):
+def main(description_files, interface=None, address=None, ipv6=None, watch=False, cache=True, workers=1,
+         snapshot=True):
     """
 
-    :param description: where to find the json server description
+    :param description_files: where to find the yaml device description(s): files or directories
+    :param interface: name(s) of the interface(s) to serve, or `all`
+    :param address: address(es) to serve, if the interfaces can't be used
+    :param ipv6: IPv6 address to serve the IPv6 SSDP groups with (on the first interface)
+    :param watch: reload the descriptions when their files change
+    :param cache: keep the rendered descriptions on disk (a directory, or True for the default one)
+    :param workers: processes serving the sockets, see upnp.prefork
+    :param snapshot: keep the remote devices on disk across restarts (a file, or True for the default one)
     :return:
     """
-
-    local_ip_address = get_network_interface_ip_address(interface) or address
+    import asyncio
+    from .description import DescriptionCache, host, jcu_config, load_descriptions
+    from .http_server import AsyncUPNPHTTPServer
+    from .jcu import JCUSessions
+    from .ssdp import SSDPServer
+
+    if isinstance(interface, str):
+        interface = [interface]
+    if isinstance(address, str):
+        address = [address]
+
+    local_ip_addresses = get_network_interface_ip_addresses(interface or []) or address
     port = 8088  # @todo make this parameteric as well
 
-    assert local_ip_address, "You need to specify a local IP address, either by IP or interface (requires netifaces)"
-
-    description = ServiceDescription(description_file, address=(local_ip_address, port))
-    http_server = UPNPHTTPServer((local_ip_address, port), description.description)
-    # http_server = UPNPHTTPServer(('0.0.0.0', port), description.description)
-    http_server.start()
-
-    ssdp = SSDPServer(local_ip_address)
-    # those definitions should probably be automatic, give the UUID!
-    ssdp.register('local',
-                  description.usn,
-                  'upnp:rootdevice',  # what are options exist?
-                  http_server.description_url)
-    ssdp.run()
+    assert local_ip_addresses, "You need to specify a local IP address, either by IP or interface (requires netifaces)"
+    # the first one is used in the description, SSDP replaces it on the other interfaces
+    local_ip_address = local_ip_addresses[0]
+
+    if cache:
+        cache = DescriptionCache(None if cache is True else cache)
+    descriptions = load_descriptions(description_files, address=(local_ip_address, port), cache=cache or None)
+    assert descriptions, "No device description could be loaded from {}".format(description_files)
+    if ipv6:
+        # all the addresses, of both families
+        http_server = AsyncUPNPHTTPServer(('', port), None)
+    elif len(local_ip_addresses) == 1:
+        http_server = AsyncUPNPHTTPServer((local_ip_address, port), None)
+    else:
+        http_server = AsyncUPNPHTTPServer(('0.0.0.0', port), None)
+    # each JCU gets the config of the first device
+    http_server.jcu_sessions = JCUSessions(jcu_config(descriptions))
+
+    # the IPv6 groups are joined on the first interface
+    ipv6_interface = interface[0] if interface and interface[0] != 'all' else 0
+    ssdp = SSDPServer(local_ip_addresses, ipv6=ipv6, ipv6_interface=ipv6_interface)
+    host(descriptions, http_server, ssdp)
+    logger.info("serving %d device(s)", len(descriptions))
+    watcher = None
+    if watch:
+        from .reload import DescriptionWatcher
+        watcher = DescriptionWatcher(description_files, (local_ip_address, port), descriptions, http_server, ssdp)
+    if snapshot:
+        from .snapshot import RegistrySnapshot
+        snapshot = RegistrySnapshot(ssdp, None if snapshot is True else snapshot)
+    if workers > 1:
+        from .prefork import prefork
+        prefork(workers, http_server, ssdp, watcher, registry_snapshot=snapshot or None)
+        return
+
+    # HTTP and SSDP share the same event loop
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(http_server.start())
+    if watcher:
+        watcher.start(loop)
+    if snapshot:
+        snapshot.load()
+        snapshot.start(loop)
+    ssdp.run(loop)
+    if snapshot:
+        snapshot.stop()
+        snapshot.save()
 
 # @todo instead of making it complicated with the interface, it's easier to just pass an ip address ;-)
 # but of course that's way less future proof...
 
 
-
-parser = argparse.ArgumentParser(description='UPNP Server.')
-parser.add_argument('device_description', default='examples/m87.yaml', nargs='?',
-                    help='description of the services(s) offered by this server')
-parser.add_argument('-i', '--iface', default='eth0',
-                    help='interface to be used to subscribe and send multicast packets. '
-                         'Due to how networking works on *nix we get an ipaddress from the iface,'
-                         ' which is then used to associate the socket (IP_MULTICAST_IF)')
-parser.add_argument('-a', '--address', default=None,
-                    help='address to be used to subscribe and send multicast packets.')
-
-args = parser.parse_args()
-
-# make those parametric from command line...
-main(args.device_description, args.iface, args.address)
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='UPNP Server.')
+    parser.add_argument('device_description', default=['examples/m87.yaml'], nargs='*',
+                        help='description(s) of the device(s) offered by this server: yaml files, '
+                             'or directories of yaml files')
+    parser.add_argument('-i', '--iface', action='append',
+                        help='interface to be used to subscribe and send multicast packets (default eth0). '
+                             'Due to how networking works on *nix we get an ipaddress from the iface,'
+                             ' which is then used to associate the socket (IP_MULTICAST_IF). '
+                             'Can be repeated, or `all` to serve every interface.')
+    parser.add_argument('-a', '--address', action='append',
+                        help='address to be used to subscribe and send multicast packets. Can be repeated.')
+    parser.add_argument('-6', '--ipv6', default=None,
+                        help='IPv6 address of this host: also serve the IPv6 SSDP groups (ff02::c and ff05::c).')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='reload the device descriptions (and their templates) when they change.')
+    parser.add_argument('--cache', default=True,
+                        help='where to keep the rendered descriptions (default: ~/.cache/upnp-ssdp).')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='render the descriptions at every start.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes serving HTTP and SSDP (SO_REUSEPORT), to use more than one core.')
+    parser.add_argument('--snapshot', default=True,
+                        help='where to keep the remote devices across restarts '
+                             '(default: ~/.cache/upnp-ssdp/registry.snapshot).')
+    parser.add_argument('--no-snapshot', dest='snapshot', action='store_false',
+                        help='rediscover the network at every start.')
+    parser.add_argument('--log-level', default='INFO', type=str.upper,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='the least severe messages logged (default: INFO).')
+    parser.add_argument('-v', '--verbose', dest='log_level', action='store_const', const='DEBUG',
+                        help='log every datagram and request (--log-level DEBUG).')
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    """The command line."""
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=args.log_level)
+    logger.setLevel(args.log_level)
+    # make those parametric from command line...
+    main(args.device_description, args.iface or ['eth0'], args.address, args.ipv6, args.watch, args.cache,
+         args.workers, args.snapshot)
+
+
+if __name__ == '__main__':
+    run()
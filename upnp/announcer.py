@@ -0,0 +1,213 @@
+import logging
+import random
+from collections import OrderedDict
+
+from .scheduler import DeadlineHeap
+
+logger = logging.getLogger()
+
+NOTIFY_RATE = 20  # packets per second
+
+
+class Announcer:
+    """
+    Periodic ssdp:alive NOTIFYs for every local registration.
+
+    Each registration is refreshed every `period` seconds (half its max-age). After the first announcement
+    the next one comes anywhere in the second half of the period, and later ones with a bit of jitter, so
+    services registered together are spread over the window instead of being announced in bursts.
+    Due announcements go through a token bucket of `rate` packets per second; each timer callback sends
+    as many as the bucket allows in one go, so a burst costs one wakeup. An announcement takes a token per
+    packet it sent (one per interface), the bucket may go into debt for the last one.
+    Python has no `sendmmsg`, this is the closest batching available to us.
+    """
+
+    def __init__(self, send, rate=NOTIFY_RATE, burst=None, jitter=0.1, lag=None):
+        """
+        :param send: called with the usn to announce, returns the number of packets sent (None counts as one)
+        :param rate: maximum NOTIFYs per second
+        :param burst: maximum NOTIFYs sent at once, defaults to `rate`
+        :param jitter: fraction of the period by which a refresh may come early
+        :param lag: a metrics Histogram, observing how late each announcement is
+        """
+        self.send = send
+        self.lag = lag
+        self.rate = rate
+        self.burst = burst or rate
+        self.jitter = jitter
+        self.loop = None
+        self.periods = {}  # usn -> seconds
+        self.refresh = DeadlineHeap()  # usn -> next announcement (loop time)
+        self.due = OrderedDict()  # usn -> when it should have been sent, waiting for the rate limit
+        self._first = set()  # not announced yet
+        self._tokens = self.burst
+        self._last = None
+        self._timer = None
+        self._timer_deadline = None
+        self.stats = {
+            'announced': 0,
+            'due': 0,
+            'lag_total': 0.0,  # seconds between the scheduled and the actual announcement
+            'lag_max': 0.0,
+        }
+
+    def add(self, usn, period):
+        """Announce `usn` now, then every `period` seconds."""
+        self.periods[usn] = period
+        self.refresh.discard(usn)
+        self._first.add(usn)
+        if self.loop:
+            self.due[usn] = self.loop.time()
+            self.stats['due'] = len(self.due)
+            self._arm(self.loop.time())
+
+    def remove(self, usn):
+        self.periods.pop(usn, None)
+        self._first.discard(usn)
+        self.refresh.discard(usn)
+        self.due.pop(usn, None)
+        self.stats['due'] = len(self.due)
+
+    def start(self, loop):
+        """Announce everything registered so far, and keep announcing."""
+        self.loop = loop
+        self._last = now = loop.time()
+        for usn in self.periods:
+            self.due.setdefault(usn, now)
+        self.stats['due'] = len(self.due)
+        self._arm(now)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = self._timer_deadline = None
+        self.loop = None
+
+    def _arm(self, deadline):
+        if self._timer_deadline is not None and self._timer_deadline <= deadline:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self.loop.call_at(deadline, self._run)
+
+    def _run(self):
+        self._timer = self._timer_deadline = None
+        now = self.loop.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        for usn, deadline in self.refresh.pop_expired(now):
+            self.due.setdefault(usn, deadline)
+
+        stats = self.stats
+        while self.due and self._tokens >= 1:
+            usn, deadline = self.due.popitem(last=False)
+            try:
+                sent = self.send(usn)
+            except Exception as e:
+                logger.error("announcement of %s failed: %r", usn, e)
+                sent = 1
+            self._tokens -= 1 if sent is None else sent
+            lag = now - deadline
+            stats['announced'] += 1
+            stats['lag_total'] += lag
+            if lag > stats['lag_max']:
+                stats['lag_max'] = lag
+            if self.lag is not None:
+                self.lag.observe(lag)
+            period = self.periods[usn]
+            if usn in self._first:
+                self._first.discard(usn)
+                period *= 1 - 0.5 * random.random()
+            else:
+                period *= 1 - self.jitter * random.random()
+            self.refresh.set(usn, now + period)
+        stats['due'] = len(self.due)
+
+        if self.due:
+            # wait for the next token
+            self._arm(now + (1 - self._tokens) / self.rate)
+        else:
+            deadline = self.refresh.next_deadline()
+            if deadline is not None:
+                self._arm(deadline)
+
+
+def test_announcer():
+    """The announcements: at most `rate` packets a second past the first burst, refreshes spread over the period."""
+
+    class Clock:
+        """The loop, as far as the announcer uses it, with the time moved by hand."""
+
+        def __init__(self):
+            self.now = 0.0
+            self.timers = []  # [when, callback, cancelled]
+
+        def time(self):
+            return self.now
+
+        def call_at(self, when, callback):
+            timer = [when, callback, False]
+            self.timers.append(timer)
+            return type('Handle', (), {'cancel': lambda handle: timer.__setitem__(2, True)})()
+
+        def run_until(self, end):
+            while True:
+                timers = [timer for timer in self.timers if not timer[2] and timer[0] <= end]
+                if not timers:
+                    break
+                timer = min(timers, key=lambda timer: timer[0])
+                self.timers.remove(timer)
+                # a callback takes some time: a timer armed for the rounding error of a token comes later
+                self.now = max(self.now + 1e-6, timer[0])
+                timer[1]()
+            self.now = end
+
+    clock = Clock()
+    sent = []  # (time, usn)
+    announcer = Announcer(lambda usn: sent.append((clock.now, usn)), rate=10, jitter=0.1)
+    for n in range(30):
+        announcer.add('uuid:%d' % n, 100)
+    announcer.start(clock)
+
+    clock.run_until(0)
+    assert len(sent) == 10  # the burst
+    clock.run_until(5)
+    assert sorted(usn for _, usn in sent) == sorted('uuid:%d' % n for n in range(30))
+    for second in range(1, 5):
+        assert len([time for time, _ in sent if second <= time < second + 1]) <= 10
+    assert announcer.stats['announced'] == 30 and announcer.stats['due'] == 0
+    # the first refresh anywhere in the second half of the period
+    first = dict((usn, time) for time, usn in sent)
+    refresh = announcer.refresh.deadlines
+    assert all(50 <= refresh[usn] - first[usn] <= 100 for usn in first)
+    assert max(refresh.values()) - min(refresh.values()) > 10
+
+    # later ones a period apart, give or take the jitter
+    del sent[:]
+    clock.run_until(210)
+    assert len(sent) > 30
+    last = {}
+    for time, usn in sent:
+        if usn in last:
+            assert 90 - 1 <= time - last[usn] <= 100 + 1  # (late by the rate limit, a bit)
+        last[usn] = time
+
+    announcer.remove('uuid:0')
+    del sent[:]
+    clock.run_until(400)
+    assert sent and 'uuid:0' not in {usn for _, usn in sent}
+
+    # a token per packet: sending on two interfaces halves the announcements
+    clock = Clock()
+    sent = []
+    announcer = Announcer(lambda usn: sent.append(usn) or 2, rate=10)
+    for n in range(10):
+        announcer.add('uuid:%d' % n, 100)
+    announcer.start(clock)
+    clock.run_until(0)
+    assert len(sent) == 5
+    clock.run_until(1)
+    assert len(sent) == 10
+    announcer.stop()
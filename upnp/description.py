@@ -0,0 +1,296 @@
+"""
+Device descriptions: a yaml file rendered through an XML template, and what is needed to host many of them.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from .document import DescriptionDocument, DESCRIPTION_PATH
+from .jcu import DEFAULT_JCU_CONFIG
+
+logger = logging.getLogger()
+
+
+def template_path(template):
+    # templates are relative to the project
+    return os.path.join(os.path.dirname(__file__), "..", template)
+
+
+@functools.lru_cache(maxsize=None)
+def read_template(template):
+    # devices usually share their template, read it once (`read_template.cache_clear()` when it changes)
+    with open(template_path(template)) as f:
+        return f.read()
+
+
+def _hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class DescriptionCache:
+    """
+    The rendered descriptions, on disk: parsing the yaml (and importing yaml at all) is what takes the most
+    time when starting on a small board.
+
+    There is one entry per yaml file (and address), valid as long as the hashes of the yaml and of the
+    template it was rendered with did not change.
+    """
+    VERSION = 1
+
+    def __init__(self, directory=None):
+        """:param directory: defaults to ~/.cache/upnp-ssdp"""
+        if directory is None:
+            directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'upnp-ssdp')
+        self.directory = directory
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _file(self, dscr, address, shared):
+        key = repr((self.VERSION, os.path.abspath(dscr), tuple(address), shared)).encode()
+        return os.path.join(self.directory, _hash(key) + '.json')
+
+    def get(self, dscr, address, shared, source):
+        """:return: the cached entry of the yaml `dscr`, whose content is `source`, or None"""
+        try:
+            with open(self._file(dscr, address, shared)) as f:
+                entry = json.load(f)
+            valid = (entry['source_hash'] == _hash(source) and
+                     entry['template_hash'] == _hash(read_template(entry['template']).encode()))
+        except (OSError, ValueError, KeyError, TypeError):
+            valid = False
+        if not valid:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry
+
+    def put(self, dscr, address, shared, source, entry):
+        entry = dict(entry, source_hash=_hash(source),
+                     template_hash=_hash(read_template(entry['template']).encode()))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            data = json.dumps(entry)
+            # whole files only, even with several processes starting at once
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(path, self._file(dscr, address, shared))
+        except (OSError, TypeError, ValueError) as e:
+            # e.g. a read only file system, or yaml values that are not json (dates)
+            logger.debug("Could not cache the description of %s: %r", dscr, e)
+
+
+class ServiceDescription:
+
+    def __init__(self, dscr, address, shared=False, cache=None):
+        """
+        :param dscr: the yaml description
+        :param address: (ip_address, port) of the HTTP server
+        :param shared: the HTTP server hosts more devices: serve the description on /<udn>/description.xml
+        :param cache: a DescriptionCache
+        """
+        self.file = dscr
+        with open(dscr, 'rb') as f:
+            source = f.read()
+        entry = cache.get(dscr, address, shared, source) if cache else None
+        if entry is None:
+            entry = self._render(source, address, shared)
+            if cache:
+                cache.put(dscr, address, shared, source, entry)
+        self._values = self._description_data = entry['values']
+        self.template = entry['template']
+        self.path = entry['path']
+        self.description = entry['description']
+        # what is actually served: encoded (and compressed) once
+        self.document = DescriptionDocument(self.description)
+
+    @staticmethod
+    def _render(source, address, shared):
+        import yaml
+
+        try:
+            values = yaml.safe_load(source)
+        except yaml.YAMLError as e:
+            raise ValueError("not a valid yaml description: %s" % e)
+        if values.get('template'):
+            # a template in the json will override the template
+            template = values.get('template')
+        else:
+            # not sure if this the best place to put it
+            template = "examples/service.template.xml"
+
+        if shared:
+            path = '/{}-{}{}'.format(values['UDN'], values['MAC'], DESCRIPTION_PATH)
+        else:
+            path = DESCRIPTION_PATH
+        values.update({'presentation_url': 'http://{}:{}{}'.format(address[0], address[1], path)})
+        return {
+            'values': values,
+            'template': template,
+            'path': path,
+            'description': read_template(template).format(**values),
+        }
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._values[item]
+
+    @property
+    def uuid(self):
+        # uuid:Upnp-IRCamera-1_0-858fba00-d3a0-11dd-a001-00407F401ABA
+        return 'uuid:{}-{}'.format(self._values['UDN'], self._values['MAC'])
+
+    @property
+    def location(self):
+        return self._values['presentation_url']
+
+    @property
+    def usn(self):
+        # USN: uuid:Upnp-IRCamera-1_0-858fba00-d3a0-11dd-a001-00407F401ABA::upnp:rootdevice
+        return '{}::upnp:rootdevice'.format(self.uuid)
+
+    @property
+    def device_type(self):
+        # the templates only have basic devices for now
+        return self._values.get('device_type', 'urn:schemas-upnp-org:device:basic:1')
+
+    @property
+    def jcu_config(self):
+        # the reply to `jcu_config`: the m87 one, for our model, with the overrides from the `jcu` section
+        config = dict(DEFAULT_JCU_CONFIG)
+        model = self._values.get('model') or {}
+        if model.get('name'):
+            config['cameraudn'] = model['name']
+        config.update(self._values.get('jcu') or {})
+        return config
+
+
+def description_files(paths):
+    """
+    :param paths: yaml files and directories (all their .yaml/.yml files)
+    :return: the yaml files
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(('.yaml', '.yml'))))
+        else:
+            files.append(path)
+    return files
+
+
+def is_shared(paths, files):
+    """Whether the devices need their own paths: there are more of them, or there might be (a directory)."""
+    if isinstance(paths, str):
+        paths = [paths]
+    return len(files) > 1 or any(os.path.isdir(path) for path in paths)
+
+
+def load_descriptions(paths, address, cache=None):
+    """
+    :param paths: yaml files and directories
+    :param address: (ip_address, port) of the HTTP server
+    :param cache: a DescriptionCache
+    :return: a ServiceDescription for each device (a uuid is served once)
+    """
+    files = description_files(paths)
+    shared = is_shared(paths, files)
+    descriptions = []
+    uuids = set()
+    for description_file in files:
+        try:
+            description = ServiceDescription(description_file, address=address, shared=shared, cache=cache)
+        except (OSError, KeyError, ValueError) as e:
+            logger.error("Could not load the description %s: %r", description_file, e)
+            continue
+        if description.uuid in uuids:
+            logger.warning("%s: %s is already served", description_file, description.uuid)
+            continue
+        uuids.add(description.uuid)
+        descriptions.append(description)
+    return descriptions
+
+
+def host(descriptions, http_server, ssdp):
+    """Serve the descriptions on `http_server` and announce the devices through `ssdp`."""
+    for description in descriptions:
+        http_server.add_description(description.path, description.document)
+        # rootdevice, uuid and device type; the announcer spreads the NOTIFYs of all the devices
+        ssdp.register_device(description.uuid, description.location, description.device_type)
+    if descriptions and http_server.description is None:
+        # /description.xml is the first device
+        http_server.description = descriptions[0].document
+
+
+def jcu_config(descriptions):
+    """
+    The config of the JCUs: the JCU path (/bi-cgi) is the same for all the devices hosted, so they all get
+    the one of the first device. Warns about the devices whose `jcu` section says otherwise.
+    """
+    config = descriptions[0].jcu_config
+    differing = [description.path for description in descriptions[1:] if description.jcu_config != config]
+    if differing:
+        logger.warning("the JCUs get the jcu config of %s, not the different one of %s", descriptions[0].path,
+                       ', '.join(differing))
+    return config
+
+
+def test_description_cache():
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DescriptionCache(os.path.join(directory, 'cache'))
+        dscr = os.path.join(directory, 'm87.yaml')
+        shutil.copy(template_path('examples/m87.yaml'), dscr)
+
+        rendered = ServiceDescription(dscr, ('10.0.0.2', 8088), cache=cache)
+        cached = ServiceDescription(dscr, ('10.0.0.2', 8088), cache=cache)
+        assert cache.stats == {'hits': 1, 'misses': 1}
+        assert cached.description == rendered.description and cached.document.etag == rendered.document.etag
+        assert (cached.uuid, cached.location, cached.jcu_config) == (rendered.uuid, rendered.location, rendered.jcu_config)
+
+        # another address, another entry
+        ServiceDescription(dscr, ('10.0.0.3', 8088), cache=cache)
+        assert cache.stats['misses'] == 2
+        # the yaml changed
+        with open(dscr, 'a') as f:
+            f.write('\n  serial: AE00615\n')
+        assert 'AE00615' in ServiceDescription(dscr, ('10.0.0.2', 8088), cache=cache).description
+        assert cache.stats['misses'] == 3
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_jcu_config():
+    import shutil
+
+    class Records(logging.Handler):
+        def __init__(self):
+            super().__init__(logging.WARNING)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    directory = tempfile.mkdtemp()
+    records = Records()
+    logger.addHandler(records)
+    try:
+        source = open(template_path('examples/m87.yaml')).read()
+        for n, jcu in enumerate(('', '', '\n  jcu:\n    keepalive: 1000\n')):
+            with open(os.path.join(directory, 'device-%d.yaml' % n), 'w') as f:
+                f.write(source.replace('MAC: 00407F401ABA', 'MAC: 00407F40000%d' % n) + jcu)
+        descriptions = load_descriptions(directory, ('10.0.0.2', 8088))
+        assert jcu_config(descriptions[:2]) == descriptions[0].jcu_config and not records.messages
+        assert jcu_config(descriptions)['keepalive'] != 1000
+        assert len(records.messages) == 1 and descriptions[2].path in records.messages[0]
+    finally:
+        logger.removeHandler(records)
+        shutil.rmtree(directory)
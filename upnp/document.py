@@ -0,0 +1,48 @@
+"""
+A device description as served: kept apart from the HTTP server, so that loading the descriptions does not
+import the whole HTTP stack.
+"""
+from email.utils import formatdate, parsedate_to_datetime
+import gzip
+import hashlib
+import time
+
+DESCRIPTION_PATH = '/description.xml'
+
+
+class DescriptionDocument:
+    """
+    A device description, encoded once with everything needed to serve it: the body (plain and gzipped),
+    its ETag and Last-Modified. Build a new one when the description changes.
+    """
+
+    def __init__(self, text, content_type='application/xml', max_age=1800, last_modified=None):
+        self.text = text
+        self.content_type = content_type
+        self.body = text.encode()
+        self.gzipped = gzip.compress(self.body, mtime=0)
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+        # a different representation needs a different (strong) ETag
+        self.gzipped_etag = '"%s-gzip"' % self.etag.strip('"')
+        self.last_modified_time = int(last_modified or time.time())
+        self.last_modified = formatdate(self.last_modified_time, usegmt=True)
+        self.cache_control = 'max-age=%d' % max_age
+
+    def __str__(self):
+        return self.text
+
+    def not_modified(self, headers):
+        """Whether the conditional headers of a request say the client has it already."""
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # weak comparison
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            return '*' in tags or self.etag in tags or self.gzipped_etag in tags
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.last_modified_time
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+        return False
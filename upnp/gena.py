@@ -0,0 +1,620 @@
+"""
+GENA eventing (UDA 1.1, 4.1): control points SUBSCRIBE to the eventSubURL of a service and get its evented
+state variables in NOTIFY requests, instead of polling the device.
+
+    publisher = EventPublisher()
+    publisher.add_service('/camera/event', {'Zoom': 1, 'Power': True})
+    http_server.gena = publisher  # answers SUBSCRIBE / UNSUBSCRIBE on the event urls
+    publisher.start(loop)
+    ...
+    publisher.update('/camera/event', {'Zoom': 4})  # from any thread
+
+Changes are collected for `moderation` seconds and go out as one NOTIFY per subscriber; the NOTIFYs are
+sent from the event loop on a few keep-alive connections per subscriber host (NotifyPool), so neither the
+thread changing the state nor the HTTP handlers ever wait for a subscriber.
+"""
+import asyncio
+import collections
+import ipaddress
+import logging
+import re
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+
+from .metrics import REGISTRY
+from .scheduler import DeadlineHeap
+
+logger = logging.getLogger()
+
+DEFAULT_TIMEOUT = 1800  # seconds, when the control point does not ask for one
+MIN_TIMEOUT = 60
+MAX_TIMEOUT = 86400  # what `Second-infinite` gets
+MODERATION = 0.2  # seconds the changes are collected before being sent
+CONNECTIONS_PER_HOST = 2
+MAX_CONNECTIONS = 64  # to all the subscribers
+DELIVERY_TIMEOUT = 5  # seconds to connect, and to get the answer to a NOTIFY
+IDLE_TIMEOUT = 30  # seconds an unused connection is kept
+MAX_SEQ = 4294967295  # SEQ wraps to 1
+MAX_SUBSCRIPTIONS = 64  # per service
+
+NOTIFIES = REGISTRY.counter('gena_notify_total', 'Event NOTIFYs sent to the subscribers, by result', ('result',))
+
+
+def _address(host):
+    try:
+        address = ipaddress.ip_address(host.split('%', 1)[0])
+    except ValueError:
+        return None
+    # (an IPv4 client of a dual stack socket)
+    return getattr(address, 'ipv4_mapped', None) or address
+
+
+def parse_callback(header, subscriber=None):
+    """
+    The CALLBACK header: one or more `<http://host:port/path>`.
+    :param subscriber: the address the SUBSCRIBE came from, if given the callbacks to other hosts are dropped:
+     anyone could have us send NOTIFYs to a third party otherwise
+    :return: [(host, port, path)], the ones we can deliver to
+    """
+    subscriber = _address(subscriber) if subscriber is not None else None
+    callbacks = []
+    for url in re.findall(r'<([^>]*)>', header or ''):
+        try:
+            url = urlsplit(url.strip())
+            port = url.port or 80
+        except ValueError:
+            continue
+        if url.scheme != 'http' or not url.hostname:
+            continue
+        if subscriber is not None and _address(url.hostname) != subscriber:
+            logger.warning("callback %s dropped: not the subscriber's address", url.geturl())
+            continue
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        callbacks.append((url.hostname, port, path))
+    return callbacks
+
+
+def parse_timeout(header):
+    """The TIMEOUT header, `Second-1800` or `Second-infinite`: :return: the seconds we grant"""
+    if not header:
+        return DEFAULT_TIMEOUT
+    value = header.strip().lower()
+    if not value.startswith('second-'):
+        return DEFAULT_TIMEOUT
+    value = value[len('second-'):]
+    if value == 'infinite':
+        return MAX_TIMEOUT
+    try:
+        return min(max(int(value), MIN_TIMEOUT), MAX_TIMEOUT)
+    except ValueError:
+        return DEFAULT_TIMEOUT
+
+
+def _value(value):
+    if isinstance(value, bool):
+        # UPnP booleans
+        return '1' if value else '0'
+    return escape(str(value))
+
+
+def propertyset(variables):
+    """The body of a NOTIFY."""
+    return ('<?xml version="1.0"?>\n<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">' +
+            ''.join('<e:property><%s>%s</%s></e:property>' % (name, _value(value), name)
+                    for name, value in variables.items()) +
+            '</e:propertyset>\n').encode()
+
+
+class Subscription:
+    __slots__ = ('sid', 'path', 'callbacks', 'timeout', 'expires', 'seq', 'pending', 'queued')
+
+    def __init__(self, sid, path, callbacks, timeout, now):
+        self.sid = sid
+        self.path = path  # of the service
+        self.callbacks = callbacks  # [(host, port, path)], the first one is used
+        self.timeout = timeout
+        self.expires = now + timeout
+        self.seq = 0  # of the next event
+        self.pending = None  # [variables, their propertyset or None] waiting to be sent
+        self.queued = False  # in the NotifyPool, or being sent
+
+    def request(self):
+        """Take the pending event: :return: the NOTIFY request"""
+        variables, body = self.pending
+        self.pending = None
+        if body is None:
+            body = propertyset(variables)
+        host, port, path = self.callbacks[0]
+        seq = self.seq
+        self.seq = seq + 1 if seq < MAX_SEQ else 1
+        return ('NOTIFY %s HTTP/1.1\r\nHOST: %s:%d\r\nCONTENT-TYPE: text/xml; charset="utf-8"\r\n'
+                'NT: upnp:event\r\nNTS: upnp:propchange\r\nSID: %s\r\nSEQ: %d\r\nCONTENT-LENGTH: %d\r\n\r\n' %
+                (path, host, port, self.sid, seq, len(body))).encode() + body
+
+
+class NotifyPool:
+    """
+    Sends the NOTIFYs of the subscriptions handed to `submit`, on the event loop.
+
+    There are at most `connections_per_host` connections to a subscriber host (and `max_connections` in all),
+    kept open between events for `idle_timeout` seconds. A subscription is sent one event at a time, so the
+    SEQs arrive in order; what changes meanwhile is merged into its next event. A failed delivery is not
+    retried (the subscriber will see a gap in the SEQs), the next event goes to the next callback url.
+    """
+
+    def __init__(self, connections_per_host=CONNECTIONS_PER_HOST, max_connections=MAX_CONNECTIONS,
+                 timeout=DELIVERY_TIMEOUT, idle_timeout=IDLE_TIMEOUT, keep_alive=True):
+        """:param keep_alive: False closes the connection after each NOTIFY (for comparison)"""
+        self.connections_per_host = connections_per_host
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.keep_alive = keep_alive
+        self.loop = None
+        self.queues = {}  # (host, port) -> deque of Subscriptions with an event to send
+        self.workers = collections.Counter()  # (host, port) -> running workers
+        self.running = 0
+        self.idle = {}  # (host, port) -> [(reader, writer, idle since)]
+        self._reaper = None
+        self._tasks = set()
+        self.stats = {
+            'sent': 0,
+            'failed': 0,
+            'opened': 0,
+            'reused': 0,
+        }
+
+    def start(self, loop):
+        self.loop = loop
+
+    def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        for connections in self.idle.values():
+            for _, writer, _ in connections:
+                writer.close()
+        self.idle.clear()
+        self.queues.clear()
+
+    def submit(self, subscription):
+        if subscription.queued:
+            # it will be sent (again) when its current event is done
+            return
+        subscription.queued = True
+        key = subscription.callbacks[0][:2]
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = collections.deque()
+        queue.append(subscription)
+        self._start_worker(key)
+
+    def _start_worker(self, key):
+        if self.workers[key] >= min(self.connections_per_host, len(self.queues[key])):
+            return False
+        if self.running >= self.max_connections:
+            return False
+        self.workers[key] += 1
+        self.running += 1
+        task = self.loop.create_task(self._worker(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _worker(self, key):
+        connection = None
+        try:
+            queue = self.queues[key]
+            while queue:
+                subscription = queue.popleft()
+                if subscription.pending is not None:
+                    connection, ok = await self._deliver(key, connection, subscription.request())
+                    if not ok and len(subscription.callbacks) > 1:
+                        subscription.callbacks.append(subscription.callbacks.pop(0))
+                subscription.queued = False
+                if subscription.pending is not None:
+                    self.submit(subscription)
+        finally:
+            if connection is not None:
+                self._park(key, connection)
+            self.workers[key] -= 1
+            if not self.workers[key]:
+                del self.workers[key]
+                if not self.queues.get(key, True):
+                    del self.queues[key]
+            self.running -= 1
+            # hosts that were waiting for a connection
+            for waiting in list(self.queues):
+                if self.running >= self.max_connections:
+                    break
+                if waiting not in self.workers:
+                    self._start_worker(waiting)
+
+    async def _deliver(self, key, connection, request):
+        """:return: (the connection, if it can be used again, whether the subscriber got it)"""
+        for attempt in (0, 1):
+            reused = True
+            if connection is None:
+                connection = self._idle_connection(key)
+            try:
+                if connection is None:
+                    reused = False
+                    connection = await asyncio.wait_for(asyncio.open_connection(*key), self.timeout)
+                    self.stats['opened'] += 1
+                else:
+                    self.stats['reused'] += 1
+                reader, writer = connection
+                writer.write(request)
+                status, keep_alive = await asyncio.wait_for(self._response(reader), self.timeout)
+            except (OSError, EOFError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    asyncio.TimeoutError) as e:
+                if connection is not None:
+                    connection[1].close()
+                connection = None
+                if reused and attempt == 0:
+                    # the subscriber closed the connection while it was idle: once more on a new one
+                    continue
+                self.stats['failed'] += 1
+                NOTIFIES.inc('failed')
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("NOTIFY to %s:%d failed: %r", key[0], key[1], e)
+                return None, False
+            ok = 200 <= status < 300
+            self.stats['sent' if ok else 'failed'] += 1
+            NOTIFIES.inc('ok' if ok else 'rejected')
+            if not (keep_alive and self.keep_alive):
+                connection[1].close()
+                connection = None
+            return connection, ok
+        return None, False
+
+    @staticmethod
+    async def _response(reader):
+        """:return: (status, whether the connection stays open)"""
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        version, status = lines[0].split()[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        length = int(headers.get('content-length') or 0)
+        if length:
+            await reader.readexactly(length)
+        connection = headers.get('connection', '')
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        return int(status), keep_alive
+
+    def _idle_connection(self, key):
+        connections = self.idle.get(key)
+        while connections:
+            reader, writer, _ = connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _park(self, key, connection):
+        self.idle.setdefault(key, []).append(connection + (time.monotonic(),))
+        if self._reaper is None:
+            self._reaper = self.loop.call_later(self.idle_timeout, self._reap)
+
+    def _reap(self):
+        self._reaper = None
+        limit = time.monotonic() - self.idle_timeout
+        for key, connections in list(self.idle.items()):
+            for connection in [c for c in connections if c[2] <= limit]:
+                connections.remove(connection)
+                connection[1].close()
+            if not connections:
+                del self.idle[key]
+        if self.idle:
+            self._reaper = self.loop.call_later(self.idle_timeout, self._reap)
+
+
+class EventPublisher:
+    """
+    The evented services of a server (by event url), their subscriptions and their state.
+
+    `subscribe`, `renew`, `unsubscribe` and `update` may be called from any thread (the threaded HTTP server
+    calls them from its handlers), the NOTIFYs are sent from the loop given to `start`. Subscriptions expire
+    after their timeout, checked on every call, so no timer is needed.
+    """
+
+    def __init__(self, moderation=MODERATION, pool=None, max_subscriptions=MAX_SUBSCRIPTIONS):
+        """
+        :param moderation: seconds to collect the changes of the state before sending them
+        :param pool: the NotifyPool delivering the events
+        :param max_subscriptions: the subscriptions a service takes, the others are refused
+        """
+        self.moderation = moderation
+        self.max_subscriptions = max_subscriptions
+        self.pool = pool or NotifyPool()
+        self.loop = None
+        self.services = {}  # event path -> {variable: value}, the current state
+        self.subscriptions = {}  # sid -> Subscription
+        self.by_path = {}  # event path -> {sid: Subscription}
+        self.expiry = DeadlineHeap()  # sid -> time.monotonic() of the expiry
+        self._dirty = {}  # event path -> {variable: value} changed since the last events
+        self._armed = False
+        self._timer = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'subscribed': 0,
+            'refused': 0,
+            'renewed': 0,
+            'unsubscribed': 0,
+            'expired': 0,
+            'events': 0,
+            'merged': 0,
+        }
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def start(self, loop):
+        self.loop = loop
+        self.pool.start(loop)
+        REGISTRY.gauge('gena_subscriptions', 'Event subscriptions', self.__len__)
+        with self._lock:
+            # what happened before
+            pending = [s for s in self.subscriptions.values() if s.pending is not None]
+            self._armed = bool(self._dirty)
+        loop.call_soon_threadsafe(self._submit, pending)
+        if self._armed:
+            loop.call_soon_threadsafe(self._arm)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.pool.stop()
+
+    def add_service(self, path, variables=None):
+        """Accept subscriptions on the event url `path`, whose evented variables are `variables`."""
+        with self._lock:
+            self.services[path] = dict(variables or {})
+            self.by_path.setdefault(path, {})
+
+    def remove_service(self, path):
+        with self._lock:
+            self.services.pop(path, None)
+            for sid in list(self.by_path.pop(path, ())):
+                self._remove(sid)
+
+    def has_service(self, path):
+        return path in self.services
+
+    def subscribe(self, path, callbacks, timeout=DEFAULT_TIMEOUT, now=None):
+        """
+        :param callbacks: [(host, port, path)], see parse_callback
+        :return: the new Subscription, that gets the whole state as its first event (SEQ 0), None if the service
+         has `max_subscriptions` already
+        """
+        now = time.monotonic() if now is None else now
+        subscription = Subscription('uuid:%s' % uuid.uuid4(), path, callbacks, timeout, now)
+        with self._lock:
+            self.expire(now)
+            if len(self.by_path[path]) >= self.max_subscriptions:
+                self.stats['refused'] += 1
+                return None
+            subscription.pending = [dict(self.services[path]), None]
+            self.subscriptions[subscription.sid] = subscription
+            self.by_path[path][subscription.sid] = subscription
+            self.expiry.set(subscription.sid, subscription.expires)
+            self.stats['subscribed'] += 1
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._submit, [subscription])
+        return subscription
+
+    def renew(self, sid, timeout=DEFAULT_TIMEOUT, now=None):
+        """:return: the Subscription, None if there is no such (unexpired) subscription"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.expire(now)
+            subscription = self.subscriptions.get(sid)
+            if subscription is None:
+                return None
+            subscription.timeout = timeout
+            subscription.expires = now + timeout
+            self.expiry.set(sid, subscription.expires)
+            self.stats['renewed'] += 1
+        return subscription
+
+    def unsubscribe(self, sid, now=None):
+        """:return: whether there was such a subscription"""
+        with self._lock:
+            self.expire(now)
+            if sid not in self.subscriptions:
+                return False
+            self._remove(sid)
+            self.stats['unsubscribed'] += 1
+        return True
+
+    def _remove(self, sid):
+        subscription = self.subscriptions.pop(sid)
+        self.by_path.get(subscription.path, {}).pop(sid, None)
+        self.expiry.discard(sid)
+        # (not sent if it is still queued)
+        subscription.pending = None
+
+    def expire(self, now=None):
+        """:return: the sids that expired (call it with the lock held)"""
+        now = time.monotonic() if now is None else now
+        expired = [sid for sid, _ in self.expiry.pop_expired(now) if sid in self.subscriptions]
+        for sid in expired:
+            logger.info("subscription %s expired", sid)
+            self._remove(sid)
+        self.stats['expired'] += len(expired)
+        return expired
+
+    def update(self, path, variables):
+        """
+        The evented variables of the service at `path` changed: the subscribers get them with the other changes
+        of the next `moderation` seconds.
+        """
+        with self._lock:
+            self.services[path].update(variables)
+            dirty = self._dirty.get(path)
+            if dirty is None:
+                self._dirty[path] = dict(variables)
+            else:
+                dirty.update(variables)
+            arm = self.loop is not None and not self._armed
+            self._armed = self._armed or arm
+        if arm:
+            # one wake up of the loop per batch, not per change
+            self.loop.call_soon_threadsafe(self._arm)
+
+    def _arm(self):
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.moderation, self.flush)
+
+    def flush(self):
+        """Send the changes collected so far (on the loop)."""
+        self._timer = None
+        with self._lock:
+            self._armed = False
+            dirty, self._dirty = self._dirty, {}
+            self.expire()
+            batches = [(variables, list(self.by_path.get(path, {}).values())) for path, variables in dirty.items()]
+        for variables, subscriptions in batches:
+            self.stats['events'] += 1
+            # one body for all the subscribers, unless they have something pending still
+            body = propertyset(variables)
+            for subscription in subscriptions:
+                if subscription.pending is None:
+                    subscription.pending = [variables, body]
+                else:
+                    merged = dict(subscription.pending[0])
+                    merged.update(variables)
+                    subscription.pending = [merged, None]
+                    self.stats['merged'] += 1
+            self._submit(subscriptions)
+
+    def _submit(self, subscriptions):
+        for subscription in subscriptions:
+            if subscription.pending is not None:
+                self.pool.submit(subscription)
+
+
+def test_gena():
+    """SUBSCRIBE over HTTP, batched NOTIFYs on one connection, renew and unsubscribe."""
+    from .http_server import AsyncUPNPHTTPServer
+
+    received = []
+
+    async def subscriber(reader, writer):
+        # a control point: answers the NOTIFYs, keeping the connection
+        received.append('connection')
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                break
+            headers = dict(line.split(': ', 1) for line in head.decode().split('\r\n')[1:] if line)
+            body = await reader.readexactly(int(headers['CONTENT-LENGTH']))
+            received.append((headers['SID'], int(headers['SEQ']), body.decode()))
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        writer.close()
+
+    async def request(port, head):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(head.encode() + b'\r\n')
+        response = (await reader.readuntil(b'\r\n\r\n')).decode()
+        writer.close()
+        return int(response.split()[1]), dict(line.split(': ', 1) for line in response.split('\r\n')[1:] if line)
+
+    async def wait_for(count):
+        for _ in range(200):
+            if len(received) >= count:
+                return
+            await asyncio.sleep(0.01)
+        assert False, received
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        stub = await asyncio.start_server(subscriber, '127.0.0.1', 0)
+        stub_port = stub.sockets[0].getsockname()[1]
+        http_server = AsyncUPNPHTTPServer(('127.0.0.1', 0), None)
+        publisher = http_server.gena = EventPublisher(moderation=0.05)
+        publisher.add_service('/event', {'Zoom': 1, 'Power': True})
+        publisher.start(loop)
+        await http_server.start()
+        port = http_server.address[1]
+        try:
+            status, headers = await request(port, 'SUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\n'
+                                                  'CALLBACK: <http://127.0.0.1:%d/cb>\r\nNT: upnp:event\r\n'
+                                                  'TIMEOUT: Second-300\r\n' % stub_port)
+            assert status == 200 and headers['TIMEOUT'] == 'Second-300', headers
+            sid = headers['SID']
+            await wait_for(2)
+            assert received[1] == (sid, 0, propertyset({'Zoom': 1, 'Power': True}).decode())
+
+            # two changes, one event
+            publisher.update('/event', {'Zoom': 2})
+            publisher.update('/event', {'Zoom': 3, 'Power': False})
+            await wait_for(3)
+            await asyncio.sleep(0.1)
+            assert received[2:] == [(sid, 1, propertyset({'Zoom': 3, 'Power': False}).decode())], received
+            assert publisher.pool.stats == {'sent': 2, 'failed': 0, 'opened': 1, 'reused': 1}
+
+            assert (await request(port, 'SUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\nSID: %s\r\n\r\n' % sid))[0] == 200
+            assert (await request(port, 'SUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\nSID: %s\r\n'
+                                        'NT: upnp:event\r\n' % sid))[0] == 400
+            # NOTIFYs only to the subscriber, and not too many subscriptions
+            assert (await request(port, 'SUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\nNT: upnp:event\r\n'
+                                        'CALLBACK: <http://10.0.0.1:%d/cb>\r\n' % stub_port))[0] == 412
+            publisher.max_subscriptions = 1
+            assert (await request(port, 'SUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\nNT: upnp:event\r\n'
+                                        'CALLBACK: <http://127.0.0.1:%d/cb>\r\n' % stub_port))[0] == 503
+            assert (await request(port, 'UNSUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\nSID: %s\r\n' % sid))[0] == 200
+            assert (await request(port, 'UNSUBSCRIBE /event HTTP/1.1\r\nHOST: x\r\nSID: %s\r\n' % sid))[0] == 412
+            assert (await request(port, 'SUBSCRIBE /nothing HTTP/1.1\r\nHOST: x\r\nNT: upnp:event\r\n'
+                                        'CALLBACK: <http://127.0.0.1:1/>\r\n'))[0] == 404
+            publisher.update('/event', {'Zoom': 4})
+            await asyncio.sleep(0.1)
+            assert len(received) == 3 and not publisher
+        finally:
+            publisher.stop()
+            http_server.close()
+            stub.close()
+
+    asyncio.run(run())
+
+
+def test_expiry():
+    publisher = EventPublisher()
+    publisher.add_service('/event', {'A': 1})
+    subscription = publisher.subscribe('/event', [('127.0.0.1', 1, '/')], timeout=60, now=0)
+    assert publisher.renew(subscription.sid, timeout=120, now=50) is subscription
+    assert publisher.renew(subscription.sid, timeout=120, now=169) is subscription
+    publisher.expire(now=290)
+    assert publisher.renew(subscription.sid, now=290) is None and not publisher
+    assert parse_timeout('Second-5') == MIN_TIMEOUT and parse_timeout('second-infinite') == MAX_TIMEOUT
+    assert parse_callback('<http://10.0.0.1:49152/cb?x=1><ftp://x/>') == [('10.0.0.1', 49152, '/cb?x=1')]
+    # only to the subscriber
+    assert parse_callback('<http://10.0.0.2/a><http://10.0.0.1/b><http://host/c>', '10.0.0.1') == \
+        [('10.0.0.1', 80, '/b')]
+    assert parse_callback('<http://10.0.0.1/b>', '::ffff:10.0.0.1') == [('10.0.0.1', 80, '/b')]
+
+    # a cap per service
+    publisher = EventPublisher(max_subscriptions=2)
+    publisher.add_service('/event', {'A': 1})
+    publisher.add_service('/other', {'B': 1})
+    first = publisher.subscribe('/event', [('127.0.0.1', 1, '/')], timeout=60, now=0)
+    assert publisher.subscribe('/event', [('127.0.0.1', 1, '/')], timeout=60, now=0)
+    assert publisher.subscribe('/event', [('127.0.0.1', 1, '/')], now=0) is None
+    assert publisher.subscribe('/other', [('127.0.0.1', 1, '/')], now=0)
+    assert publisher.unsubscribe(first.sid, now=0)
+    assert publisher.subscribe('/event', [('127.0.0.1', 1, '/')], now=0)
+    # the expired ones make room
+    assert publisher.subscribe('/event', [('127.0.0.1', 1, '/')], now=61)
+    assert publisher.stats['refused'] == 1
@@ -1,89 +1,68 @@
-# @TODO instead of using threading, replace with aiohttp!
+# UPNPHTTPServer runs the handler in a thread, AsyncUPNPHTTPServer runs the same handler on an asyncio loop
 from http.server import BaseHTTPRequestHandler, HTTPServer
+import http.client
+import asyncio
+import io
+import time
+import socket
 import threading
-import json
 import logging
 
+from .document import DescriptionDocument, DESCRIPTION_PATH
+from .gena import parse_callback, parse_timeout
+from .jcu import JCUSessions, command_label, compile_jcu_query
+from .metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
 logger = logging.getLogger()
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+
+HTTP_LATENCY = REGISTRY.histogram('http_request_duration_seconds', 'Time to answer a GET, by route', ('route',))
+JCU_COMMANDS = REGISTRY.counter('jcu_commands_total', 'JCU commands received, by command', ('command',))
+
+MAX_BODY = 64 << 10  # bytes; the bodies we get are JCU commands, a few hundred bytes
+
+
+def accepts_gzip(headers):
+    for coding in headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = coding.partition(';')
+        if coding.strip().lower() == 'gzip':
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
 
 
-def parse_jcu_command(path):
-    duration = None
-    # the logic is slightly weird. The main command is a 'structure' in dot notation,
-    # but there can be more than one "nested" value:
-    # > axis.t.displacement=-57,duration=0
-    # {"axis":{"t":{"displacement":-32,"duration":0}}}
-    # this is a generic way to parse, but in any case we'll need to interpret the commands at some point
+class DescriptionHolder:
     """
-    for some commands (`button`) the normal pattern:
-     
-        a.b.c=3,d=4 => a: b: c
-        
-    is instead:
-    
-        a.b,c=3,d=4
-        
-    in that case, _command should include the first additional term.
+    A server with DescriptionDocuments by path: `description` is the one at /description.xml, more devices
+    hosted by the same server have their own path (see `add_description`).
     """
-    # print("parsing {}".format(path))
-    commands = {}  # list of all commands
-    _commands = commands  # pointer
-    _path = path.split('.')
-
-    _v = _path[-1].split(',', 1)
-    if '=' not in _v[0]:
-        _command = _path[:-1] + [_v[0]]
-        # I have no examples yet... but there could be no "values". Might need to protect this.
-        _values = _v[1]
-    else:
-        _command = _path[:-1]
-        _values = _path[-1]
-
-    values = dict(v.split('=') for v in _values.split(','))
-
-    while _command:
-        k = _command.pop(0)
-        _commands[k] = {}
-        _commands = _commands[k]
-    for k, v in values.items():
-        try:
-            # check if this is a number...
-            v = float(v)
-        except:
-            pass
-        _commands[k] = v
-        if k == 'duration':  # special case - do we care?
-            duration = v
-    return commands
-
-
-def test_parse_jcu_command():
-
-    for (request, response) in [
-
-        # "jcu_config", {"config":{"timescale":-3,"magnitudescale":0,"keepalive":2000,"commandrepeat":500,"cameraudn":M-Series,"powerondelay":1000,"shutdowndelay":2000,"backlightdelay":1000,"deadbandatrest_idx":25,"deadbandatrest_idy":25,"deadbandatrest_idz":25, "deadbandatrest_idt":25,"deadbandtranslation_idx":0,"deadbandtranslation_idy":0,"deadbandtranslation_idz":0,"deadbandtranslation_idt":0}}),
-        ("connect.jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
-         {"connect": {"jcuudn": "uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6"}}),
-        ("keepalive.jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
-         {"keepalive": {"jcuudn": "uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6"}}),
-        ("axis.t.displacement=-32,duration=0",
-         {"axis": {"t": {"displacement": -32, "duration": 0}}}),
-        ("button.F,state=DOWN,duration=0,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
-         {"button": {"F": {"state": "DOWN", "duration": 0}}}),
-        ("button.F,state=UP,duration=210,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
-         {"button": {"F": {"state": "UP", "duration": 210}}}),
-        # the way things are combined is just... crazy....
-        ("button.F,state=DOWN,duration=2000,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6,F,state=UP,duration=2010,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6", {})
-    ]:
-        r = parse_jcu_command(request)
-        # This test will fail if jcuudn is returned for `button` messages... thou that's because it's a crappy api :-(
-        assert r == response, "parsing error: {} != {}".format(r, response)
+
+    @property
+    def description(self):
+        return self.descriptions.get(DESCRIPTION_PATH)
+
+    @description.setter
+    def description(self, description):
+        self.add_description(DESCRIPTION_PATH, description)
+
+    def add_description(self, path, description):
+        """
+        Serve `description` (text or DescriptionDocument) on `path`, replacing what was there.
+        :return: the DescriptionDocument
+        """
+        if description is None:
+            self.descriptions.pop(path, None)
+            return None
+        if not isinstance(description, DescriptionDocument):
+            description = DescriptionDocument(description)
+        self.descriptions[path] = description
+        return description
+
+    def remove_description(self, path):
+        self.descriptions.pop(path, None)
 
 
 class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
     """
-    A HTTP handler that serves the UPnP XML descriptions and responds to the JCU commands.
+    A HTTP handler that serves the UPnP XML descriptions, the GENA subscriptions and responds to the JCU commands.
 
 
     JCU
@@ -92,7 +71,6 @@ class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
     known requests (and responses)
 
 
-
     /bi-cgi?connect.jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6
         {"connect":{"jcuudn":"uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6"}}\r\n
     /bi-cgi?jcu_config
@@ -116,28 +94,114 @@ class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
 
     # Handler for the GET requests
     def do_GET(self):
-        logger.info("Got a `GET` for %s from %s", self.path, self.client_address)
+        start = time.perf_counter()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Got a `GET` for %s from %s", self.path, self.client_address)
         if self.path.startswith('/bi-cgi?'):
-            return self.parse_jcu_command(self.path.replace('/bi-cgi?', ''))
-
-        if self.path == '/description.xml':  # this should be parametric... check server.description_url!
-            return self.return_description()
-        # i could centralize sending the response here
-        logger.warning("Unknown request %s", self.path)
+            route = 'jcu'
+            self.parse_jcu_command(self.path.replace('/bi-cgi?', ''))
+        elif self.path == '/metrics':
+            route = 'metrics'
+            self.respond(self.server.metrics.render().encode(), METRICS_CONTENT_TYPE)
+        else:
+            document = self.server.descriptions.get(self.path)
+            if document is not None:
+                route = 'description'
+                self.return_description(document)
+            else:
+                # i could centralize sending the response here
+                route = 'unknown'
+                logger.warning("Unknown request %s", self.path)
+                self.send_error(404)
+        HTTP_LATENCY.observe(time.perf_counter() - start, route)
+
+    def do_SUBSCRIBE(self):
+        """GENA: a new subscription (NT and CALLBACK), or the renewal of one (SID)."""
+        start = time.perf_counter()
+        gena = self.server.gena
+        if gena is None or not gena.has_service(self.path):
+            self.send_error(404)
+            return
+        sid = self.headers.get('SID')
+        nt = self.headers.get('NT')
+        callbacks = self.headers.get('CALLBACK')
+        timeout = parse_timeout(self.headers.get('TIMEOUT'))
+        if sid:
+            if nt or callbacks:
+                self.send_error(400, 'Incompatible header fields')
+                return
+            subscription = gena.renew(sid, timeout)
+        else:
+            callbacks = parse_callback(callbacks, self.client_address[0])
+            if nt != 'upnp:event' or not callbacks:
+                self.send_error(412)
+                return
+            subscription = gena.subscribe(self.path, callbacks, timeout)
+            if subscription is None:
+                self.send_error(503, 'Too many subscriptions')
+                return
+        if subscription is None:
+            self.send_error(412)
+            return
+        self.send_response(200)
+        self.send_header('SID', subscription.sid)
+        self.send_header('TIMEOUT', 'Second-%d' % subscription.timeout)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        HTTP_LATENCY.observe(time.perf_counter() - start, 'gena')
+
+    def do_UNSUBSCRIBE(self):
+        gena = self.server.gena
+        if gena is None or not gena.has_service(self.path):
+            self.send_error(404)
+            return
+        if self.headers.get('NT') or self.headers.get('CALLBACK'):
+            self.send_error(400, 'Incompatible header fields')
+            return
+        if not gena.unsubscribe(self.headers.get('SID')):
+            self.send_error(412)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # BaseHTTPRequestHandler writes every request to stderr
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s - %s", self.address_string(), format % args)
 
     def respond(self, message, content_type='text/html'):
         try:
             self.send_response(200)
             self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(len(message)))
             self.end_headers()
             self.wfile.write(message)
         except Exception as e:
             logger.error('Could not send out a response to the request `%s`: %s', self.path, e)
 
-    def return_description(self):
-        logger.debug("sending description: %s", self.server.description)
-        self.respond(self.server.description.encode(), 'application/xml')
-        return
+    def return_description(self, document=None):
+        document = document or self.server.description
+        gzipped = accepts_gzip(self.headers)
+        try:
+            if document.not_modified(self.headers):
+                self.send_response(304)
+                body = b''
+            else:
+                self.send_response(200)
+                self.send_header('Content-type', document.content_type)
+                body = document.gzipped if gzipped else document.body
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', document.gzipped_etag if gzipped else document.etag)
+            self.send_header('Last-Modified', document.last_modified)
+            self.send_header('Cache-Control', document.cache_control)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            self.wfile.write(body)
+        except Exception as e:
+            logger.error('Could not send out a response to the request `%s`: %s', self.path, e)
 
     def parse_jcu_command(self, path):
         """
@@ -146,45 +210,66 @@ class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
         """
         # bit of repetition with bi-cgi. Instead, each response could check if it can handle the path.
         # Or we pass the "command" part to this method
+        sessions = self.server.jcu_sessions
+        source = self.client_address[0]
         if path == 'jcu_config':
             # this is a bit of an exception so we could take it out of this method
-            # here we should return some config:
-            logger.info("received an SSDP XML config request (%s)", self.path)
-            response = json.dumps(self.camera_config())
+            JCU_COMMANDS.inc('jcu_config')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("received an SSDP XML config request (%s)", self.path)
+            response = sessions.configure(source)
         else:
-            commands = parse_jcu_command(path)
-            #         if k == 'duration':  # special case - do we care?
-            response = json.dumps(commands)
-
-        self.respond(response.encode())
+            # parsed and serialized once per distinct query
+            commands, response = compile_jcu_query(path)
+            dispatcher = self.server.jcu_dispatcher
+            for command in commands:
+                JCU_COMMANDS.inc(command_label(command.command))
+                sessions.seen(command, source)
+                if dispatcher is not None:
+                    # acting on the commands is not our business, let alone in the HTTP handler
+                    dispatcher.dispatch(command, source)
+
+        self.respond(response)
 
     def camera_config(self):
-        # m87
-        config = {
-            "config": {
-                "timescale": -3, "magnitudescale": 0, "keepalive": 2000, "commandrepeat": 500,
-                "cameraudn": "M-Series", "powerondelay": 1000, "shutdowndelay": 2000,
-                "backlightdelay": 1000, "deadbandatrest_idx": 25, "deadbandatrest_idy": 25,
-                "deadbandatrest_idz": 25, "deadbandatrest_idt": 25, "deadbandtranslation_idx": 0,
-                "deadbandtranslation_idy": 0, "deadbandtranslation_idz": 0,
-                "deadbandtranslation_idt": 0
-            }
-        }
-        return config
-
-
-class UPNPHTTPServerBase(HTTPServer):
+        return {'config': self.server.jcu_sessions.config}
+
+
+class UPNPHTTPServerBase(DescriptionHolder, HTTPServer):
     """
     A simple HTTP server that knows the information about a UPnP device.
     """
+    jcu_dispatcher = None  # a JCUDispatcher receiving the JCU commands
+    gena = None  # an EventPublisher, answering SUBSCRIBE / UNSUBSCRIBE on its event urls
+    metrics = REGISTRY  # served on /metrics
 
     def __init__(self, server_address, request_handler_class, description):
+        if ':' in server_address[0]:
+            # IPv6 (on '::' this also accepts IPv4 clients, where the system allows dual stack sockets)
+            self.address_family = socket.AF_INET6
         HTTPServer.__init__(self, server_address, request_handler_class)
         self.port = server_address[1]
+        self.descriptions = {}  # path -> DescriptionDocument
         self.description = description
+        self.jcu_sessions = JCUSessions()  # replace it to serve another config
+
+
+class ServerURLs:
+    """The urls of a server with an `address`."""
 
+    @property
+    def baseurl(self):
+        host, port = self.address[:2]
+        if ':' in host:
+            host = '[{}]'.format(host)
+        return 'http://{}:{}'.format(host, port)
 
-class UPNPHTTPServer(threading.Thread):
+    @property
+    def description_url(self):
+        return self.baseurl + DESCRIPTION_PATH
+
+
+class UPNPHTTPServer(ServerURLs, threading.Thread):
     """
     A thread that runs UPNPHTTPServerBase.
     """
@@ -193,7 +278,7 @@ class UPNPHTTPServer(threading.Thread):
         """
 
         :param server_address: (ip_address, port)
-        :param description: (text to be sent back on the description_url
+        :param description: (text to be sent back on the description_url, or its DescriptionDocument
         """
         threading.Thread.__init__(self, daemon=True)
         self.server = UPNPHTTPServerBase(server_address, UPNPHTTPServerHandler, description)
@@ -202,13 +287,265 @@ class UPNPHTTPServer(threading.Thread):
     def address(self):
         return self.server.server_address
 
-    @property
-    def baseurl(self):
-        return 'http://{}:{}'.format(*self.address)
+    def run(self):
+        self.server.serve_forever()
+
+
+class AsyncRequestHandler(UPNPHTTPServerHandler):
+    """
+    Runs the UPNPHTTPServerHandler routes on a request already read by AsyncUPNPHTTPServer.
+
+    Nothing touches a socket: the body is read from memory and the response is collected in memory.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, server, client_address, command, path, request_version, headers, body=b''):
+        # BaseHTTPRequestHandler.__init__ would start reading from the connection
+        self.server = server
+        self.client_address = client_address
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.requestline = '%s %s %s' % (command, path, request_version)
+        self.headers = headers
+        self.rfile = io.BytesIO(body)
+        self.wfile = io.BytesIO()
+        self.close_connection = False
+
+    def handle_request(self):
+        """:return: the raw response"""
+        method = getattr(self, 'do_' + self.command, None)
+        if method is None:
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+        else:
+            method()
+        if not self.wfile.tell():
+            self.send_error(404)
+        return self.wfile.getvalue()
+
+
+class AsyncUPNPHTTPServer(DescriptionHolder, ServerURLs):
+    """
+    The HTTP server, on an asyncio loop (usually the SSDP one).
+
+    HTTP/1.1 with keep-alive; requests on a connection are answered one at a time and in order, so
+    pipelined requests are safe. Connections beyond `max_connections` get a 503, and a client has
+    `request_timeout` seconds to send a request (or to read its response), `keepalive_timeout` between requests.
+    Bodies over `max_body` bytes get a 413, too many (or too long) headers a 431.
+    """
+    handler_class = AsyncRequestHandler
+    jcu_dispatcher = None  # a JCUDispatcher receiving the JCU commands
+    gena = None  # an EventPublisher, answering SUBSCRIBE / UNSUBSCRIBE on its event urls
+    metrics = REGISTRY  # served on /metrics
+
+    def __init__(self, server_address, description, max_connections=512, request_timeout=10, keepalive_timeout=15,
+                 reuse_port=False, max_body=MAX_BODY):
+        """
+
+        :param server_address: (ip_address, port)
+        :param description: (text to be sent back on the description_url, or its DescriptionDocument
+        :param reuse_port: listen with SO_REUSEPORT, for several processes serving the same port
+        :param max_body: the largest request body accepted, in bytes
+        """
+        self.server_address = server_address
+        self.port = server_address[1]
+        self.descriptions = {}  # path -> DescriptionDocument
+        self.description = description
+        self.jcu_sessions = JCUSessions()  # replace it to serve another config
+        self.max_connections = max_connections
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.reuse_port = reuse_port
+        self.max_body = max_body
+        self.connections = 0
+        self._server = None
 
     @property
-    def description_url(self):
-        return '/'.join([self.baseurl, 'description.xml'])
+    def address(self):
+        if self._server and self._server.sockets:
+            return self._server.sockets[0].getsockname()
+        return self.server_address
+
+    async def start(self):
+        host, port = self.server_address[:2]
+        self._server = await asyncio.start_server(self._connection, host or None, port, reuse_address=True,
+                                                  reuse_port=self.reuse_port or None, backlog=self.max_connections)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+
+    async def _connection(self, reader, writer):
+        if self.connections >= self.max_connections:
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            writer.close()
+            return
+        self.connections += 1
+        client_address = writer.get_extra_info('peername')
+        try:
+            timeout = self.request_timeout
+            while True:
+                response, keep_alive = await asyncio.wait_for(self._request(reader, client_address), timeout)
+                if response is None:
+                    break
+                writer.write(response)
+                await asyncio.wait_for(writer.drain(), self.request_timeout)
+                if not keep_alive:
+                    break
+                timeout = self.keepalive_timeout
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            # (a body shorter than its Content-Length)
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
 
-    def run(self):
-        self.server.serve_forever()
+    async def _request(self, reader, client_address):
+        """
+        Read and answer one request.
+
+        :return: (the response, or None if the connection is done, whether to keep the connection open)
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return None, False
+        request_line, _, header_block = head.partition(b'\r\n')
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            return b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n', False
+        command, path, version = parts
+        try:
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+        except http.client.HTTPException:
+            # more than http.client._MAXHEADERS headers, or a header line over _MAXLINE
+            return (b'HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n',
+                    False)
+        try:
+            length = int(headers.get('Content-Length') or 0)
+        except ValueError:
+            return b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n', False
+        if length > self.max_body:
+            # not read, so not kept either
+            return b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n', False
+        body = await reader.readexactly(length) if length > 0 else b''
+
+        handler = self.handler_class(self, client_address, command, path, version, headers, body)
+        response = handler.handle_request()
+
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        return response, keep_alive and not handler.close_connection
+
+
+def test_request_limits():
+    """
+    A body over `max_body` gets a 413 without being read, too many headers a 431, and a truncated body just
+    closes the connection.
+    """
+
+    async def exchange(port, request):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        writer.write_eof()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def run():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        server = AsyncUPNPHTTPServer(('127.0.0.1', 0), 'limits', max_body=1024)
+        await server.start()
+        port = server.address[1]
+        try:
+            response = await exchange(port, b'POST /bi-cgi HTTP/1.1\r\nContent-Length: 100000000\r\n\r\nx')
+            assert response.startswith(b'HTTP/1.1 413 ')
+            assert await exchange(port, b'POST /bi-cgi HTTP/1.1\r\nContent-Length: 100\r\n\r\nshort') == b''
+            headers = b''.join(b'X-Header-%d: %d\r\n' % (n, n) for n in range(200))
+            response = await exchange(port, b'GET /description.xml HTTP/1.1\r\n' + headers + b'\r\n')
+            assert response.startswith(b'HTTP/1.1 431 ') and b'Connection: close' in response
+            response = await exchange(port, b'GET /description.xml HTTP/1.1\r\nConnection: close\r\n\r\n')
+            assert response.startswith(b'HTTP/1.1 200 ') and response.endswith(b'limits')
+            await asyncio.sleep(0.01)
+            assert not errors and server.connections == 0, errors
+        finally:
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_description_caching():
+    """The description: gzipped if accepted (with its own ETag), 304 for what the client has, Vary always."""
+    import gzip
+    from email.utils import formatdate
+
+    async def get(port, *headers):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(('GET /description.xml HTTP/1.1\r\nConnection: close\r\n%s\r\n' %
+                      ''.join(header + '\r\n' for header in headers)).encode())
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        return int(lines[0].split()[1]), dict(line.split(': ', 1) for line in lines[1:]), body
+
+    async def run():
+        document = DescriptionDocument('<root>description</root>', last_modified=1000000000)
+        server = AsyncUPNPHTTPServer(('127.0.0.1', 0), document)
+        await server.start()
+        port = server.address[1]
+        try:
+            status, headers, body = await get(port)
+            assert status == 200 and body == document.body and headers['ETag'] == document.etag
+            assert 'Content-Encoding' not in headers and headers['Vary'] == 'Accept-Encoding'
+            assert headers['Last-Modified'] == document.last_modified
+
+            status, headers, body = await get(port, 'Accept-Encoding: deflate, gzip')
+            assert status == 200 and headers['Content-Encoding'] == 'gzip' and gzip.decompress(body) == document.body
+            assert headers['ETag'] == document.gzipped_etag != document.etag and headers['Vary'] == 'Accept-Encoding'
+            status, headers, _ = await get(port, 'Accept-Encoding: gzip;q=0')
+            assert status == 200 and 'Content-Encoding' not in headers
+
+            for conditional in ('If-None-Match: %s' % document.etag, 'If-None-Match: W/%s' % document.gzipped_etag,
+                                'If-None-Match: "other", *',
+                                'If-Modified-Since: %s' % formatdate(1000000000, usegmt=True)):
+                status, headers, body = await get(port, conditional)
+                assert status == 304 and body == b'' and headers['Vary'] == 'Accept-Encoding', conditional
+                assert headers['ETag'] == document.etag
+            for conditional in ('If-None-Match: "other"', 'If-Modified-Since: %s' % formatdate(999999999, usegmt=True),
+                                'If-Modified-Since: yesterday'):
+                status, _, body = await get(port, conditional)
+                assert status == 200 and body == document.body, conditional
+            # If-None-Match wins over If-Modified-Since
+            status, _, _ = await get(port, 'If-None-Match: "other"',
+                                     'If-Modified-Since: %s' % formatdate(1000000000, usegmt=True))
+            assert status == 200
+        finally:
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_jcu_metrics():
+    """Commands we don't know of are counted as `other`: a client can't add metric series."""
+
+    async def run():
+        server = AsyncUPNPHTTPServer(('127.0.0.1', 0), 'jcu')
+        await server.start()
+        try:
+            for query in ('a=1', 'x.y=2', 'keepalive.jcuudn=uuid:JCU-1'):
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.address[1])
+                writer.write(b'GET /bi-cgi?%s HTTP/1.1\r\nConnection: close\r\n\r\n' % query.encode())
+                assert (await reader.read()).startswith(b'HTTP/1.1 200 ')
+                writer.close()
+        finally:
+            server.close()
+
+    asyncio.run(run())
+    labels = {labels[0] for labels in JCU_COMMANDS.values}
+    assert 'other' in labels and 'keepalive' in labels and not {'a', 'x'} & labels
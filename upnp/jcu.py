@@ -0,0 +1,522 @@
+import functools
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque, namedtuple
+
+from .scheduler import DeadlineHeap
+
+logger = logging.getLogger()
+
+# what a m87 replies to `jcu_config` (times in ms)
+DEFAULT_JCU_CONFIG = {
+    "timescale": -3, "magnitudescale": 0, "keepalive": 2000, "commandrepeat": 500,
+    "cameraudn": "M-Series", "powerondelay": 1000, "shutdowndelay": 2000,
+    "backlightdelay": 1000, "deadbandatrest_idx": 25, "deadbandatrest_idy": 25,
+    "deadbandatrest_idz": 25, "deadbandatrest_idt": 25, "deadbandtranslation_idx": 0,
+    "deadbandtranslation_idy": 0, "deadbandtranslation_idz": 0,
+    "deadbandtranslation_idt": 0
+}
+
+MAX_QUEUE = 1024
+KEEPALIVE_MISSED = 3  # a JCU is gone after this many keepalive periods without one
+KEEPALIVE_TIMEOUT = KEEPALIVE_MISSED * DEFAULT_JCU_CONFIG['keepalive'] / 1000.
+
+ANY = '*'  # register for every command
+TIMEOUT = 'timeout'  # delivered when a jcuudn stops sending keepalives
+
+
+# one parsed JCU command: `target` is the dotted path after the command, `values` the (key, value) pairs
+JCUCommand = namedtuple('JCUCommand', 'command target values jcuudn')
+
+JCU_CACHE_SIZE = 1024
+
+# the commands of the JCUs we know of; the others are counted as `other` (a label per name sent would let any
+# client add metric series)
+JCU_COMMAND_NAMES = frozenset(('jcu_config', 'connect', 'keepalive', 'button', 'axis'))
+
+
+def command_label(command):
+    """The metric label of a command name."""
+    return command if command in JCU_COMMAND_NAMES else 'other'
+
+
+def _jcu_value(value):
+    # numbers come as integers, but let's not assume it
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    # nan, inf, 1e999... stay strings: json would write them as NaN / Infinity, which is not JSON
+    return number if math.isfinite(number) else value
+
+
+def parse_jcu_commands(query):
+    """
+    Split a JCU query in its commands, in a single pass over the comma separated terms.
+
+    The main command is a 'structure' in dot notation, but there can be more than one "nested" value:
+
+        axis.t.displacement=-57,duration=0  =>  axis: t: displacement=-57, duration=0
+
+    for some commands (`button`) the normal pattern:
+
+        a.b.c=3,d=4 => a: b: c
+
+    is instead:
+
+        a.b,c=3,d=4
+
+    and the same query can carry more commands of the same kind, each starting with a term without value:
+
+        button.F,state=DOWN,duration=2000,jcuudn=...,F,state=UP,duration=2010,jcuudn=...
+
+    :param query: what follows `/bi-cgi?`
+    :return: a tuple of JCUCommand
+    """
+    commands = []
+    command = target = jcuudn = None
+    values = []
+    echo_jcuudn = True  # the jcuudn of `button` commands is not replied
+    for term in query.split(','):
+        if not term:
+            continue
+        key, eq, value = term.partition('=')
+        if not eq:
+            # a command without value: the first one, or the next one of a chain
+            if command is not None:
+                commands.append(JCUCommand(command, target, tuple(values), jcuudn))
+                values = []
+                jcuudn = None
+            if command is None or '.' in key:
+                path = key.split('.')
+                command, target = path[0], tuple(path[1:])
+            else:
+                target = (key,)
+            echo_jcuudn = False
+            continue
+        if command is None:
+            # the last part of the path is the first value
+            path = key.split('.')
+            command, target, key = path[0], tuple(path[1:-1]), path[-1]
+        if key == 'jcuudn':
+            jcuudn = value
+            if echo_jcuudn:
+                values.append((key, value))
+            continue
+        values.append((key, _jcu_value(value)))
+    if command is not None:
+        commands.append(JCUCommand(command, target, tuple(values), jcuudn))
+    return tuple(commands)
+
+
+def jcu_response(command):
+    """What the camera replies to a command: {command: {target...: {values}}}"""
+    response = dict(command.values)
+    for name in reversed(command.target):
+        response = {name: response}
+    return {command.command: response}
+
+
+def _merge(reply, response):
+    for key, value in response.items():
+        if isinstance(value, dict) and isinstance(reply.get(key), dict):
+            _merge(reply[key], value)
+        else:
+            reply[key] = value
+
+
+def _jcu_echo(commands):
+    # a query gets one object, as it always did: chained commands are merged into it in order, so a target
+    # named twice (button.F,state=DOWN,...,F,state=UP,...) keeps its last values
+    reply = {}
+    for command in commands:
+        _merge(reply, jcu_response(command))
+    return reply
+
+
+def parse_jcu_command(path):
+    """
+    :param path: what follows `/bi-cgi?`
+    :return: the reply to a JCU query, one object for chained commands too
+    """
+    return _jcu_echo(parse_jcu_commands(path))
+
+
+@functools.lru_cache(maxsize=JCU_CACHE_SIZE)
+def compile_jcu_query(query):
+    """
+    Parse a JCU query and serialize its reply, once: the joysticks repeat the same few queries
+    (keepalives, axis at rest...) every `commandrepeat` ms.
+
+    :return: (tuple of JCUCommand, reply as bytes)
+    """
+    commands = parse_jcu_commands(query)
+    return commands, json.dumps(_jcu_echo(commands), separators=(',', ':')).encode()
+
+
+def test_parse_jcu_command():
+
+    jcuudn = "uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6"
+    for (request, response) in [
+
+        # "jcu_config", {"config":{"timescale":-3,"magnitudescale":0,"keepalive":2000,"commandrepeat":500,"cameraudn":M-Series,"powerondelay":1000,"shutdowndelay":2000,"backlightdelay":1000,"deadbandatrest_idx":25,"deadbandatrest_idy":25,"deadbandatrest_idz":25, "deadbandatrest_idt":25,"deadbandtranslation_idx":0,"deadbandtranslation_idy":0,"deadbandtranslation_idz":0,"deadbandtranslation_idt":0}}),
+        ("connect.jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
+         {"connect": {"jcuudn": "uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6"}}),
+        ("keepalive.jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
+         {"keepalive": {"jcuudn": "uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6"}}),
+        ("axis.t.displacement=-32,duration=0",
+         {"axis": {"t": {"displacement": -32, "duration": 0}}}),
+        ("button.F,state=DOWN,duration=0,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
+         {"button": {"F": {"state": "DOWN", "duration": 0}}}),
+        ("button.F,state=UP,duration=210,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
+         {"button": {"F": {"state": "UP", "duration": 210}}}),
+        # the way things are combined is just... crazy....
+        ("button.F,state=DOWN,duration=2000,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6,F,state=UP,duration=2010,jcuudn=uuid:JCU-1_0-1A22-EF16-11DD-84A7-00405F40A3D6",
+         {"button": {"F": {"state": "UP", "duration": 2010}}}),
+        ("button.F,state=DOWN,duration=0,G,state=UP,duration=10",
+         {"button": {"F": {"state": "DOWN", "duration": 0}, "G": {"state": "UP", "duration": 10}}}),
+    ]:
+        r = parse_jcu_command(request)
+        assert r == response, "parsing error: {} != {}".format(r, response)
+        assert json.loads(compile_jcu_query(request)[1]) == response
+
+    down, up = parse_jcu_commands("button.F,state=DOWN,duration=2000,jcuudn={0},F,state=UP,duration=2010,jcuudn={0}".format(jcuudn))
+    assert down == JCUCommand('button', ('F',), (('state', 'DOWN'), ('duration', 2000)), jcuudn)
+    assert up.values == (('state', 'UP'), ('duration', 2010))
+    assert parse_jcu_commands("axis.x.displacement=0.5,duration=0")[0].values == (('displacement', 0.5), ('duration', 0))
+    assert parse_jcu_commands("") == ()
+    # not numbers JSON can carry
+    assert parse_jcu_commands("axis.x.displacement=nan,duration=inf,speed=1e999")[0].values == \
+        (('displacement', 'nan'), ('duration', 'inf'), ('speed', '1e999'))
+    assert compile_jcu_query("axis.x.displacement=nan,duration=-inf")[1] == \
+        b'{"axis":{"x":{"displacement":"nan","duration":"-inf"}}}'
+
+
+class JCUDispatcher:
+    """
+    Delivers the parsed JCU commands to the handlers registered for them, outside of the HTTP handler.
+
+    Commands are queued (at most `max_queue`, the others are dropped) and a pool of worker threads calls
+    the handlers. The commands of a source always go to the same worker, so they are handled in order.
+    While an `axis` update is waiting, a newer one for the same axis from the same source replaces it:
+    a slow handler only gets the latest displacement.
+    `connect` and `keepalive` (re)start the timeout of their jcuudn; when it runs out the handlers get
+    a `timeout` command with that jcuudn.
+    """
+
+    def __init__(self, workers=2, max_queue=MAX_QUEUE, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.handlers = {}  # command -> [handler(command, source)]
+        self.max_queue = max_queue
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalives = DeadlineHeap()  # jcuudn -> time.monotonic() of the timeout
+        self._sources = {}  # jcuudn -> source of its last keepalive
+        self._queues = [deque() for _ in range(workers)]  # (queued at, axis key, command, source)
+        self._axis = {}  # (source, axis) -> latest command, while queued
+        self._lock = threading.Lock()
+        self._conditions = [threading.Condition(self._lock) for _ in range(workers)]
+        self._threads = []
+        self._running = False
+        self.stats = {
+            'queued': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'handled': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'depth': 0,
+            'wait_max': 0.0,  # seconds in the queue
+            'latency_total': 0.0,  # seconds in the handlers
+            'latency_max': 0.0,
+        }
+
+    def __len__(self):
+        return self.stats['depth']
+
+    def register(self, command, handler):
+        """Call `handler(command, source)` for every `command` (`ANY` for all of them)."""
+        self.handlers.setdefault(command, []).append(handler)
+
+    def unregister(self, command, handler):
+        self.handlers.get(command, []).remove(handler)
+
+    def dispatch(self, command, source=None):
+        """
+        Queue a JCUCommand.
+        :param source: where the command comes from (the JCU address)
+        :return: False if the queue is full and the command was dropped
+        """
+        now = time.monotonic()
+        stats = self.stats
+        with self._lock:
+            if command.jcuudn and command.command in ('connect', 'keepalive'):
+                self.keepalives.set(command.jcuudn, now + self.keepalive_timeout)
+                self._sources[command.jcuudn] = source
+                # the first worker keeps an eye on the timeouts
+                self._conditions[0].notify()
+
+            key = None
+            if command.command == 'axis':
+                key = (source, command.target)
+                if key in self._axis:
+                    self._axis[key] = command
+                    stats['coalesced'] += 1
+                    return True
+
+            if stats['depth'] >= self.max_queue:
+                stats['dropped'] += 1
+                return False
+            index = hash(source) % len(self._queues)
+            if key is None:
+                self._queues[index].append((now, None, command, source))
+            else:
+                self._axis[key] = command
+                self._queues[index].append((now, key, None, source))
+            stats['queued'] += 1
+            stats['depth'] += 1
+            self._conditions[index].notify()
+        return True
+
+    def start(self):
+        self._running = True
+        for index in range(len(self._queues)):
+            thread = threading.Thread(target=self._work, args=(index,), name='jcu-%d' % index, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=1.0):
+        """Stop the workers. What is still queued is not delivered."""
+        with self._lock:
+            self._running = False
+            for condition in self._conditions:
+                condition.notify()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _work(self, index):
+        queue = self._queues[index]
+        condition = self._conditions[index]
+        stats = self.stats
+        while True:
+            command = None
+            timeouts = ()
+            with self._lock:
+                if not self._running:
+                    return
+                if index == 0:
+                    timeouts = [(jcuudn, self._sources.pop(jcuudn, None))
+                                for jcuudn, _ in self.keepalives.pop_expired(time.monotonic())]
+                if queue:
+                    queued, key, command, source = queue.popleft()
+                    if key is not None:
+                        command = self._axis.pop(key)
+                    stats['depth'] -= 1
+                elif not timeouts:
+                    wait = None
+                    if index == 0:
+                        deadline = self.keepalives.next_deadline()
+                        if deadline is not None:
+                            wait = max(0.0, deadline - time.monotonic())
+                    condition.wait(wait)
+                    continue
+
+            for jcuudn, jcu_source in timeouts:
+                logger.info("JCU %s timed out", jcuudn)
+                stats['timeouts'] += 1
+                self._deliver(JCUCommand(TIMEOUT, (), (), jcuudn), jcu_source)
+            if command is not None:
+                wait = time.monotonic() - queued
+                if wait > stats['wait_max']:
+                    stats['wait_max'] = wait
+                self._deliver(command, source)
+
+    def _deliver(self, command, source):
+        handlers = self.handlers.get(command.command, []) + self.handlers.get(ANY, [])
+        start = time.monotonic()
+        for handler in handlers:
+            try:
+                handler(command, source)
+            except Exception as e:
+                logger.error("JCU handler %r failed on %s: %r", handler, command, e)
+                with self._lock:
+                    self.stats['errors'] += 1
+        latency = time.monotonic() - start
+        with self._lock:
+            stats = self.stats
+            stats['handled'] += 1
+            stats['latency_total'] += latency
+            if latency > stats['latency_max']:
+                stats['latency_max'] = latency
+
+
+def test_jcu_dispatcher():
+    gate = threading.Event()
+    received = []
+
+    def slow(command, source):
+        gate.wait(1)
+        received.append((command.command, command.target, dict(command.values).get('displacement')))
+
+    dispatcher = JCUDispatcher(workers=1, max_queue=2, keepalive_timeout=0.05)
+    dispatcher.register(ANY, slow)
+    dispatcher.start()
+    try:
+        dispatcher.dispatch(parse_jcu_commands('connect.jcuudn=uuid:JCU-1')[0], '10.0.0.9')
+        # wait for the worker to be stuck on it
+        while dispatcher.stats['depth']:
+            time.sleep(0.001)
+        for displacement in range(10):
+            command, = parse_jcu_commands('axis.t.displacement=%d,duration=0' % displacement)
+            dispatcher.dispatch(command, '10.0.0.9')
+        dispatcher.dispatch(parse_jcu_commands('axis.x.displacement=1,duration=0')[0], '10.0.0.9')
+        # one axis.t and the axis.x are queued, the other axis.t updates are coalesced
+        assert not dispatcher.dispatch(parse_jcu_commands('axis.y.displacement=1,duration=0')[0], '10.0.0.9')
+        gate.set()
+        deadline = time.monotonic() + 2
+        while dispatcher.stats['timeouts'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        dispatcher.stop()
+
+    assert received[0] == ('connect', (), None)
+    axis = [r for r in received if r[0] == 'axis']
+    assert ('timeout', (), None) in received
+    assert dispatcher.stats['dropped'] == 1
+    assert axis == [('axis', ('t',), 9), ('axis', ('x',), 1)]
+    assert dispatcher.stats['coalesced'] == 9
+
+
+class JCUSession:
+    """A connected JCU."""
+    __slots__ = ('jcuudn', 'source', 'connected', 'last_keepalive', 'last_seen', 'commands', 'config')
+
+    def __init__(self, jcuudn, source, now):
+        self.jcuudn = jcuudn
+        self.source = source
+        self.connected = self.last_keepalive = self.last_seen = now
+        self.commands = 0
+        self.config = None  # what it got from `jcu_config`
+
+    @property
+    def rate(self):
+        """Commands per second since it connected."""
+        elapsed = self.last_seen - self.connected
+        return self.commands / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return '<JCUSession %s from %s, %d commands>' % (self.jcuudn, self.source, self.commands)
+
+
+class JCUSessions:
+    """
+    The JCUs connected to a device, by jcuudn.
+
+    `connect` opens a session, `keepalive` keeps it open: it expires after KEEPALIVE_MISSED times the
+    `keepalive` of the config. The other commands are counted to the session of their jcuudn, or of their
+    source when they don't carry it (`axis`). Expiry is checked on every call, so no timer is needed.
+    The config is serialized once, `configure` hands out the bytes.
+    """
+
+    def __init__(self, config=None):
+        """:param config: the device config, DEFAULT_JCU_CONFIG by default"""
+        self.config = config or dict(DEFAULT_JCU_CONFIG)
+        self.config_response = json.dumps({'config': self.config}, separators=(',', ':')).encode()
+        self.timeout = KEEPALIVE_MISSED * self.config['keepalive'] / 1000.
+        self.sessions = {}  # jcuudn -> JCUSession
+        self._by_source = {}  # source -> jcuudn
+        self.expiry = DeadlineHeap()  # jcuudn -> time.monotonic() of the timeout
+        self.stats = {
+            'connected': 0,
+            'expired': 0,
+        }
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, jcuudn):
+        return jcuudn in self.sessions
+
+    def get(self, jcuudn):
+        return self.sessions.get(jcuudn)
+
+    def active(self, now=None):
+        """The open sessions."""
+        self.expire(now)
+        return list(self.sessions.values())
+
+    def seen(self, command, source, now=None):
+        """
+        Account a JCUCommand received from `source`.
+        :return: its JCUSession, None if it does not belong to one
+        """
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        jcuudn = command.jcuudn or self._by_source.get(source)
+        if jcuudn is None:
+            return None
+        keepalive = command.command in ('connect', 'keepalive')
+        session = self.sessions.get(jcuudn)
+        if session is None:
+            if not keepalive:
+                return None
+            # a keepalive after the expiry opens it again
+            session = self.sessions[jcuudn] = JCUSession(jcuudn, source, now)
+            self.stats['connected'] += 1
+        if session.source != source:
+            self._by_source.pop(session.source, None)
+            session.source = source
+        self._by_source[source] = jcuudn
+        session.commands += 1
+        session.last_seen = now
+        if keepalive:
+            session.last_keepalive = now
+            self.expiry.set(jcuudn, now + self.timeout)
+        return session
+
+    def configure(self, source):
+        """A `jcu_config` from `source`: :return: the serialized config"""
+        session = self.sessions.get(self._by_source.get(source))
+        if session is not None:
+            session.config = self.config
+        return self.config_response
+
+    def expire(self, now=None):
+        """:return: the sessions that were closed"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        for jcuudn, _ in self.expiry.pop_expired(now):
+            session = self.sessions.pop(jcuudn, None)
+            if session is None:
+                continue
+            if self._by_source.get(session.source) == jcuudn:
+                del self._by_source[session.source]
+            logger.info("JCU %s expired", jcuudn)
+            expired.append(session)
+        self.stats['expired'] += len(expired)
+        return expired
+
+
+def test_jcu_sessions():
+    sessions = JCUSessions(dict(DEFAULT_JCU_CONFIG, keepalive=1000))
+    assert sessions.timeout == 3
+    assert json.loads(sessions.config_response)['config']['keepalive'] == 1000
+
+    connect, = parse_jcu_commands('connect.jcuudn=uuid:JCU-1')
+    keepalive, = parse_jcu_commands('keepalive.jcuudn=uuid:JCU-1')
+    axis, = parse_jcu_commands('axis.t.displacement=-32,duration=0')
+
+    assert sessions.seen(axis, '10.0.0.9', now=0) is None
+    session = sessions.seen(connect, '10.0.0.9', now=0)
+    assert sessions.configure('10.0.0.9') is sessions.config_response and session.config is sessions.config
+    assert sessions.seen(axis, '10.0.0.9', now=1) is session
+    assert sessions.seen(keepalive, '10.0.0.9', now=2.5) is session
+    assert sessions.active(now=5) == [session] and session.commands == 3 and session.rate == 3 / 2.5
+    assert sessions.expire(now=5.5) == [session]
+    assert not sessions and sessions.seen(axis, '10.0.0.9', now=6) is None
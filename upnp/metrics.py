@@ -0,0 +1,164 @@
+"""
+Counters, gauges and latency histograms, rendered in the Prometheus text format (served on /metrics).
+
+Updating a metric is a dict lookup and an addition, cheap enough for the datagram and request paths.
+There is no lock: with threaded HTTP servers a concurrent increment may (rarely) be lost.
+"""
+import bisect
+
+# seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for name, value in zip(names, values))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> count
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Gauge:
+    """A value read when rendering: `function()` returns it, or {label values: value} with labels."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not self.labels:
+            yield self.name, '', value
+            return
+        for labels, v in value.items():
+            yield self.name, _labels(self.labels, labels), v
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [counts per bucket (+Inf last), sum]
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, *labels):
+        entry = self.values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket', _labels(names, labels + (bound,)), cumulative
+            yield self.name + '_sum', _labels(self.labels, labels), total
+            yield self.name + '_count', _labels(self.labels, labels), cumulative
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}  # name -> metric
+
+    def _add(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            # modules may ask twice (reloads, tests): same name, same metric
+            if existing.kind != metric.kind:
+                raise ValueError('%s is already a %s' % (metric.name, existing.kind))
+            if metric.kind == 'gauge':
+                existing.function = metric.function
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, function, labels=()):
+        return self._add(Gauge(name, help, function, labels))
+
+    def render(self):
+        """The Prometheus text exposition format (0.0.4)."""
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample, labels, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# what /metrics serves
+REGISTRY = MetricsRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def test_render():
+    registry = MetricsRegistry()
+    counter = registry.counter('jcu_commands_total', 'JCU commands', ('command',))
+    counter.inc('axis')
+    counter.inc('axis', amount=2)
+    assert registry.counter('jcu_commands_total', 'JCU commands', ('command',)) is counter
+    latency = registry.histogram('http_request_seconds', 'latency', ('route',), buckets=(0.1, 1))
+    latency.observe(0.05, 'description')
+    latency.observe(0.5, 'description')
+    latency.observe(5, 'description')
+    registry.gauge('depth', 'queued', lambda: 4)
+
+    assert registry.render().splitlines() == [
+        '# HELP depth queued',
+        '# TYPE depth gauge',
+        'depth 4',
+        '# HELP http_request_seconds latency',
+        '# TYPE http_request_seconds histogram',
+        'http_request_seconds_bucket{route="description",le="0.1"} 1',
+        'http_request_seconds_bucket{route="description",le="1"} 2',
+        'http_request_seconds_bucket{route="description",le="+Inf"} 3',
+        'http_request_seconds_sum{route="description"} 5.55',
+        'http_request_seconds_count{route="description"} 3',
+        '# HELP jcu_commands_total JCU commands',
+        '# TYPE jcu_commands_total counter',
+        'jcu_commands_total{command="axis"} 3',
+    ]
@@ -0,0 +1,368 @@
+"""
+Prefork: `python -m upnp --workers N` serves from N worker processes, to use more than one core.
+
+- HTTP: every worker listens on the port with SO_REUSEPORT, the kernel spreads the connections (so the JCU
+  sessions are per worker).
+- SSDP: every worker joins the multicast groups and gets every datagram. Each answers the searches and
+  announces the registrations it owns (`SSDPServer.set_worker`); only the first one tracks the remote devices.
+- the registry: the supervisor holds the descriptions and the local registrations (and watches them, with
+  `--watch`) and publishes them in a SharedRegistry, a shared memory block the workers check every
+  `interval` seconds: nothing is exchanged per packet.
+- the registry snapshot (upnp.snapshot), of the remote devices: loaded and saved by the first worker.
+
+The supervisor restarts the workers that die, and stops them all on SIGTERM or Ctrl-C.
+"""
+import asyncio
+import logging
+import mmap
+import os
+import pickle
+import signal
+import struct
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger()
+
+SHARED_SIZE = 64 << 20  # bytes; anonymous memory, only the pages written are used
+SYNC_INTERVAL = 1.0  # seconds between two checks of the registry
+STOP_TIMEOUT = 5  # seconds the workers get to say byebye
+
+
+def registration(entry):
+    """The arguments of `SSDPServer.register` for a local registration."""
+    return {
+        'st': entry['ST'],
+        'location': entry['LOCATION'],
+        'server': entry['SERVER'],
+        'cache_control': entry['CACHE-CONTROL'],
+        'silent': entry['SILENT'],
+        'host': entry['HOST'],
+    }
+
+
+def snapshot(http_server, ssdp):
+    return {
+        'descriptions': dict(http_server.descriptions),
+        'registrations': {usn: registration(entry) for usn, entry in ssdp.known.items()
+                          if entry['MANIFESTATION'] == 'local'},
+    }
+
+
+class SharedRegistry:
+    """
+    A snapshot of the registry in shared memory: an anonymous mmap, created before the workers are forked.
+
+    One writer (the supervisor), many readers. The header holds a generation, odd while a snapshot is
+    being written, and the length of the snapshot; a reader that sees the generation change under it tries
+    again at the next check. Checking is reading 16 bytes.
+    """
+    HEADER = struct.Struct('QQ')  # generation, length
+
+    def __init__(self, size=SHARED_SIZE):
+        self.size = size
+        self.mmap = mmap.mmap(-1, size)
+        self.generation = 0  # published (writer), or applied (reader)
+        self._key = None
+
+    def publish(self, snapshot):
+        """Write `snapshot` (see `snapshot`), unless it is the same as the last one. :return: whether it was"""
+        key = (pickle.dumps(snapshot['registrations']),
+               sorted((path, document.etag) for path, document in snapshot['descriptions'].items()))
+        if key == self._key:
+            return False
+        data = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.size - self.HEADER.size:
+            logger.error("the registry (%d bytes) does not fit in the shared memory (%d), not published",
+                         len(data), self.size)
+            return False
+        generation = self.generation + 1
+        self.HEADER.pack_into(self.mmap, 0, generation, 0)
+        self.mmap[self.HEADER.size:self.HEADER.size + len(data)] = data
+        self.generation = generation + 1
+        self.HEADER.pack_into(self.mmap, 0, self.generation, len(data))
+        self._key = key
+        return True
+
+    def read(self):
+        """:return: the snapshot, if there is a new one (and it is not being written)"""
+        generation, length = self.HEADER.unpack_from(self.mmap, 0)
+        if generation == self.generation or generation % 2:
+            return None
+        data = self.mmap[self.HEADER.size:self.HEADER.size + length]
+        if self.HEADER.unpack_from(self.mmap, 0)[0] != generation:
+            return None
+        self.generation = generation
+        return pickle.loads(data)
+
+
+class RegistryFollower:
+    """Applies the snapshots of a SharedRegistry to the servers of a worker."""
+
+    def __init__(self, shared, http_server, ssdp, interval=SYNC_INTERVAL):
+        self.shared = shared
+        self.http_server = http_server
+        self.ssdp = ssdp
+        self.interval = interval
+        self.loop = None
+        self._timer = None
+        self.stats = {'applied': 0}
+
+    def start(self, loop):
+        self.loop = loop
+        self._timer = loop.call_later(self.interval, self._poll)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _poll(self):
+        snapshot = self.shared.read()
+        if snapshot is not None:
+            try:
+                self.apply(snapshot)
+            except Exception as e:
+                logger.error("could not apply the registry: %r", e)
+        self._timer = self.loop.call_later(self.interval, self._poll)
+
+    def apply(self, snapshot):
+        """
+        Serve the descriptions and the registrations of `snapshot`: byebye for the registrations that are gone,
+        registered (and announced) again when they changed, or when their description did.
+        """
+        ssdp = self.ssdp
+        descriptions = snapshot['descriptions']
+        registrations = snapshot['registrations']
+        old_etags = {path: document.etag for path, document in self.http_server.descriptions.items()}
+        self.http_server.descriptions = descriptions
+
+        local = {usn: entry for usn, entry in ssdp.known.items() if entry['MANIFESTATION'] == 'local'}
+        for usn in set(local) - set(registrations):
+            if not local[usn]['SILENT'] and ssdp.owns(usn):
+                ssdp.do_byebye(usn)
+            ssdp.unregister(usn)
+        for usn, arguments in registrations.items():
+            entry = local.get(usn)
+            if entry is None or registration(entry) != arguments:
+                ssdp.register('local', usn, **arguments)
+                continue
+            path = urlsplit(arguments['location']).path
+            document = descriptions.get(path)
+            if document is not None and old_etags.get(path) != document.etag:
+                ssdp.announce_device(usn.split('::')[0])
+        self.stats['applied'] += 1
+
+
+class Supervisor:
+    """Forks `workers` processes running `target(index)`, and keeps them running."""
+
+    def __init__(self, workers, target):
+        self.workers = workers
+        self.target = target
+        self.pids = {}  # pid -> worker index
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.workers):
+            self._fork(index)
+
+    def _fork(self, index):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
+            logger.info("worker %d started (pid %d)", index, pid)
+            return
+        code = 0
+        try:
+            # nothing of the supervisor's loop in the worker
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            asyncio._set_running_loop(None)
+            self.target(index)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            logger.exception("worker %d failed", index)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        """Restart the workers that died (those that exited cleanly were stopped)."""
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            index = self.pids.pop(pid, None)
+            if index is None or self.stopping or status == 0:
+                continue
+            logger.warning("worker %d (pid %d) exited with %d, restarting it", index, pid,
+                           os.waitstatus_to_exitcode(status))
+            self._fork(index)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        while self.pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self.pids.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.pids:
+            logger.warning("worker pid %d does not stop, killing it", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.pids.clear()
+
+
+def serve_worker(index, workers, http_server, ssdp, shared, interval=SYNC_INTERVAL, registry_snapshot=None):
+    """The worker `index`: serves until SIGTERM."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ssdp.set_worker(index, workers)
+    http_server.reuse_port = True
+    follower = RegistryFollower(shared, http_server, ssdp, interval)
+    loop.run_until_complete(http_server.start())
+    follower.start(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    if registry_snapshot is not None and index == 0:
+        # the one keeping track of the remote devices
+        registry_snapshot.load()
+        registry_snapshot.start(loop)
+        ssdp.run(loop)
+        registry_snapshot.stop()
+        registry_snapshot.save()
+        return
+    ssdp.run(loop)
+
+
+def prefork(workers, http_server, ssdp, watcher=None, interval=SYNC_INTERVAL, registry_snapshot=None):
+    """
+    Serve `http_server` and `ssdp`, not started yet and with their registrations, from `workers` processes.
+    Runs until interrupted.
+
+    :param watcher: a DescriptionWatcher on `http_server` and `ssdp`, run by the supervisor
+    :param registry_snapshot: a RegistrySnapshot of `ssdp`, run by the first worker
+    """
+    shared = SharedRegistry()
+    shared.publish(snapshot(http_server, ssdp))
+    supervisor = Supervisor(workers, lambda index: serve_worker(index, workers, http_server, ssdp, shared, interval,
+                                                                registry_snapshot))
+    supervisor.start()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def publish():
+        shared.publish(snapshot(http_server, ssdp))
+        loop.call_later(interval, publish)
+
+    def stop():
+        supervisor.stopping = True
+        loop.stop()
+
+    loop.add_signal_handler(signal.SIGCHLD, supervisor.reap)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    if watcher is not None:
+        watcher.start(loop)
+    loop.call_later(interval, publish)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        supervisor.stop()
+        loop.close()
+
+
+def test_shared_registry():
+    """A registration made by the supervisor reaches a forked worker, with byebye for the one removed."""
+    from .http_server import AsyncUPNPHTTPServer
+    from .ssdp import SSDPServer
+
+    ssdp = SSDPServer('127.0.0.1')
+    http_server = AsyncUPNPHTTPServer(('127.0.0.1', 0), 'first')
+    ssdp.register_device('uuid:first', 'http://127.0.0.1:8088/description.xml')
+    shared = SharedRegistry(1 << 20)
+    assert shared.publish(snapshot(http_server, ssdp)) and not shared.publish(snapshot(http_server, ssdp))
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # the worker: one check of the registry
+        code = 1
+        try:
+            sent = []
+            ssdp.transport = type('Recorder', (), {'sendto': lambda self, data, addr=None: sent.append(data)})()
+            follower = RegistryFollower(shared, http_server, ssdp)
+            os.read(read, 1)
+            follower.apply(shared.read())
+            assert ssdp.is_known('uuid:second') and not ssdp.is_known('uuid:first')
+            assert any(b'ssdp:byebye' in data and b'uuid:first' in data for data in sent)
+            assert http_server.descriptions['/description.xml'].text == 'second'
+            code = 0
+        finally:
+            os._exit(code)
+    ssdp.unregister_device('uuid:first', byebye=False)
+    ssdp.register_device('uuid:second', 'http://127.0.0.1:8088/description.xml')
+    http_server.description = 'second'
+    assert shared.publish(snapshot(http_server, ssdp))
+    os.write(write, b'x')
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+
+
+def test_owns():
+    from .ssdp import SSDPServer
+
+    servers = [SSDPServer('127.0.0.1') for _ in range(3)]
+    for index, server in enumerate(servers):
+        server.set_worker(index, 3)
+    keys = ['uuid:device-%d::upnp:rootdevice' % n for n in range(100)]
+    # each key has exactly one owner
+    assert all(sum(server.owns(key) for server in servers) == 1 for key in keys)
+    assert all(sum(server.owns(key) for key in keys) > 10 for server in servers)
+
+
+def test_prefork():
+    """`prefork` with 2 workers, until SIGTERM: the first worker saves the registry snapshot on the way out."""
+    import tempfile
+    from .http_server import AsyncUPNPHTTPServer
+    from .snapshot import RegistrySnapshot
+    from .ssdp import SSDPServer
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'registry.snapshot')
+        pid = os.fork()
+        if not pid:
+            code = 1
+            try:
+                logging.disable(logging.CRITICAL)
+                ssdp = SSDPServer('127.0.0.1')
+                ssdp.register_device('uuid:prefork', 'http://127.0.0.1:8088/description.xml', silent=True)
+                http_server = AsyncUPNPHTTPServer(('127.0.0.1', 0), 'prefork')
+                prefork(2, http_server, ssdp, interval=0.1, registry_snapshot=RegistrySnapshot(ssdp, path))
+                code = 0
+            finally:
+                os._exit(code)
+        time.sleep(1.5)
+        assert os.waitpid(pid, os.WNOHANG) == (0, 0), 'prefork exited early'
+        os.kill(pid, signal.SIGTERM)
+        assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+        assert os.path.exists(path)
@@ -0,0 +1,134 @@
+"""
+Amplification protection for the M-SEARCH replies: a `ssdp:all` gets one datagram per registration, so a
+spoofed source could have us send many times its own traffic to a victim.
+"""
+from collections import OrderedDict
+
+SEARCH_RATE = 1.0  # searches per second for a (source, ST)
+SEARCH_BURST = 4  # control points repeat their searches, UDP being UDP
+REPLY_RATE = 1000  # reply datagrams per second, for all the sources together
+REPLY_BURST = 2000
+MAX_SOURCES = 4096  # (source, ST) buckets kept, the least recently used are forgotten
+
+
+class SearchLimiter:
+    """
+    Token buckets for the searches: one per (source address, ST), in searches, and a global one in reply
+    datagrams.
+
+    The table of buckets is bounded by `max_sources`: under a flood of spoofed sources the oldest buckets
+    are evicted (a forgotten source starts with a full bucket again, the global budget still holds), so
+    memory and the cost per search stay constant.
+    """
+
+    def __init__(self, rate=SEARCH_RATE, burst=SEARCH_BURST, reply_rate=REPLY_RATE, reply_burst=REPLY_BURST,
+                 max_sources=MAX_SOURCES):
+        self.rate = rate
+        self.burst = burst
+        self.reply_rate = reply_rate
+        self.reply_burst = reply_burst
+        self.max_sources = max_sources
+        self.sources = OrderedDict()  # (source, ST) -> [tokens, last update]
+        self._replies = reply_burst
+        self._last = None
+        self.stats = {
+            'limited': 0,  # searches over the rate of their source
+            'over_budget': 0,  # searches whose replies did not fit the global budget
+            'suppressed': 0,  # reply datagrams not sent, for going over the budget
+            'evicted': 0,
+        }
+
+    def __len__(self):
+        return len(self.sources)
+
+    def admit(self, source, st, now):
+        """Take a token from the bucket of (source, ST). :return: whether the search may be answered"""
+        key = (source, st)
+        bucket = self.sources.get(key)
+        if bucket is None:
+            if len(self.sources) >= self.max_sources:
+                self.sources.popitem(last=False)
+                self.stats['evicted'] += 1
+            bucket = self.sources[key] = [self.burst, now]
+        else:
+            self.sources.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.stats['limited'] += 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def spend(self, replies, now):
+        """Take `replies` datagrams from the global budget. :return: whether they can all be sent"""
+        if self._last is not None:
+            self._replies = min(self.reply_burst, self._replies + (now - self._last) * self.reply_rate)
+        self._last = now
+        if replies > self._replies:
+            self.stats['over_budget'] += 1
+            self.stats['suppressed'] += replies
+            return False
+        self._replies -= replies
+        return True
+
+
+def test_search_limiter():
+    limiter = SearchLimiter(rate=1, burst=2, reply_rate=100, reply_burst=100, max_sources=2)
+    assert limiter.admit('10.0.0.1', 'ssdp:all', 0) and limiter.admit('10.0.0.1', 'ssdp:all', 0)
+    assert not limiter.admit('10.0.0.1', 'ssdp:all', 0.5)
+    assert limiter.admit('10.0.0.1', 'upnp:rootdevice', 0.5)
+    assert limiter.admit('10.0.0.1', 'ssdp:all', 1.5)
+    # a third source evicts the least recently used one
+    assert limiter.admit('10.0.0.2', 'ssdp:all', 1.5)
+    assert len(limiter) == 2 and ('10.0.0.1', 'upnp:rootdevice') not in limiter.sources
+
+    assert limiter.spend(60, 0) and not limiter.spend(60, 0.1) and limiter.spend(60, 0.2)
+    assert limiter.stats == {'limited': 1, 'over_budget': 1, 'suppressed': 60, 'evicted': 1}
+
+
+def test_search_flood():
+    """A flood of ssdp:all from spoofed sources: what we send is bounded by the budget, and so is the CPU."""
+    import asyncio
+    import time
+    from .ssdp import SSDPServer
+
+    class Counter:
+        sent = 0
+
+        def sendto(self, data, addr=None):
+            self.sent += 1
+
+    search = (b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 0\r\n'
+              b'ST: ssdp:all\r\n\r\n')
+
+    async def flood(limiter, count=20000):
+        server = SSDPServer('127.0.0.1')
+        for n in range(20):
+            server.register_device('uuid:flood-%d' % n, 'http://127.0.0.1:8088/%d/description.xml' % n,
+                                   'urn:schemas-upnp-org:device:Flood:1')
+        server.limiter = limiter
+        server.loop = server.responses.loop = asyncio.get_running_loop()
+        server.transport = Counter()
+        start = time.process_time()
+        begin = time.monotonic()
+        for n in range(count):
+            # a few real sources, and many spoofed ones
+            source = '10.0.%d.%d' % (n % 7, 1) if n % 2 else '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+            server.datagram_received(search, (source, 1900 + n % 50))
+            if n % 500 == 0:
+                await asyncio.sleep(0)
+        await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - begin
+        cpu = time.process_time() - start
+        return server.transport.sent, elapsed, cpu
+
+    limiter = SearchLimiter(max_sources=256)
+    sent, elapsed, limited_cpu = asyncio.run(flood(limiter))
+    assert sent <= REPLY_BURST + REPLY_RATE * elapsed, (sent, elapsed)
+    assert len(limiter) == 256 and limiter.stats['evicted'] and limiter.stats['over_budget']
+    unlimited_sent, _, unlimited_cpu = asyncio.run(flood(None, 2000))
+    # without a limit each search gets about 60 replies, with one the flood gets less than one
+    assert sent / 20000 < 1 < 30 < unlimited_sent / 2000, (sent, unlimited_sent)
+    # and a search costs a fraction of what answering it does
+    assert limited_cpu / 20000 < unlimited_cpu / 2000 / 2, (limited_cpu, unlimited_cpu)
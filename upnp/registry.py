@@ -0,0 +1,210 @@
+"""
+The registrations of `SSDPServer.known`, and secondary indexes over them, so that answering a M-SEARCH costs
+in proportion to the number of matches rather than to the number of registrations.
+"""
+import sys
+import time
+from collections.abc import Mapping
+
+
+class Registration(Mapping):
+    """
+    One registration (local, or a remote device we heard of), in slots rather than a 10 key dict: with
+    tens of thousands of remote devices cached, that is most of the memory of the server.
+
+    It still reads like the dict it replaces, `entry['LOCATION']`, `entry.get('HOST')`, `dict(entry)`,
+    with the keys in the same order. The strings repeated across registrations (ST, SERVER, CACHE-CONTROL,
+    LOCATION, HOST) are interned, so that they are stored once.
+    """
+    __slots__ = ('usn', 'location', 'st', 'server', 'cache_control', 'manifestation', 'silent', 'host',
+                 'last_seen')
+
+    # the dict keys, in the order of the dicts (and of the headers of the datagrams), -> slot
+    KEYS = {
+        'USN': 'usn',
+        'LOCATION': 'location',
+        'ST': 'st',
+        'EXT': None,  # always empty
+        'SERVER': 'server',
+        'CACHE-CONTROL': 'cache_control',
+        'MANIFESTATION': 'manifestation',
+        'SILENT': 'silent',
+        'HOST': 'host',
+        'last-seen': 'last_seen',
+    }
+
+    def __init__(self, usn, location, st, server='', cache_control='max-age=1800', manifestation='local',
+                 silent=False, host=None, last_seen=None):
+        self.usn = usn
+        self.location = _intern(location)
+        self.st = _intern(st)
+        self.server = _intern(server)
+        self.cache_control = _intern(cache_control)
+        self.manifestation = _intern(manifestation)
+        self.silent = silent
+        self.host = _intern(host)
+        self.last_seen = time.time() if last_seen is None else last_seen
+
+    def __getitem__(self, key):
+        slot = self.KEYS[key]
+        return getattr(self, slot) if slot else ''
+
+    def __setitem__(self, key, value):
+        slot = self.KEYS[key]
+        if slot:
+            setattr(self, slot, value)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return 'Registration(%r)' % dict(self)
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def usn_uuid(usn):
+    """`uuid:device-UUID::urn:...` -> `uuid:device-UUID`"""
+    return usn.split('::', 1)[0]
+
+
+class RegistryIndex:
+    """
+    Incrementally maintained lookups over registrations (Registrations, or dicts with the same keys).
+
+    Dicts are used as ordered sets (usn -> entry), so results come out in registration order.
+    Only local entries are searchable; remote ones are indexed by manifestation only.
+    """
+
+    def __init__(self):
+        self.by_manifestation = {'local': {}, 'remote': {}}
+        self.by_st = {}  # st -> {usn: entry}, local only
+        self.by_uuid = {}  # uuid:device-UUID -> {usn: entry}, local only
+        self.visible = {}  # local, non silent: what `ssdp:all` answers with
+
+    def add(self, entry):
+        usn = entry['USN']
+        manifestation = entry['MANIFESTATION']
+        self.by_manifestation.setdefault(manifestation, {})[usn] = entry
+        if manifestation != 'local':
+            return
+        self.by_st.setdefault(entry['ST'], {})[usn] = entry
+        self.by_uuid.setdefault(usn_uuid(usn), {})[usn] = entry
+        if not entry['SILENT']:
+            self.visible[usn] = entry
+
+    def remove(self, entry):
+        usn = entry['USN']
+        self.by_manifestation.get(entry['MANIFESTATION'], {}).pop(usn, None)
+        self.visible.pop(usn, None)
+        for index, key in ((self.by_st, entry['ST']), (self.by_uuid, usn_uuid(usn))):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(usn, None)
+                if not bucket:
+                    del index[key]
+
+    def search(self, st):
+        """
+        The local registrations matching a search target.
+
+        A `uuid:` target without a registration for that exact ST matches every registration of that device.
+        :return: an iterable of entries
+        """
+        if st == 'ssdp:all':
+            return self.visible.values()
+        matches = self.by_st.get(st)
+        if matches:
+            return matches.values()
+        if st.startswith('uuid:'):
+            return self.by_uuid.get(st, {}).values()
+        return ()
+
+
+def test_registration():
+    entry = Registration('uuid:a::upnp:rootdevice', 'http://10.0.0.1/d.xml', 'upnp:rootdevice', 'Linux',
+                         manifestation='remote', host='10.0.0.1', last_seen=5)
+    as_dict = {
+        'USN': 'uuid:a::upnp:rootdevice',
+        'LOCATION': 'http://10.0.0.1/d.xml',
+        'ST': 'upnp:rootdevice',
+        'EXT': '',
+        'SERVER': 'Linux',
+        'CACHE-CONTROL': 'max-age=1800',
+        'MANIFESTATION': 'remote',
+        'SILENT': False,
+        'HOST': '10.0.0.1',
+        'last-seen': 5,
+    }
+    assert entry == as_dict and list(dict(entry).items()) == list(as_dict.items())
+    assert entry.get('NOPE') is None and 'ST' in entry and 'NOPE' not in entry
+    entry['LOCATION'] = 'http://10.0.0.2/d.xml'
+    assert entry.location == 'http://10.0.0.2/d.xml'
+    other = Registration('uuid:b::upnp:rootdevice', 'http://10.0.0.1/d.xml', ''.join(['upnp:', 'rootdevice']))
+    assert other.st is entry.st
+
+
+def test_registry_index():
+    """`search` against the linear scan it replaced, through registrations and removals in random order."""
+    import random
+    from .ssdp import SSDPServer
+
+    def linear(known, st):
+        # what discovery_request did, plus the uuid of a device without a registration for it
+        local = [entry for entry in known.values() if entry['MANIFESTATION'] == 'local']
+        matches = [entry for entry in local if entry['ST'] == st or st == 'ssdp:all' and not entry['SILENT']]
+        if not matches and st.startswith('uuid:'):
+            matches = [entry for entry in local if usn_uuid(entry['USN']) == st]
+        return matches
+
+    targets = ['upnp:rootdevice', 'urn:schemas-upnp-org:device:Camera:1', 'urn:schemas-upnp-org:service:Zoom:1']
+    entries = []
+    for device in range(20):
+        uuid = 'uuid:device-%d' % device
+        for st in [uuid] + targets:
+            usn = uuid if st == uuid else '%s::%s' % (uuid, st)
+            entries.append(Registration(usn, 'http://10.0.0.1/%d.xml' % device, st, silent=device % 5 == 0,
+                                        manifestation='remote' if device % 4 == 0 else 'local'))
+    sts = targets + ['uuid:device-%d' % device for device in range(20)] + ['ssdp:all', 'urn:nothing']
+
+    random.seed(4)
+    index = RegistryIndex()
+    known = {}
+    for _ in range(500):
+        entry = random.choice(entries)
+        if entry['USN'] in known and random.random() < 0.5:
+            index.remove(known.pop(entry['USN']))
+        else:
+            if entry['USN'] in known:
+                index.remove(known.pop(entry['USN']))
+            known[entry['USN']] = entry
+            index.add(entry)
+        for st in sts:
+            assert list(index.search(st)) == linear(known, st), st
+
+    # a device without a registration for its uuid is still found by it
+    index = RegistryIndex()
+    for entry in entries:
+        if entry['ST'] != usn_uuid(entry['USN']):
+            index.add(entry)
+    assert [entry['ST'] for entry in index.search('uuid:device-1')] == targets
+    assert not index.search('uuid:device-4')  # (remote)
+
+    # ... and answered with the ST asked for
+    server = SSDPServer('127.0.0.1')
+    server.limiter = None
+    server.register('local', 'uuid:device-1::upnp:rootdevice', 'upnp:rootdevice', 'http://10.0.0.1/1.xml')
+    server.register('local', 'uuid:device-1::urn:schemas-upnp-org:service:Zoom:1',
+                    'urn:schemas-upnp-org:service:Zoom:1', 'http://10.0.0.1/1.xml')
+    replies = []
+    # answered right away
+    server.responses = type('Now', (), {'schedule': lambda self, delay, key, send, *args: send(*args) or True})()
+    server.send_responses = lambda responses, destination, delay: replies.extend(response for response, _ in responses)
+    server.discovery_request({'st': 'uuid:device-1', 'mx': '0'}, ('10.0.0.2', 1900))
+    assert len(replies) == 2 and all(b'\r\nST: uuid:device-1\r\n' in reply for reply in replies), replies
+    assert [reply.count(b'\r\nST: ') for reply in replies] == [1, 1]
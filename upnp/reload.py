@@ -0,0 +1,335 @@
+"""
+Hot reload of the device descriptions: the yaml files (and their templates) are watched, and a device whose
+files change is rendered again and swapped in, while the sockets stay as they are.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+
+from .description import ServiceDescription, description_files, host, is_shared, read_template, template_path
+
+logger = logging.getLogger()
+
+POLL_INTERVAL = 1.0  # seconds, without inotify
+SETTLE = 0.05  # seconds to wait after an inotify event: editors write files in several steps
+
+# inotify(7)
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+def signature(path):
+    """What tells a file changed, None if it is not there."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class DescriptionWatcher:
+    """
+    Reloads the descriptions whose yaml or template changed, and only those.
+
+    A device that keeps its identity (uuid, location and device type) gets its new description swapped in
+    (a dict assignment: requests get either the old or the new one) and is announced again with ssdp:alive.
+    A device whose identity changed says byebye with the old one, and is announced with the new one.
+    New files add devices, removed files remove them (with byebye). A description that does not load
+    anymore is logged, and the last good one is kept.
+
+    Changes are noticed with inotify (on Linux), by polling the mtimes every `interval` seconds otherwise.
+    """
+
+    def __init__(self, paths, address, descriptions, http_server, ssdp, interval=POLL_INTERVAL, inotify=True):
+        """
+        :param paths: the yaml files and directories the descriptions come from
+        :param address: (ip_address, port) of the HTTP server
+        :param descriptions: the ServiceDescriptions already hosted
+        """
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.address = address
+        self.http_server = http_server
+        self.ssdp = ssdp
+        self.interval = interval
+        self.shared = is_shared(self.paths, description_files(self.paths))
+        self.devices = {description.file: description for description in descriptions}
+        self.signatures = {}  # file -> signature, yaml files and templates
+        for path in self._watched_files():
+            self.signatures[path] = signature(path)
+        self.loop = None
+        self._libc = _libc() if inotify else None
+        self._fd = None
+        self._timer = None
+        self.stats = {
+            'scans': 0,
+            'reloaded': 0,
+            'added': 0,
+            'removed': 0,
+            'errors': 0,
+        }
+
+    def _templates(self):
+        return {description.template: template_path(description.template) for description in self.devices.values()}
+
+    def _watched_files(self):
+        return description_files(self.paths) + list(self._templates().values())
+
+    def start(self, loop):
+        self.loop = loop
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+                self._watch()
+                loop.add_reader(fd, self._inotify_ready)
+                return
+            logger.warning("inotify not available (errno %d), polling the descriptions", ctypes.get_errno())
+        self._timer = loop.call_later(self.interval, self._poll)
+
+    def stop(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _watch(self):
+        # directories rather than files: editors often replace a file instead of writing it
+        directories = {path if os.path.isdir(path) else os.path.dirname(path) or '.' for path in self.paths}
+        directories.update(os.path.dirname(path) for path in self._templates().values())
+        for directory in directories:
+            if self._libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_MASK) < 0:
+                logger.warning("could not watch %s (errno %d)", directory, ctypes.get_errno())
+
+    def _inotify_ready(self):
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        if self._timer is None:
+            self._timer = self.loop.call_later(SETTLE, self._settled)
+
+    def _settled(self):
+        self._timer = None
+        self.scan()
+        # templates may have moved to other directories
+        self._watch()
+
+    def _poll(self):
+        self.scan()
+        self._timer = self.loop.call_later(self.interval, self._poll)
+
+    def scan(self):
+        """Reload what changed since the last scan. :return: the files reloaded"""
+        self.stats['scans'] += 1
+        files = description_files(self.paths)
+        changed = set()
+        for path in files:
+            current = signature(path)
+            if current != self.signatures.get(path):
+                self.signatures[path] = current
+                changed.add(path)
+        for name, path in self._templates().items():
+            current = signature(path)
+            if current != self.signatures.get(path):
+                self.signatures[path] = current
+                read_template.cache_clear()
+                changed.update(file for file, description in self.devices.items() if description.template == name)
+        for path in set(self.devices) - set(files):
+            self.signatures.pop(path, None)
+            changed.add(path)
+
+        for path in sorted(changed):
+            self.reload(path)
+        return changed
+
+    def reload(self, path):
+        old = self.devices.get(path)
+        if signature(path) is None:
+            if old is not None:
+                logger.info("%s is gone, removing %s", path, old.uuid)
+                self._remove(old)
+            return
+        try:
+            new = ServiceDescription(path, address=self.address, shared=self.shared)
+        except (OSError, KeyError, ValueError) as e:
+            self.stats['errors'] += 1
+            logger.error("Could not reload the description %s, keeping the previous one: %r", path, e)
+            return
+
+        if old is None:
+            if any(description.uuid == new.uuid for description in self.devices.values()):
+                logger.warning("%s: %s is already served", path, new.uuid)
+                return
+            logger.info("%s: adding %s", path, new.uuid)
+            self.devices[path] = new
+            host([new], self.http_server, self.ssdp)
+            self.stats['added'] += 1
+            return
+
+        if new.document.etag == old.document.etag and new.device_type == old.device_type:
+            # touched, but nothing to serve differently
+            self.devices[path] = new
+            return
+
+        logger.info("%s changed, reloading %s", path, new.uuid)
+        self.stats['reloaded'] += 1
+        if (new.uuid, new.location, new.device_type) != (old.uuid, old.location, old.device_type):
+            primary = self.http_server.description is old.document
+            self._remove(old)
+            self.devices[path] = new
+            host([new], self.http_server, self.ssdp)
+            if primary:
+                # /description.xml stays with this device, not with the one `_remove` moved it to
+                self.http_server.description = new.document
+            return
+        self.devices[path] = new
+        if self.http_server.description is old.document:
+            self.http_server.description = new.document
+        self.http_server.add_description(new.path, new.document)
+        self.ssdp.announce_device(new.uuid)
+
+    def _remove(self, description):
+        self.devices.pop(description.file, None)
+        self.ssdp.unregister_device(description.uuid)
+        self.http_server.remove_description(description.path)
+        if self.http_server.description is description.document:
+            # /description.xml goes to another device
+            self.http_server.description = next(iter(self.devices.values())).document if self.devices else None
+        self.stats['removed'] += 1
+
+
+def test_reload():
+    """Reloads are quick, and neither the HTTP connections nor the other devices notice."""
+    import asyncio
+    import tempfile
+    import time
+    import yaml
+    from .http_server import AsyncUPNPHTTPServer
+    from .ssdp import SSDPServer
+
+    class Recorder:
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, addr=None):
+            self.sent.append(data)
+
+    with open(template_path('examples/m87.yaml')) as f:
+        m87 = yaml.safe_load(f)
+
+    def write(path, **values):
+        with open(path + '.tmp', 'w') as f:
+            yaml.safe_dump(dict(m87, **values), f)
+        os.replace(path + '.tmp', path)
+
+    async def get(reader, writer, path):
+        writer.write(('GET %s HTTP/1.1\r\nHost: x\r\n\r\n' % path).encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = [line for line in head.split(b'\r\n') if line.lower().startswith(b'content-length')]
+        body = await reader.readexactly(int(length[0].split(b':')[1])) if length else b''
+        return int(head.split()[1]), body
+
+    async def wait_for(condition, timeout=2.0):
+        start = time.monotonic()
+        while not await condition():
+            assert time.monotonic() - start < timeout, "no reload after %ss" % timeout
+            await asyncio.sleep(0.01)
+        return time.monotonic() - start
+
+    async def run(directory, inotify):
+        write(os.path.join(directory, 'a.yaml'), name='camera A', MAC='0000000000AA')
+        write(os.path.join(directory, 'b.yaml'), name='camera B', MAC='0000000000BB')
+        descriptions = load_descriptions(directory, ('127.0.0.1', 8088))
+        http_server = AsyncUPNPHTTPServer(('127.0.0.1', 0), None)
+        ssdp = SSDPServer('127.0.0.1')
+        ssdp.transport = Recorder()
+        host(descriptions, http_server, ssdp)
+        loop = asyncio.get_running_loop()
+        await http_server.start()
+        ssdp.announcer.start(loop)
+        watcher = DescriptionWatcher(directory, ('127.0.0.1', 8088), descriptions, http_server, ssdp,
+                                     interval=0.02, inotify=inotify)
+        watcher.start(loop)
+        assert (watcher._fd is not None) == inotify
+        a, b = descriptions
+        try:
+            reader, writer = await asyncio.open_connection(*http_server.address[:2])
+            assert (await get(reader, writer, a.path))[1].count(b'camera A')
+            await asyncio.sleep(0.05)
+            ssdp.transport.sent.clear()
+
+            # same identity: swapped, and announced again
+            write(a.file, name='camera A2', MAC='0000000000AA')
+
+            async def renamed():
+                return b'camera A2' in (await get(reader, writer, a.path))[1]
+            latency = await wait_for(renamed)
+            assert latency < 1
+            assert watcher.devices[b.file] is b and http_server.descriptions[b.path] is b.document
+            await asyncio.sleep(0.05)
+            assert any(b'ssdp:alive' in data and a.uuid.encode() in data for data in ssdp.transport.sent)
+            assert not any(b'ssdp:byebye' in data or b.uuid.encode() in data for data in ssdp.transport.sent)
+
+            # another identity: byebye for the old one
+            ssdp.transport.sent.clear()
+            write(b.file, name='camera B', MAC='0000000000BC')
+
+            async def moved():
+                return watcher.devices[b.file] is not b
+            await wait_for(moved)
+            new_b = watcher.devices[b.file]
+            assert (await get(reader, writer, new_b.path))[0] == 200
+            # (a 404 closes the connection)
+            assert (await get(reader, writer, b.path))[0] == 404
+            writer.close()
+            assert any(b'ssdp:byebye' in data and b.uuid.encode() in data for data in ssdp.transport.sent)
+            assert not ssdp.is_known(b.usn) and ssdp.is_known(new_b.usn)
+
+            # the device at /description.xml, with another identity: still there
+            renamed_a = watcher.devices[a.file]
+            assert http_server.description is renamed_a.document
+            write(a.file, name='camera A', MAC='0000000000AB')
+
+            async def moved_a():
+                return watcher.devices[a.file] is not renamed_a
+            await wait_for(moved_a)
+            assert http_server.description is watcher.devices[a.file].document
+            assert http_server.descriptions[new_b.path] is new_b.document
+
+            # gone
+            os.unlink(a.file)
+
+            async def removed():
+                return a.file not in watcher.devices
+            await wait_for(removed)
+            assert a.path not in http_server.descriptions and http_server.description is new_b.document
+            assert not ssdp.is_known(a.usn)
+        finally:
+            watcher.stop()
+            ssdp.announcer.stop()
+            http_server.close()
+
+    from .description import load_descriptions
+    for inotify in (True, False):
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(run(directory, inotify))
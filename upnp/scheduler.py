@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger()
+
+
+class ResponseScheduler:
+    """
+    Run callbacks at a deadline without blocking the caller.
+
+    All pending entries live in a single heap and only one loop timer is armed, for the earliest deadline.
+    Entries carry a key: scheduling a key that is still pending is refused (and counted as coalesced),
+    which is how repeated M-SEARCHes from the same client within the MX window get a single reply.
+    """
+
+    def __init__(self, loop=None, lag=None):
+        """:param lag: a metrics Histogram, observing how late each callback runs"""
+        self.loop = loop
+        self.lag = lag
+        self._heap = []  # (deadline, seq, key)
+        self._pending = {}  # key -> (callback, args)
+        self._seq = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+        self.stats = {
+            'scheduled': 0,
+            'coalesced': 0,
+            'sent': 0,
+            'depth': 0,
+            'lag_total': 0.0,  # seconds between the scheduled deadline and the actual send
+            'lag_max': 0.0,
+        }
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, delay, key, callback, *args):
+        """
+        Call `callback(*args)` in `delay` seconds.
+
+        :param delay: seconds from now
+        :param key: identifies the entry; must be hashable, None means "never coalesce"
+        :return: False if an entry with the same key is already pending
+        """
+        if key is None:
+            key = ('unique', next(self._seq))
+        elif key in self._pending:
+            self.stats['coalesced'] += 1
+            return False
+
+        self.stats['scheduled'] += 1
+        if self.loop is None:
+            # not attached to a loop (yet): there is nothing to wait on
+            self.stats['sent'] += 1
+            callback(*args)
+            return True
+
+        deadline = self.loop.time() + delay
+        self._pending[key] = (callback, args)
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        self.stats['depth'] = len(self._pending)
+        if self._timer_deadline is None or deadline < self._timer_deadline:
+            self._arm(deadline)
+        return True
+
+    def cancel(self):
+        """Drop everything that is still pending."""
+        if self._timer:
+            self._timer.cancel()
+        self._timer = self._timer_deadline = None
+        self._heap.clear()
+        self._pending.clear()
+        self.stats['depth'] = 0
+
+    def _arm(self, deadline):
+        if self._timer:
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = self.loop.call_at(deadline, self._run)
+
+    def _run(self):
+        self._timer = self._timer_deadline = None
+        now = self.loop.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            callback, args = self._pending.pop(key)
+            lag = now - deadline
+            self.stats['sent'] += 1
+            self.stats['lag_total'] += lag
+            if lag > self.stats['lag_max']:
+                self.stats['lag_max'] = lag
+            if self.lag is not None:
+                self.lag.observe(lag)
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error("scheduled callback %r failed: %r", callback, e)
+        self.stats['depth'] = len(self._pending)
+        if heap:
+            self._arm(heap[0][0])
+
+
+class DeadlineHeap:
+    """
+    One deadline per key, kept in a single heap.
+
+    Moving or discarding a deadline does not touch the heap: outdated heap entries are skipped when they
+    come out, so updates stay O(log n) and nothing ever needs a full scan.
+    """
+
+    def __init__(self):
+        self._heap = []  # (deadline, key)
+        self.deadlines = {}  # key -> current deadline
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def set(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self.deadlines) + 64:
+            # too many outdated entries, start over
+            self._heap = [(d, k) for k, d in self.deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def discard(self, key):
+        self.deadlines.pop(key, None)
+
+    def next_deadline(self):
+        heap = self._heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_expired(self, now):
+        """Remove and return the (key, deadline) pairs whose deadline is not after `now`."""
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                expired.append((key, deadline))
+        return expired
+
+
+def test_response_scheduler():
+    """The M-SEARCH replies: MX capped, deadlines spread over the window, repeats coalesced, lag and depth kept."""
+    import asyncio
+    from .ssdp import SSDPServer, MAX_MX
+
+    class Lag:
+        def __init__(self):
+            self.observed = []
+
+        def observe(self, value):
+            self.observed.append(value)
+
+    def search(server, port, mx, st='upnp:rootdevice'):
+        server.datagram_received(('M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\n'
+                                  'MX: %s\r\nST: %s\r\n\r\n' % (mx, st)).encode(), ('127.0.0.1', port))
+
+    assert [SSDPServer.max_delay({'mx': mx}) for mx in ('3', '120', '-1', 'x')] == [3, MAX_MX, 0, 1]
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        server = SSDPServer('127.0.0.1')
+        server.limiter = None
+        server.register('local', 'uuid:test::upnp:rootdevice', 'upnp:rootdevice', 'http://127.0.0.1:8088/d.xml')
+        sent = []
+        server.transport = type('Recorder', (), {'sendto': lambda self, data, addr: sent.append((loop.time(), addr))})()
+        lag = Lag()
+        server.responses = ResponseScheduler(loop, lag=lag)
+        server.loop = loop
+
+        start = loop.time()
+        for port in range(20000, 20020):
+            search(server, port, 1)
+        search(server, 20000, 1)  # a repeat: coalesced
+        search(server, 20000, 1, 'ssdp:all')  # another target: not
+        search(server, 30000, 120)  # capped to MAX_MX
+        assert len(server.responses) == server.responses.stats['depth'] == 22
+        assert server.responses.stats['coalesced'] == 1
+        deadlines = {key[1:]: deadline - start for deadline, _, key in server.responses._heap}
+        assert deadlines.pop((30000, 'upnp:rootdevice')) <= MAX_MX
+        assert max(deadlines.values()) <= 1
+        # jittered over the window, not all at once
+        assert max(deadlines.values()) - min(deadlines.values()) > 0.2
+
+        await asyncio.sleep(1.1)
+        replies = [(time, addr) for time, addr in sent if addr[1] != 30000]
+        assert len(replies) == 21 and {addr[1] for _, addr in replies} == set(range(20000, 20020))
+        assert all(time - start <= 1.1 for time, _ in replies)
+        assert server.responses.stats['sent'] >= 21 and server.responses.stats['depth'] <= 1
+        assert len(lag.observed) >= 21 and 0 <= server.responses.stats['lag_max'] < 0.1
+        assert abs(server.responses.stats['lag_total'] - sum(lag.observed)) < 1e-9
+        server.responses.cancel()
+        assert len(server.responses) == 0
+
+    asyncio.run(run())
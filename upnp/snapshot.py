@@ -0,0 +1,337 @@
+"""
+Warm restarts: the registry of a SSDPServer saved to disk every `interval` seconds and loaded at start-up, so
+that the remote devices are known again right away, instead of after their next NOTIFY (up to their max-age).
+
+The file is a header, fixed size records, and the table of the distinct strings they point into (the ST,
+SERVER, LOCATION... are shared by many entries): loading is one read, one decode and an `iter_unpack`.
+Saving encodes a slice of the entries per loop iteration, and the file is written from a thread, to a
+temporary file renamed over the previous one: the loop never waits on it, and a reader never sees half of it.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import os
+import struct
+import tempfile
+import time
+
+from .registry import Registration
+
+logger = logging.getLogger()
+
+SNAPSHOT_INTERVAL = 30  # seconds
+SLICE = 1000  # entries encoded per loop iteration, a few ms
+
+MAGIC = b'SSDPREG1'
+HEADER = struct.Struct('<8sdII')  # magic, time written, strings, records
+# deadline (0 for the local ones), last seen, flags, then the strings: usn, location, st, server, cache-control,
+# host
+RECORD = struct.Struct('<ddBIIIIII')
+LOCAL, SILENT, SUFFIXED = 1, 2, 4  # flags; SUFFIXED: the usn is `<usn string>::<st>`
+NONE = 0xffffffff  # no string (a None host)
+
+
+class Encoder:
+    """Builds a snapshot, one entry at a time."""
+
+    def __init__(self):
+        self.strings = {}  # string -> index, in order
+        self.records = bytearray()
+        self.count = 0
+
+    def _index(self, value):
+        if value is None:
+            return NONE
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def add(self, entry, deadline=None):
+        """
+        :param entry: a Registration (or a dict with the same keys)
+        :param deadline: when a remote entry expires (time.time() based)
+        """
+        fields = (entry['USN'], entry['LOCATION'], entry['ST'], entry['SERVER'], entry['CACHE-CONTROL'],
+                  entry['HOST'])
+        if any(field and '\0' in field for field in fields):
+            # the separator of the strings; not from a well behaved device anyway
+            return
+        flags = (LOCAL if entry['MANIFESTATION'] == 'local' else 0) | (SILENT if entry['SILENT'] else 0)
+        usn, st = fields[0], fields[2]
+        if usn.endswith(st) and usn[-len(st) - 2:-len(st)] == '::':
+            # `uuid:device-UUID::urn:...`: the uuid part is shared by the registrations of the device
+            fields = (usn[:-len(st) - 2],) + fields[1:]
+            flags |= SUFFIXED
+        self.records += RECORD.pack(deadline or 0, entry['last-seen'], flags, *map(self._index, fields))
+        self.count += 1
+
+    def data(self):
+        strings = '\0'.join(self.strings).encode()
+        return HEADER.pack(MAGIC, time.time(), len(self.strings), self.count) + self.records + strings
+
+
+def decode(data):
+    """
+    :param data: a snapshot (bytes, or a mmap)
+    :return: [(Registration, deadline)], in the order of the registry; the deadline is None for local entries
+    :raise ValueError: not a (complete) snapshot
+    """
+    try:
+        magic, _, count, records = HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError('truncated snapshot')
+    if magic != MAGIC:
+        raise ValueError('not a registry snapshot')
+    end = HEADER.size + records * RECORD.size
+    strings = bytes(data[end:]).decode().split('\0') if count else []
+    if len(data) < end or len(strings) != count:
+        raise ValueError('truncated snapshot')
+
+    entries = []
+    for deadline, last_seen, flags, usn, location, st, server, cache_control, host in RECORD.iter_unpack(
+            memoryview(data)[HEADER.size:end]):
+        local = flags & LOCAL
+        usn = strings[usn]
+        if flags & SUFFIXED:
+            usn = '%s::%s' % (usn, strings[st])
+        entry = Registration(usn, strings[location], strings[st], strings[server], strings[cache_control],
+                             'local' if local else 'remote', bool(flags & SILENT),
+                             None if host == NONE else strings[host], last_seen)
+        entries.append((entry, None if local else deadline))
+    return entries
+
+
+def write(path, data):
+    """Replace the file at `path` with `data`, at once."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def default_path():
+    """In the directory of the DescriptionCache: ~/.cache/upnp-ssdp/registry.snapshot"""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'upnp-ssdp',
+                        'registry.snapshot')
+
+
+class RegistrySnapshot:
+    """Saves the registry of `server` to `path` every `interval` seconds, and loads it back."""
+
+    def __init__(self, server, path=None, interval=SNAPSHOT_INTERVAL, slice=SLICE):
+        self.server = server
+        self.path = path or default_path()
+        self.interval = interval
+        self.slice = slice
+        self.loop = None
+        self._timer = None
+        self._pending = None  # the usns still to encode, while saving
+        self._encoder = None
+        self._executor = None  # the thread writing the file
+        self._writing = None  # the future of the write in progress
+        self.stats = {'saved': 0, 'failed': 0, 'bytes': 0, 'loaded': 0, 'expired': 0}
+
+    def load(self, local=False, now=None):
+        """
+        Add back the remote devices of the snapshot that have not expired.
+
+        :param local: restore the local registrations too (they usually come from the descriptions again)
+        :return: the number of entries restored
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                entries = decode(f.read())
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, IndexError) as e:
+            logger.warning("could not load the registry snapshot %s: %r", self.path, e)
+            return 0
+        now = time.time() if now is None else now
+        restored = 0
+        for entry, deadline in entries:
+            if deadline is None:
+                if local and not self.server.is_known(entry.usn):
+                    self.server.register('local', entry.usn, entry.st, entry.location, entry.server,
+                                         entry.cache_control, entry.silent, entry.host)
+                    restored += 1
+            elif deadline <= now:
+                self.stats['expired'] += 1
+            elif self.server.restore(entry, deadline):
+                restored += 1
+        self.stats['loaded'] += restored
+        logger.info("%d entries restored from %s", restored, self.path)
+        return restored
+
+    def save(self):
+        """Save the registry now, blocking: at exit."""
+        encoder = Encoder()
+        deadlines = self.server.remote_expiry.deadlines
+        for entry in self.server.known.values():
+            encoder.add(entry, deadlines.get(entry['USN']))
+        self._write(encoder.data())
+
+    def _write(self, data):
+        try:
+            write(self.path, data)
+        except OSError as e:
+            self.stats['failed'] += 1
+            logger.warning("could not save the registry snapshot %s: %r", self.path, e)
+            return
+        self.stats['saved'] += 1
+        self.stats['bytes'] = len(data)
+
+    def start(self, loop):
+        self.loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='snapshot')
+        self._timer = loop.call_later(self.interval, self._begin)
+
+    def stop(self):
+        """Stop saving. A write in progress is waited for: a `save` after this one is not overwritten by it."""
+        if self._timer:
+            self._timer.cancel()
+        if self._writing is not None:
+            concurrent.futures.wait([self._writing])
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._timer = self.loop = self._pending = self._encoder = self._executor = self._writing = None
+
+    def _begin(self):
+        # the usns as they are now: those gone by the time they are encoded are skipped, those refreshed
+        # are saved as they are then
+        self._pending = iter(list(self.server.known))
+        self._encoder = Encoder()
+        self._timer = self.loop.call_soon(self._encode)
+
+    def _encode(self):
+        known = self.server.known
+        deadlines = self.server.remote_expiry.deadlines
+        encoded = 0
+        for usn in itertools.islice(self._pending, self.slice):
+            encoded += 1
+            entry = known.get(usn)
+            if entry is not None:
+                self._encoder.add(entry, deadlines.get(usn))
+        if encoded == self.slice:
+            self._timer = self.loop.call_soon(self._encode)
+            return
+        data = self._encoder.data()
+        self._pending = self._encoder = self._timer = None
+        self._writing = self._executor.submit(self._write, data)
+        asyncio.wrap_future(self._writing, loop=self.loop).add_done_callback(self._written)
+
+    def _written(self, future):
+        if self.loop is not None:
+            self._writing = None
+            self._timer = self.loop.call_later(self.interval, self._begin)
+
+
+def test_snapshot():
+    from .ssdp import SSDPServer
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'registry.snapshot')
+        server = SSDPServer('127.0.0.1')
+        server.register_device('uuid:local', 'http://127.0.0.1:8088/description.xml', silent=True)
+        headers = {'location': 'http://10.0.0.1/d.xml', 'server': 'Linux', 'cache-control': 'max-age=100'}
+        server.remember('uuid:a::upnp:rootdevice', 'upnp:rootdevice', headers, '10.0.0.1')
+        server.remember('uuid:b::upnp:rootdevice', 'upnp:rootdevice', dict(headers, **{'cache-control': 'max-age=1'}),
+                        '10.0.0.2')
+        RegistrySnapshot(server, path).save()
+
+        restarted = SSDPServer('127.0.0.1')
+        added = []
+        restarted.remote_callbacks.append(lambda change, entry: added.append(entry['USN']))
+        snapshot = RegistrySnapshot(restarted, path)
+        assert snapshot.load(now=time.time() + 10) == 1 and snapshot.stats['expired'] == 1
+        assert added == ['uuid:a::upnp:rootdevice'] and not restarted.is_known('uuid:local')
+        assert dict(restarted.known['uuid:a::upnp:rootdevice']) == dict(server.known['uuid:a::upnp:rootdevice'])
+        assert restarted.remote_expiry.deadlines == {'uuid:a::upnp:rootdevice':
+                                                     server.remote_expiry.deadlines['uuid:a::upnp:rootdevice']}
+
+        # and the local ones, if asked
+        restarted = SSDPServer('127.0.0.1')
+        assert RegistrySnapshot(restarted, path).load(local=True) == 4
+        assert restarted.known['uuid:local']['SILENT'] and restarted.known['uuid:local']['HOST'] is None
+
+        # stopped while writing: the write is done before the one at exit
+        slow = RegistrySnapshot(server, path, interval=0)
+        written = []
+        slow._write = lambda data: time.sleep(0.2) or written.append(len(data))
+
+        async def stop_while_writing():
+            slow.start(asyncio.get_running_loop())
+            while slow._writing is None:
+                await asyncio.sleep(0.001)
+            slow.stop()
+            assert written
+
+        asyncio.run(stop_while_writing())
+
+        with open(path, 'r+b') as f:
+            f.truncate(100)
+        assert RegistrySnapshot(SSDPServer('127.0.0.1'), path).load() == 0
+
+
+def test_time_to_inventory():
+    """
+    200 devices announcing themselves every 0.5s (their NOTIFY cycle, for the test): after a restart, how long
+    until all of them are known again? Without a snapshot it takes a cycle, with one it is immediate.
+    """
+    import asyncio
+    from .ssdp import SSDPServer
+
+    devices = 200
+    cycle = 0.5
+    notifies = [('NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nCACHE-CONTROL: max-age=1800\r\n'
+                 'LOCATION: http://10.0.%d.%d/description.xml\r\nNT: upnp:rootdevice\r\nNTS: ssdp:alive\r\n'
+                 'SERVER: Linux UPnP/1.0 Camera/1.0\r\nUSN: uuid:device-%d::upnp:rootdevice\r\n\r\n' %
+                 (n // 250, n % 250, n)).encode() for n in range(devices)]
+
+    async def network(servers):
+        """The devices, each announcing itself once a cycle, at its own time in it."""
+        begin = time.monotonic()
+        for n in itertools.count():
+            await asyncio.sleep(max(0.0, begin + n * cycle / devices - time.monotonic()))
+            for server in servers:
+                server.datagram_received(notifies[n % devices], ('10.0.%d.%d' % (n // 250 % 250, n % 250), 1900))
+
+    async def run(directory, warm):
+        loop = asyncio.get_running_loop()
+        path = os.path.join(directory, 'registry.snapshot')
+        servers = [SSDPServer('127.0.0.1')]
+        devices_task = loop.create_task(network(servers))
+        # the first run, until it knows the network, and saved it (a save started after that)
+        snapshot = RegistrySnapshot(servers[0], path, interval=0.01, slice=50)
+        snapshot.start(loop)
+        while len(servers[0].remote_devices()) < devices:
+            await asyncio.sleep(0.01)
+        saved = snapshot.stats['saved']
+        while snapshot.stats['saved'] < saved + 2:
+            await asyncio.sleep(0.01)
+        snapshot.stop()
+
+        restart = time.monotonic()
+        servers[0] = server = SSDPServer('127.0.0.1')
+        if warm:
+            RegistrySnapshot(server, path).load()
+        while len(server.remote_devices()) < devices:
+            await asyncio.sleep(0.001)
+        elapsed = time.monotonic() - restart
+        devices_task.cancel()
+        return elapsed
+
+    with tempfile.TemporaryDirectory() as directory:
+        cold = asyncio.run(run(directory, False))
+    with tempfile.TemporaryDirectory() as directory:
+        warm = asyncio.run(run(directory, True))
+    assert cold > cycle / 2 and warm < cycle / 10, (cold, warm)
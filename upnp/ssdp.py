@@ -10,12 +10,9 @@
 # Implementation of a SSDP server.
 #
 
-# @TODO - need an asyncio version of this! but... there's a known asyncio multicast bug grrrr :
-# https://github.com/python/asyncio/issues/480
-# https://github.com/python/cpython/pull/423
-# checkout, thou:
-# * https://stackoverflow.com/questions/41418023/python-asyncio-how-to-receive-multicast-responses
-# * and its source: https://www.reddit.com/r/learnpython/comments/4drk0a/asyncio_multicast_udp_socket_on_342/
+# The engine runs on asyncio: the multicast socket is configured by hand (the asyncio multicast helpers
+# have a known bug, see https://github.com/python/asyncio/issues/480) and then handed over to
+# `loop.create_datagram_endpoint`, so datagrams are dispatched as soon as the socket is readable.
 
 
 import random
@@ -24,35 +21,356 @@ import socket
 import logging
 import struct
 import asyncio
+import re
+import sys
+import zlib
+from collections import namedtuple
 from email.utils import formatdate
 from errno import ENOPROTOOPT
 
+from .announcer import Announcer, NOTIFY_RATE
+from .metrics import REGISTRY
+from .ratelimit import SearchLimiter
+from .registry import RegistryIndex, Registration
+from .scheduler import ResponseScheduler, DeadlineHeap
+from .ssdp_parser import parse_datagram, M_SEARCH, NOTIFY, RESPONSE
+
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
+SSDP_ADDR_V6_LINK = 'ff02::c'
+SSDP_ADDR_V6_SITE = 'ff05::c'
 SERVER_ID = 'SSDP Server'
-# or pick it based on interface, which is more flexible
+MAX_MX = 5
+DEFAULT_MAX_AGE = 1800
+MAX_REMOTE = 10000
 
 logger = logging.getLogger()
 
+# headers of a registration that are never sent on the wire
+PRIVATE_FIELDS = ('MANIFESTATION', 'SILENT', 'HOST', 'last-seen')
+
+# the bytes sent for a registration. `response` stops right after `DATE: `, the date is appended when sending
+Datagrams = namedtuple('Datagrams', 'response notify byebye')
+
+# not exported by the socket module before python 3.12 (?), but needed to know where a datagram arrived
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8 if sys.platform.startswith('linux') else None)
+_IN_PKTINFO = struct.Struct('=I4s4s')  # ipi_ifindex, ipi_spec_dst, ipi_addr
+MAX_DATAGRAM_SIZE = 8192
+
+_date_cache = [None, b'']
+
+_MAX_AGE_RE = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+
+DATAGRAMS = REGISTRY.counter('ssdp_datagrams_received_total', 'SSDP datagrams received, by type', ('type',))
+DROPPED = REGISTRY.counter('ssdp_datagrams_dropped_total', 'SSDP datagrams not acted upon, by reason', ('reason',))
+SEARCHES = REGISTRY.counter('ssdp_searches_total', 'M-SEARCHes, by whether we have something to answer',
+                            ('result',))
+SEARCH_MATCHES = REGISTRY.counter('ssdp_search_matches_total', 'Registrations matched by the M-SEARCHes')
+SUPPRESSED = REGISTRY.counter('ssdp_suppressed_replies_total', 'Search responses not sent, over the global budget')
+SENT = REGISTRY.counter('ssdp_datagrams_sent_total', 'SSDP datagrams sent, by kind', ('kind',))
+REPLY_LAG = REGISTRY.histogram('ssdp_reply_lag_seconds', 'How late search responses are sent, on their schedule')
+NOTIFY_LAG = REGISTRY.histogram('ssdp_notify_lag_seconds', 'How late ssdp:alive NOTIFYs are sent, on their schedule')
+
+
+def http_date():
+    """The current date as used in the DATE header, formatted at most once per second."""
+    now = int(time.time())
+    if now != _date_cache[0]:
+        _date_cache[1] = formatdate(now, localtime=False, usegmt=True).encode()
+        _date_cache[0] = now
+    return _date_cache[1]
+
+
+def max_age(cache_control, default=DEFAULT_MAX_AGE):
+    """The max-age of a CACHE-CONTROL header, in seconds"""
+    match = _MAX_AGE_RE.search(cache_control or '')
+    return int(match.group(1)) if match else default
+
+
+def relocate(location, address):
+    """The same LOCATION url, on another host address."""
+    scheme, sep, rest = location.partition('://')
+    netloc, slash, path = rest.partition('/')
+    host, colon, port = netloc.rpartition(':')
+    if not colon or ']' in port:
+        # no port
+        netloc = address
+    else:
+        netloc = '%s:%s' % (address, port)
+    return ''.join((scheme, sep, netloc, slash, path))
+
+
+def is_multicast(host):
+    """Whether the HOST of a request is one of the SSDP multicast groups (rather than this host)."""
+    if not host:
+        # sloppy clients: most searches are multicast
+        return True
+    host = host.strip()
+    return host.startswith(SSDP_ADDR) or host.upper().startswith('[FF0')
+
+
+def compile_datagrams(settings, host='%s:%d' % (SSDP_ADDR, SSDP_PORT)):
+    """
+    Render the search response and the NOTIFY messages of a registration.
+
+    :param settings: a `SSDPServer.known` entry
+    :param host: the HOST of the NOTIFYs, i.e. the multicast group they are sent to
+    :return: Datagrams
+    """
+    fields = [(k, v) for k, v in settings.items() if k not in PRIVATE_FIELDS]
+    response = ['HTTP/1.1 200 OK']
+    response.extend('%s: %s' % (k, v) for k, v in fields)
+    response.append('DATE: ')
+
+    notify = ['NOTIFY * HTTP/1.1', 'HOST: %s' % host]
+    notify.extend('%s: %s' % (k, v) for k, v in fields if k != 'ST')
+    notify.append('NT: %s' % settings['ST'])
+    alive = notify[:2] + ['NTS: ssdp:alive'] + notify[2:] + ['', '']
+    byebye = notify[:2] + ['NTS: ssdp:byebye'] + notify[2:] + ['', '']
+
+    return Datagrams('\r\n'.join(response).encode(),
+                     '\r\n'.join(alive).encode(),
+                     '\r\n'.join(byebye).encode())
+
+
+class PktInfoTransport(asyncio.DatagramTransport):
+    """
+    A datagram transport reading with `recvmsg`, so that the protocol also learns the local address
+    each datagram arrived on (from IP_PKTINFO): `protocol.datagram_received(data, addr, local_address)`.
+    asyncio's own transport only uses `recvfrom`.
+    """
 
-class SSDPServer:
+    def __init__(self, loop, sock, protocol):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        self._ancbufsize = socket.CMSG_SPACE(_IN_PKTINFO.size)
+        loop.add_reader(sock.fileno(), self._read_ready)
+        loop.call_soon(protocol.connection_made, self)
+
+    def _read_ready(self):
+        try:
+            data, ancdata, flags, addr = self._sock.recvmsg(MAX_DATAGRAM_SIZE, self._ancbufsize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._protocol.error_received(exc)
+            return
+        local_address = None
+        for level, kind, value in ancdata:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO and len(value) >= _IN_PKTINFO.size:
+                local_address = socket.inet_ntoa(_IN_PKTINFO.unpack_from(value)[1])
+        self._protocol.datagram_received(data, addr, local_address)
+
+    def sendto(self, data, addr=None):
+        try:
+            self._sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            # a full socket buffer: SSDP is best effort anyway
+            logger.warning("dropped a datagram to %r, socket buffer full", addr)
+        except OSError as exc:
+            self._protocol.error_received(exc)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'socket':
+            return self._sock
+        if name == 'sockname':
+            return self._sock.getsockname()
+        return default
+
+    def is_closing(self):
+        return self._sock is None
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+    abort = close
+
+
+class IPv6Endpoint(asyncio.DatagramProtocol):
+    """The IPv6 socket of a `SSDPServer`: datagrams go to the server, tagged with its IPv6 address."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, host_port):
+        self.server.datagram_received(data, host_port, self.server.ipv6_host)
+
+    def error_received(self, exc):
+        self.server.error_received(exc)
+
+
+class SSDPServer(asyncio.DatagramProtocol):
     """A class implementing a SSDP server.  The notify_received and
     searchReceived methods are called when the appropriate type of
     datagram is received by the server."""
-    known = {}
 
-    def __init__(self, local_address):
+    def __init__(self, local_address, notify_rate=NOTIFY_RATE, max_remote=MAX_REMOTE, ipv6=None, ipv6_interface=0):
+        """
+        :param local_address: the address of the interface to serve, or a list of them. The first one is the one
+         used in the LOCATION of the registrations, requests coming from the others get that address replaced.
+        :param notify_rate: the periodic NOTIFYs sent per second, counting each interface's datagram
+        :param ipv6: an IPv6 address of this host; if given, the IPv6 SSDP groups are served too, with
+         this address in the LOCATION. Better not a link-local one, those would need a zone in the url.
+        :param ipv6_interface: the interface (index or name) to join the IPv6 groups on, 0 lets the system pick
+        """
         self.sock = None
+        self.transport = None
+        self.loop = None
         # this is REQUIRED to pick the correct interface!!
-        self.local_address = local_address
+        if isinstance(local_address, str):
+            local_address = [local_address]
+        self.interfaces = list(local_address)
+        self.local_address = self.interfaces[0]
+        self.ipv6 = ipv6
+        self.ipv6_host = '[%s]' % ipv6 if ipv6 else None
+        self.ipv6_interface = ipv6_interface
+        self.ipv6_endpoint = None
+        # periodic ssdp:alive for all the local registrations
+        self.announcer = Announcer(self.do_notify, rate=notify_rate, lag=NOTIFY_LAG)
+        # delayed M-SEARCH replies
+        self.responses = ResponseScheduler(lag=REPLY_LAG)
+        # per source and global limits on what the searches get; None answers everything
+        self.limiter = SearchLimiter()
+        # usn -> Datagrams, rebuilt by `register`
+        self._datagrams = {}
+        # (usn, interface address) -> Datagrams, for the interfaces other than the first
+        self._interface_datagrams = {}
+        # usn -> Registration, local and remote
+        self.known = {}
+        # lookups by ST, manifestation and device uuid, kept in sync by `register` / `unregister`
+        self.index = RegistryIndex()
+        # remote devices learnt from NOTIFYs and search responses: expire on max-age, the least recently
+        # seen ones are evicted beyond `max_remote`
+        self.max_remote = max_remote
+        self.remote_expiry = DeadlineHeap()
+        self._expiry_handle = None
+        self._expiry_deadline = None
+        # called with ('added' | 'updated' | 'removed', entry)
+        self.remote_callbacks = []
+        # the share of the work of this process, with `--workers` (see `set_worker`)
+        self.worker = 0
+        self.workers = 1
 
-    def run(self):
-        self.register_multicast()
+    def run(self, loop=None):
+        """
+        Run the server until interrupted.
+
+        :param loop: the event loop to run on (closed at the end), by default a new one
+        """
+        if loop is None:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.start())
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+            self.stop()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    async def start(self, sock=None, sock6=None):
+        """
+        Attach the server to the running event loop.
+
+        :param sock: an already bound datagram socket; by default the SSDP multicast socket is created
+        :param sock6: the same for IPv6, only used if the server has an `ipv6` address
+        :return:
+        """
+        self.loop = self.responses.loop = asyncio.get_running_loop()
+        if sock is None:
+            sock = self.register_multicast()
+        else:
+            sock.setblocking(False)
+        self.sock = sock
+        if IP_PKTINFO is not None and len(self.interfaces) > 1:
+            PktInfoTransport(self.loop, sock, self)
+            await asyncio.sleep(0)  # connection_made
+        else:
+            await self.loop.create_datagram_endpoint(lambda: self, sock=sock)
+        if self.ipv6:
+            if sock6 is None:
+                sock6 = self.register_multicast_v6()
+            else:
+                sock6.setblocking(False)
+            self.ipv6_endpoint = IPv6Endpoint(self)
+            await self.loop.create_datagram_endpoint(lambda: self.ipv6_endpoint, sock=sock6)
+        self.announcer.start(self.loop)
+        self.register_metrics()
+        # remote devices restored before the start expire too
+        self._arm_expiry()
+
+    def set_worker(self, worker, workers):
+        """
+        Make this server the `worker`th of `workers` processes serving the same registrations (see upnp.prefork).
+
+        Each of them gets every multicast datagram: it answers the searches and announces the registrations it
+        `owns`, within its share of the NOTIFY rate. Only the first one keeps track of the remote devices.
+        """
+        self.worker = worker
+        self.workers = workers
+        self.announcer.rate /= workers
+        self.announcer.burst = max(1, self.announcer.burst // workers)
+        if self.limiter is not None:
+            # (a search is always answered by the same worker, its source's bucket is there)
+            self.limiter.reply_rate /= workers
+            self.limiter.reply_burst = max(1, self.limiter.reply_burst // workers)
+        for usn in list(self.announcer.periods):
+            if not self.owns(usn):
+                self.announcer.remove(usn)
+
+    def owns(self, key):
+        """Whether this worker is in charge of `key` (a usn, or a search)."""
+        return self.workers == 1 or zlib.crc32(key.encode()) % self.workers == self.worker
+
+    def register_metrics(self, registry=REGISTRY):
+        """Gauges on the state of this server (the last one started, if there are more)."""
+        registry.gauge('ssdp_registrations', 'Registrations, by manifestation',
+                       lambda: {(m,): len(e) for m, e in self.index.by_manifestation.items()}, ('manifestation',))
+        registry.gauge('ssdp_pending_responses', 'Search responses waiting for their time', self.responses.__len__)
+        registry.gauge('ssdp_pending_notifies', 'NOTIFYs waiting for the rate limit', self.announcer.due.__len__)
+        registry.gauge('ssdp_limited_sources', 'Search sources tracked by the rate limit',
+                       lambda: len(self.limiter) if self.limiter is not None else 0)
+
+    def stop(self):
+        self.announcer.stop()
+        self.responses.cancel()
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+        self._expiry_handle = self._expiry_deadline = None
+        if self.transport:
+            self.transport.close()
+        if self.ipv6_endpoint and self.ipv6_endpoint.transport:
+            self.ipv6_endpoint.transport.close()
+        self.transport = None
+        self.ipv6_endpoint = None
+        self.sock = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        logger.warning("SSDP socket error: %r", exc)
 
     def register_multicast(self):
+        """Create the SSDP socket and join the multicast group on each of the `interfaces`."""
 
         # Create the socket
-        sock = self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # Set some options to make it multicast-friendly
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         if hasattr(socket, "SO_REUSEPORT"):
@@ -66,10 +384,7 @@ class SSDPServer:
                     pass
                 else:
                     raise
-        sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 4)
-        sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
 
-        addr = socket.inet_aton(SSDP_ADDR)
         # @TODO: with multiple interfaces and mac os there seems to be some mess...
         # let's try to force the iface we want by setting a specific address.
         # This probably behaves differently also according to the OS and any additional bridging/routing/etc.
@@ -85,69 +400,211 @@ class SSDPServer:
 
         # this is for listening to ALL interfaces.. but seems messy and confusing
         # mreq = struct.pack('4sL', ssdp_addr, socket.INADDR_ANY)
-        mreq = ssdp_addr + iface_addr
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        # so we join explicitly on each interface we serve
+        for address in self.interfaces:
+            mreq = ssdp_addr + socket.inet_aton(address)
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            except OSError as e:
+                if address == self.local_address:
+                    raise
+                logger.warning('Could not join %s on %s: %s', SSDP_ADDR, address, e)
         sock.bind(('', SSDP_PORT))
-        # sock.settimeout(1)
-        sock.setblocking(0)
+        sock.setblocking(False)
+        return sock
 
-        notify_timeout = time.time()
-        while True:
-            # @TODO arg - re-implement this without a busy loop?
+    def register_multicast_v6(self):
+        """Create the IPv6 SSDP socket, joined to the link-local and site-local groups."""
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
             try:
-                data, addr = self.sock.recvfrom(1024)
-                self.datagram_received(data, addr)
-            except socket.timeout:
-                continue
-            except socket.error as e:
-                if e.errno == socket.errno.EWOULDBLOCK:  # == errno.EAGAIN
-                    # no data yet
-                    time.sleep(0.2)
-                else:
-                    print("Unknown socket error: {}".format(e))
-                    break
-            if time.time() - notify_timeout > 10:
-                self.do_notify()
-                notify_timeout = time.time()
-
-        self.shutdown()
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except socket.error as le:
+                if le.errno != ENOPROTOOPT:
+                    raise
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, 1)
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, 1)
 
-    # @TODO we should also send NOTIFY of our own... that's what FLIR does...
+        interface = self.ipv6_interface
+        if isinstance(interface, str):
+            try:
+                interface = socket.if_nametoindex(interface)
+            except OSError:
+                logger.warning('Unknown interface %s, joining the IPv6 groups on the default one', interface)
+                interface = 0
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, interface)
+        for group in (SSDP_ADDR_V6_LINK, SSDP_ADDR_V6_SITE):
+            mreq = socket.inet_pton(socket.AF_INET6, group) + struct.pack('@I', interface)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+        sock.bind(('::', SSDP_PORT))
+        sock.setblocking(False)
+        return sock
 
     def shutdown(self):
         for st in self.known:
-            if self.known[st]['MANIFESTATION'] == 'local':
+            if self.known[st]['MANIFESTATION'] == 'local' and self.owns(st):
                 self.do_byebye(st)
 
-    def datagram_received(self, data, host_port):
-        """Handle a received multicast datagram."""
-
-        (host, port) = host_port
+    def datagram_received(self, data, host_port, local_address=None):
+        """
+        Handle a received multicast datagram.
 
-        try:
-            header, payload = data.decode().split('\r\n\r\n')[:2]
-        except ValueError as err:
-            logger.error(err)
-            return
+        :param local_address: the address of the interface it came in from, if known
+        """
 
-        lines = header.split('\r\n')
-        cmd = lines[0].split(' ')
-        lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
-        lines = filter(lambda x: len(x) > 0, lines)
+        # IPv6 addresses come with flow info and scope id, those are kept to answer
+        host, port = host_port[:2]
 
-        headers = [x.split(':', 1) for x in lines]
-        headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+        message = parse_datagram(data)
+        if message is None:
+            DATAGRAMS.inc('invalid')
+            DROPPED.inc('invalid')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Dropped malformed or unknown datagram from %s:%d', host, port)
+            return
 
-        logger.info('SSDP command %s %s - from %s:%d' % (cmd[0], cmd[1], host, port))
-        logger.debug('with headers: {}.'.format(headers))
-        if cmd[0] == 'M-SEARCH' and cmd[1] == '*':
+        DATAGRAMS.inc(message.method)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('SSDP %s - from %s:%d', message.method, host, port)
+        if message.method == M_SEARCH:
             # SSDP discovery
-            self.discovery_request(headers, (host, port))
-        elif cmd[0] == 'NOTIFY' and cmd[1] == '*':
+            self.discovery_request(message.headers, host_port, local_address)
+        elif self.worker:
+            # the remote devices are the business of the first worker
+            return
+        elif message.method == NOTIFY:
             # SSDP presence
-            logger.debug('NOTIFY *')
+            self.notify_received(message.headers, (host, port))
+        elif message.method == RESPONSE:
+            # someone (maybe us) searched
+            self.response_received(message.headers, (host, port))
+
+    def notify_received(self, headers, host_port):
+        """Keep track of the remote devices announcing themselves."""
+        usn = headers.get('usn')
+        nts = headers.get('nts')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('NOTIFY %s for %s from %s', nts, usn, host_port[0])
+        if not usn:
+            return
+        if nts == 'ssdp:byebye':
+            entry = self.known.get(usn)
+            if entry is not None and entry['MANIFESTATION'] == 'remote':
+                self.forget(usn)
+        elif nts in ('ssdp:alive', 'ssdp:update'):
+            self.remember(usn, headers.get('nt'), headers, host_port[0])
+
+    def response_received(self, headers, host_port):
+        usn = headers.get('usn')
+        if usn:
+            self.remember(usn, headers.get('st'), headers, host_port[0])
+
+    def remember(self, usn, st, headers, host):
+        """
+        Add or refresh a remote device.
+
+        :param headers: the (lower case) headers of the NOTIFY or search response
+        """
+        entry = self.known.get(usn)
+        if entry is not None and entry['MANIFESTATION'] != 'remote':
+            # our own NOTIFYs, looped back
+            return
+        if not st or not headers.get('location'):
+            return
+
+        now = time.time()
+        cache_control = headers.get('cache-control', 'max-age=%d' % DEFAULT_MAX_AGE)
+        new = Registration(usn, headers['location'], st, headers.get('server', ''), cache_control, 'remote',
+                           host=host, last_seen=now)
+        if entry is None:
+            change = 'added'
         else:
-            logger.warning('Unknown SSDP command %s %s' % (cmd[0], cmd[1]))
+            # removing and adding back moves it to the end of the LRU order
+            self.index.remove(entry)
+            changed = any(entry[k] != new[k] for k in ('LOCATION', 'ST', 'SERVER'))
+            change = 'updated' if changed else None
+        self.known[usn] = new
+        self.index.add(new)
+        self.remote_expiry.set(usn, now + max_age(cache_control))
+
+        remote = self.index.by_manifestation['remote']
+        while len(remote) > self.max_remote:
+            self.forget(next(iter(remote)))
+
+        self._arm_expiry()
+        if change:
+            self._remote_changed(change, new)
+
+    def restore(self, entry, deadline):
+        """
+        Add back a remote device saved by upnp.snapshot, until the deadline it had.
+
+        :param entry: a remote Registration
+        :return: False if the device was heard of since (that one is fresher)
+        """
+        usn = entry['USN']
+        if usn in self.known:
+            return False
+        self.known[usn] = entry
+        self.index.add(entry)
+        self.remote_expiry.set(usn, deadline)
+        remote = self.index.by_manifestation['remote']
+        while len(remote) > self.max_remote:
+            self.forget(next(iter(remote)))
+        self._arm_expiry()
+        self._remote_changed('added', entry)
+        return True
+
+    def forget(self, usn):
+        """Drop a remote device."""
+        entry = self.known.pop(usn)
+        self.index.remove(entry)
+        self.remote_expiry.discard(usn)
+        self._remote_changed('removed', entry)
+
+    def remote_devices(self, st=None):
+        """The remote devices currently known, optionally only the ones of a given search target."""
+        entries = self.index.by_manifestation['remote'].values()
+        if st is None:
+            return list(entries)
+        return [entry for entry in entries if entry['ST'] == st]
+
+    def expire(self, now=None):
+        """Drop the remote devices whose max-age has passed."""
+        for usn, _ in self.remote_expiry.pop_expired(time.time() if now is None else now):
+            entry = self.known.get(usn)
+            if entry is None or entry['MANIFESTATION'] != 'remote':
+                # (registered locally since)
+                continue
+            logger.debug('%s expired', usn)
+            del self.known[usn]
+            self.index.remove(entry)
+            self._remote_changed('removed', entry)
+
+    def _arm_expiry(self):
+        if self.loop is None:
+            return
+        deadline = self.remote_expiry.next_deadline()
+        if deadline is None or deadline == self._expiry_deadline:
+            return
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+        self._expiry_deadline = deadline
+        self._expiry_handle = self.loop.call_later(max(deadline - time.time(), 0), self._expiry_timer)
+
+    def _expiry_timer(self):
+        self._expiry_handle = self._expiry_deadline = None
+        self.expire()
+        self._arm_expiry()
+
+    def _remote_changed(self, change, entry):
+        for callback in self.remote_callbacks:
+            try:
+                callback(change, entry)
+            except Exception as e:
+                logger.error("remote device callback %r failed: %r", callback, e)
 
     def register(self, manifestation, usn, st, location, server=SERVER_ID, cache_control='max-age=1800', silent=False,
                  host=None):
@@ -157,134 +614,462 @@ class SSDPServer:
 
         logging.info('Registering %s (%s)' % (st, location))
 
-        self.known[usn] = {}
-        self.known[usn]['USN'] = usn
-        self.known[usn]['LOCATION'] = location
-        self.known[usn]['ST'] = st
-        self.known[usn]['EXT'] = ''
-        self.known[usn]['SERVER'] = server
-        self.known[usn]['CACHE-CONTROL'] = cache_control
-
-        self.known[usn]['MANIFESTATION'] = manifestation
-        self.known[usn]['SILENT'] = silent
-        self.known[usn]['HOST'] = host
-        self.known[usn]['last-seen'] = time.time()
+        if usn in self.known:
+            self.index.remove(self.known[usn])
+            self.announcer.remove(usn)
+            self._drop_datagrams(usn)
+        # (it may have been a remote device until now)
+        self.remote_expiry.discard(usn)
+        self.known[usn] = Registration(usn, location, st, server, cache_control, manifestation, silent, host)
 
         # @todo better naming, but we want an easy way to access our own info!
         self.settings = self.known[usn]
+        if manifestation == 'local':
+            self._datagrams[usn] = compile_datagrams(self.settings)
+        self.index.add(self.settings)
 
-        if manifestation == 'local' and self.sock:
-            self.do_notify(usn)
+        if manifestation == 'local' and not silent and self.owns(usn):
+            self.announcer.add(usn, max_age(cache_control) / 2)
+
+    def register_device(self, uuid, location, device_type=None, services=(), **kwargs):
+        """
+        Register a root device under all the search targets of the UDA spec: upnp:rootdevice, its uuid,
+        its device type and each of its service types.
+
+        :param uuid: `uuid:device-UUID`
+        :param kwargs: passed to `register`
+        """
+        self.register('local', '%s::upnp:rootdevice' % uuid, 'upnp:rootdevice', location, **kwargs)
+        self.register('local', uuid, uuid, location, **kwargs)
+        for urn in (device_type,) + tuple(services):
+            if urn:
+                self.register('local', '%s::%s' % (uuid, urn), urn, location, **kwargs)
 
     def unregister(self, usn):
         logger.info("Un-registering %s" % usn)
-        del self.known[usn]
+        self.index.remove(self.known.pop(usn))
+        self._drop_datagrams(usn)
+        self.remote_expiry.discard(usn)
+        self.announcer.remove(usn)
+
+    def _drop_datagrams(self, usn):
+        self._datagrams.pop(usn, None)
+        for address in self.interfaces + [self.ipv6_host]:
+            self._interface_datagrams.pop((usn, address), None)
+
+    def unregister_device(self, uuid, byebye=True):
+        """Un-register every registration of a device (see `register_device`), saying byebye first."""
+        for usn in list(self.index.by_uuid.get(uuid, ())):
+            if byebye and not self.known[usn]['SILENT'] and self.owns(usn):
+                self.do_byebye(usn)
+            self.unregister(usn)
+
+    def announce_device(self, uuid):
+        """Announce the registrations of a device now (e.g. its description changed), and then as usual."""
+        for usn, entry in self.index.by_uuid.get(uuid, {}).items():
+            if not entry['SILENT'] and self.owns(usn):
+                self.announcer.add(usn, max_age(entry['CACHE-CONTROL']) / 2)
+
+    def datagrams(self, usn, address=None):
+        """
+        The precompiled datagrams of a registration (compiled on demand for entries added by hand).
+
+        :param address: the interface they are for; the LOCATION is moved to that address
+        """
+        if address is None or address == self.local_address:
+            try:
+                return self._datagrams[usn]
+            except KeyError:
+                datagrams = self._datagrams[usn] = compile_datagrams(self.known[usn])
+                return datagrams
+        try:
+            return self._interface_datagrams[usn, address]
+        except KeyError:
+            settings = dict(self.known[usn])
+            settings['LOCATION'] = relocate(settings['LOCATION'], address)
+            if address == self.ipv6_host:
+                datagrams = compile_datagrams(settings, '[%s]:%d' % (SSDP_ADDR_V6_LINK.upper(), SSDP_PORT))
+            else:
+                datagrams = compile_datagrams(settings)
+            self._interface_datagrams[usn, address] = datagrams
+            return datagrams
 
     def is_known(self, usn):
         return usn in self.known
 
     def send_unicast(self, response, destination, usn, delay):
-        logger.debug('send (discovery) response delayed by %fs for %s to %r', delay, usn, destination)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('send (discovery) response delayed by %fs for %s to %r', delay, usn, destination)
         try:
-            self.sock.sendto(response.encode(), destination)
+            if ':' in destination[0]:
+                self.ipv6_endpoint.transport.sendto(response, destination)
+            else:
+                self.transport.sendto(response, destination)
+            SENT.inc('response')
         except (AttributeError, socket.error) as msg:
             logger.warning("failure sending out response: %r", msg)
 
-    def discovery_request(self, headers, host_port):
+    def discovery_request(self, headers, host_port, local_address=None):
         """Process a discovery request.  The response must be sent to
-        the address specified by (host, port)."""
+        the address specified by (host, port).
+
+        :param local_address: the interface the request came from, to answer with the LOCATION on that interface
+        """
+        if local_address not in self.interfaces and local_address != self.ipv6_host:
+            local_address = None
 
-        (host, port) = host_port
+        host, port = host_port[:2]
+        st = headers.get('st')
+        if not st:
+            DROPPED.inc('no_st')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Discovery request from (%s,%d) without ST', host, port)
+            return
 
-        logger.info('Discovery request from (%s,%d) for %s' % (host, port, headers['st']))
-        logger.info('Discovery request for %s' % headers['st'])
+        if self.workers > 1 and not self.owns('%s %s' % (host, st)) and is_multicast(headers.get('host')):
+            # another worker answers (all of them got it); a unicast search reached this worker only
+            return
 
-        # Do we know about this service?
-        for i in self.known.values():
-            if i['MANIFESTATION'] == 'remote':
-                continue
-            if headers['st'] == 'ssdp:all' and i['SILENT']:
-                continue
-            if i['ST'] == headers['st'] or headers['st'] == 'ssdp:all':
-                response = ['HTTP/1.1 200 OK']
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Discovery request from (%s,%d) for %s', host, port, st)
 
-                usn = None
-                for k, v in i.items():
-                    if k == 'USN':
-                        usn = v
-                    if k not in ('MANIFESTATION', 'SILENT', 'HOST'):
-                        response.append('%s: %s' % (k, v))
+        limiter = self.limiter
+        if limiter is not None and not limiter.admit(host, st, time.monotonic()):
+            # before looking anything up: a flood costs the least possible
+            DROPPED.inc('rate_limited')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Discovery request from (%s,%d) for %s over the rate limit', host, port, st)
+            return
+
+        # Do we know about this service?
+        responses = []
+        for i in self.index.search(st):
+            usn = i['USN']
+            response = self.datagrams(usn, local_address).response
+            if i['ST'] != st and st != 'ssdp:all':
+                # a device matched by uuid: answer with the ST that was asked for
+                response = response.replace(('\r\nST: %s\r\n' % i['ST']).encode(),
+                                            ('\r\nST: %s\r\n' % st).encode())
+            responses.append((response, usn))
 
-                if usn:
-                    response.append('DATE: %s' % formatdate(timeval=None, localtime=False, usegmt=True))
+        if not responses:
+            SEARCHES.inc('unmatched')
+            return
+        SEARCHES.inc('matched')
+        SEARCH_MATCHES.inc(amount=len(responses))
+        if limiter is not None and not limiter.spend(len(responses), time.monotonic()):
+            DROPPED.inc('over_budget')
+            SUPPRESSED.inc(amount=len(responses))
+            return
+        # answer at a random point of the MX window, so that many devices don't all reply at once.
+        # A repeated search from the same client for the same target is answered only once.
+        delay = random.random() * self.max_delay(headers)
+        if not self.responses.schedule(delay, (host, port, st), self.send_responses, responses, host_port, delay):
+            DROPPED.inc('coalesced')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Discovery request from (%s,%d) for %s already queued', host, port, st)
 
-                    response.extend(('', ''))
-                    delay = random.random() * int(headers['mx'])
+    @staticmethod
+    def max_delay(headers):
+        """The MX value of a M-SEARCH, capped to 5 seconds as required by UDA 1.1"""
+        try:
+            mx = int(headers.get('mx', 1))
+        except ValueError:
+            mx = 1
+        return min(max(mx, 0), MAX_MX)
 
-                    self.send_unicast('\r\n'.join(response), (host, port), usn, delay=0)
+    def send_responses(self, responses, destination, delay):
+        date = http_date() + b'\r\n\r\n'
+        for response, usn in responses:
+            self.send_unicast(response + date, destination, usn, delay)
 
     def do_notify(self, usn=None):
-        """Do notification"""
+        """
+        Do notification
+
+        :return: the number of datagrams sent, the announcer's rate limit counts them
+        """
         # I don't think i need to keep usn as an option..
         if usn:
             settings = self.known[usn]
         else:
-            settings = self.settings
-        if settings['SILENT']:
-            return
-        logger.info('Sending NOTIFY for %s', settings['USN'])
-
-        resp = [
-            'NOTIFY * HTTP/1.1',
-            'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
-            'NTS: ssdp:alive',
-        ]
-        stcpy = dict(settings.items())
-        stcpy['NT'] = stcpy['ST']
-        del stcpy['ST']
-        del stcpy['MANIFESTATION']
-        del stcpy['SILENT']
-        del stcpy['HOST']
-        del stcpy['last-seen']
-
-        resp.extend(map(lambda x: ': '.join(x), stcpy.items()))
-        resp.extend(('', ''))
+            settings = getattr(self, 'settings', None)
+        if not settings or settings['SILENT']:
+            return 0
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Sending NOTIFY for %s', settings['USN'])
+
         dest = (SSDP_ADDR, SSDP_PORT)
-        text = '\r\n'.join(resp)
-        logger.info('do_notify content to %s', dest)
-        # logger.debug(text)
+        sent = 0
         try:
             # @todo m87 sends multiple notifications with slight variations...
-            # self.sock.sendto('\r\n'.join(resp).encode(), dest)
-            print("sent: %d" % self.sock.sendto(text.encode(), dest))
+            for address in self._multicast_interfaces():
+                sent += 1
+                self.transport.sendto(self.datagrams(settings['USN'], address).notify, dest)
+                SENT.inc('alive')
+            if self.ipv6_endpoint:
+                sent += 1
+                self.ipv6_endpoint.transport.sendto(self.datagrams(settings['USN'], self.ipv6_host).notify,
+                                                    (SSDP_ADDR_V6_LINK, SSDP_PORT))
+                SENT.inc('alive')
         except (AttributeError, socket.error) as msg:
             logger.warning("failure sending out alive notification: %r" % msg)
+        return sent
 
     def do_byebye(self, usn):
         """Do byebye"""
 
         logger.info('Sending byebye notification for %s' % usn)
 
-        resp = [
-            'NOTIFY * HTTP/1.1',
-            'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
-            'NTS: ssdp:byebye',
-        ]
+        if usn not in self.known:
+            logger.error("error building byebye notification: unknown %r" % usn)
+            return
+        if self.transport:
+            try:
+                for address in self._multicast_interfaces():
+                    self.transport.sendto(self.datagrams(usn, address).byebye, (SSDP_ADDR, SSDP_PORT))
+                    SENT.inc('byebye')
+                if self.ipv6_endpoint:
+                    self.ipv6_endpoint.transport.sendto(self.datagrams(usn, self.ipv6_host).byebye,
+                                                        (SSDP_ADDR_V6_LINK, SSDP_PORT))
+                    SENT.inc('byebye')
+            except (AttributeError, socket.error) as msg:
+                logger.error("failure sending out byebye notification: %r" % msg)
+
+    def _multicast_interfaces(self):
+        """
+        Point the multicast sends at each interface in turn.
+
+        :return: an iterator over the interface addresses, the socket sends through that interface in the meantime
+        """
+        if len(self.interfaces) == 1 or self.sock is None:
+            yield self.local_address
+            return
         try:
-            stcpy = dict(self.known[usn].items())
-            stcpy['NT'] = stcpy['ST']
-            del stcpy['ST']
-            del stcpy['MANIFESTATION']
-            del stcpy['SILENT']
-            del stcpy['HOST']
-            del stcpy['last-seen']
-            resp.extend(map(lambda x: ': '.join(x), stcpy.items()))
-            resp.extend(('', ''))
-            logger.debug('do_byebye content', resp)
-            if self.sock:
+            for address in self.interfaces:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+                yield address
+        finally:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.local_address))
+
+
+class SSDPClient(asyncio.DatagramProtocol):
+    """
+    Search the network for devices.
+
+        async for headers in SSDPClient(st='upnp:rootdevice').search():
+            print(headers['usn'], headers['location'])
+
+    Responses are yielded as they arrive, once per USN. The M-SEARCH is sent `repeat` times, since
+    UDP may lose some, and the search ends `mx` seconds (plus a grace period) after the last one.
+    """
+
+    def __init__(self, st='ssdp:all', mx=1, repeat=2, interval=0.1, local_address=None, server=None,
+                 targets=((SSDP_ADDR, SSDP_PORT),)):
+        """
+        :param st: the search target
+        :param mx: maximum seconds the devices wait before answering (1 to 5)
+        :param repeat: how many times the search is sent
+        :param interval: seconds between the repeated searches
+        :param local_address: the interface to search on
+        :param server: a SSDPServer whose remote device cache is fed with the responses
+        :param targets: where the M-SEARCH is sent, multicast by default (UDA 1.1 also allows unicast searches)
+        """
+        self.st = st
+        self.mx = mx
+        self.repeat = repeat
+        self.interval = interval
+        self.local_address = local_address
+        self.server = server
+        self.targets = list(targets)
+        self.transport = None
+        self._queue = None
+
+    def message(self):
+        return ('M-SEARCH * HTTP/1.1\r\n'
+                'HOST: %s:%d\r\n'
+                'MAN: "ssdp:discover"\r\n'
+                'MX: %d\r\n'
+                'ST: %s\r\n\r\n' % (SSDP_ADDR, SSDP_PORT, self.mx, self.st)).encode()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, host_port):
+        message = parse_datagram(data)
+        if message is not None and message.method == RESPONSE:
+            self._queue.put_nowait((message.headers, host_port))
+
+    def error_received(self, exc):
+        logger.warning("SSDP search socket error: %r", exc)
+
+    def _socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
+        if self.local_address:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.local_address))
+        sock.bind((self.local_address or '', 0))
+        sock.setblocking(False)
+        return sock
+
+    async def search(self, timeout=None):
+        """
+        :param timeout: seconds to listen for, by default until `mx` (plus one) after the last search
+        :return: an async iterator over the (lower case) headers of the responses
+        """
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        await loop.create_datagram_endpoint(lambda: self, sock=self._socket())
+        message = self.message()
+
+        def send():
+            for target in self.targets:
+                self.transport.sendto(message, target)
+
+        handles = [loop.call_later(n * self.interval, send) for n in range(self.repeat)]
+        if timeout is None:
+            timeout = (self.repeat - 1) * self.interval + self.mx + 1
+        deadline = loop.time() + timeout
+        seen = set()
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
                 try:
-                    self.sock.sendto('\r\n'.join(resp), (SSDP_ADDR, SSDP_PORT))
-                except (AttributeError, socket.error) as msg:
-                    logger.error("failure sending out byebye notification: %r" % msg)
-        except KeyError as msg:
-            logger.error("error building byebye notification: %r" % msg)
+                    headers, host_port = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                usn = headers.get('usn')
+                if not usn or usn in seen:
+                    continue
+                seen.add(usn)
+                if self.server is not None:
+                    self.server.response_received(headers, host_port)
+                yield headers
+        finally:
+            for handle in handles:
+                handle.cancel()
+            self.transport.close()
+            self.transport = None
+
+
+def test_multiple_interfaces():
+    """A search answered with the LOCATION of the interface (here, loopback address) it came in on."""
+
+    async def search(server, sock, address):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(2)
+        client.sendto(b'M-SEARCH * HTTP/1.1\r\nMAN: "ssdp:discover"\r\nMX: 0\r\nST: upnp:rootdevice\r\n\r\n',
+                      (address, sock.getsockname()[1]))
+        await asyncio.sleep(0.2)
+        response = client.recv(MAX_DATAGRAM_SIZE)
+        client.close()
+        return parse_datagram(response).get('location')
+
+    async def run():
+        server = SSDPServer(['127.0.0.1', '127.0.0.2'])
+        server.register_device('uuid:test', 'http://127.0.0.1:8088/description.xml')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('0.0.0.0', 0))
+        await server.start(sock)
+        try:
+            assert await search(server, sock, '127.0.0.1') == 'http://127.0.0.1:8088/description.xml'
+            assert await search(server, sock, '127.0.0.2') == 'http://127.0.0.2:8088/description.xml'
+            # registered again, elsewhere: no datagram of the old one is left, on any interface
+            server.register_device('uuid:test', 'http://127.0.0.1:8088/moved.xml')
+            assert await search(server, sock, '127.0.0.2') == 'http://127.0.0.2:8088/moved.xml'
+            # a NOTIFY per interface, each taking a token of the announcer
+            assert server.do_notify('uuid:test') == 2
+        finally:
+            server.stop()
+
+    asyncio.run(run())
+
+    server = SSDPServer('127.0.0.1', ipv6='::1')
+    server.register('local', 'uuid:test', 'uuid:test', 'http://127.0.0.1:8088/a.xml')
+    assert b'http://[::1]:8088/a.xml' in server.datagrams('uuid:test', server.ipv6_host).response
+    server.register('local', 'uuid:test', 'uuid:test', 'http://127.0.0.1:8088/b.xml')
+    assert b'http://[::1]:8088/b.xml' in server.datagrams('uuid:test', server.ipv6_host).response
+
+
+def test_remote_devices():
+    """The remote devices: LRU cap, byebye, max-age expiry (by the timer too), and the change callbacks."""
+    def notify(server, n, nts='ssdp:alive', max_age=1800, location='http://10.0.0.%d/d.xml'):
+        server.datagram_received(('NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\n'
+                                  'CACHE-CONTROL: max-age=%d\r\nLOCATION: %s\r\nNT: upnp:rootdevice\r\nNTS: %s\r\n'
+                                  'USN: uuid:remote-%d::upnp:rootdevice\r\n\r\n' %
+                                  (max_age, location % n, nts, n)).encode(), ('10.0.0.%d' % n, 1900))
+
+    server = SSDPServer('127.0.0.1', max_remote=3)
+    changes = []
+    server.remote_callbacks.append(lambda change, entry: changes.append((change, entry['USN'].split('::')[0])))
+    for n in range(3):
+        notify(server, n)
+    notify(server, 0)  # refreshed: now the most recently seen
+    notify(server, 1, location='http://10.0.0.%d/moved.xml')
+    notify(server, 3)  # over the cap: the least recently seen goes
+    assert [entry['USN'].split('::')[0] for entry in server.remote_devices()] == \
+        ['uuid:remote-0', 'uuid:remote-1', 'uuid:remote-3']
+    notify(server, 0, 'ssdp:byebye')
+    assert changes == [('added', 'uuid:remote-0'), ('added', 'uuid:remote-1'), ('added', 'uuid:remote-2'),
+                       ('updated', 'uuid:remote-1'), ('removed', 'uuid:remote-2'), ('added', 'uuid:remote-3'),
+                       ('removed', 'uuid:remote-0')]
+    assert not server.is_known('uuid:remote-0::upnp:rootdevice')
+
+    # a remote device registered locally since does not expire
+    server.register('local', 'uuid:remote-1::upnp:rootdevice', 'upnp:rootdevice', 'http://127.0.0.1:8088/d.xml')
+    server.expire(time.time() + 3600)
+    assert server.is_known('uuid:remote-1::upnp:rootdevice') and not server.remote_devices()
+    assert server.index.search('upnp:rootdevice')
+
+    async def expiry():
+        server.loop = asyncio.get_running_loop()
+        notify(server, 4, max_age=0)
+        assert server.is_known('uuid:remote-4::upnp:rootdevice')
+        await asyncio.sleep(0.05)
+        assert not server.is_known('uuid:remote-4::upnp:rootdevice')
+
+    asyncio.run(expiry())
+    assert changes[-2:] == [('added', 'uuid:remote-4'), ('removed', 'uuid:remote-4')]
+
+
+def test_ssdp_client():
+    """SSDPClient against local responders: results streamed as they come, once per USN, fed to a server."""
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        responders = []
+        for n in range(5):
+            responder = SSDPServer('127.0.0.1')
+            responder.register_device('uuid:responder-%d' % n, 'http://127.0.0.1:%d/description.xml' % (9000 + n))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            await responder.start(sock)
+            responders.append(responder)
+        targets = [responder.sock.getsockname() for responder in responders]
+        cache = SSDPServer('127.0.0.1')
+        try:
+            # MX 0: each responder answers both searches, the client yields each USN once
+            client = SSDPClient(st='upnp:rootdevice', mx=0, repeat=2, interval=0.1, targets=targets, server=cache)
+            start = loop.time()
+            arrivals = []
+            usns = []
+            async for headers in client.search():
+                arrivals.append(loop.time() - start)
+                usns.append(headers['usn'])
+            assert sorted(usns) == ['uuid:responder-%d::upnp:rootdevice' % n for n in range(5)]
+            assert sum(responder.responses.stats['sent'] for responder in responders) == 10
+            # streamed: the first one long before the end of the search
+            assert arrivals[0] < 0.1 and loop.time() - start > 1
+            assert sorted(entry['USN'] for entry in cache.remote_devices()) == sorted(usns)
+
+            # nobody answering: done at the timeout
+            start = loop.time()
+            assert [headers async for headers in SSDPClient(targets=[('127.0.0.1', 9)]).search(timeout=0.3)] == []
+            assert 0.3 <= loop.time() - start < 0.5
+        finally:
+            for responder in responders:
+                responder.stop()
+
+    asyncio.run(run())
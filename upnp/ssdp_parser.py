@@ -0,0 +1,126 @@
+"""
+Parsing of SSDP datagrams.
+
+Works on the raw bytes: the start line is recognised first, so anything that is not a M-SEARCH, a NOTIFY
+or a search response is dropped before looking at the headers, and the headers themselves are only
+extracted (keeping only the ones the server uses) when they are first asked for.
+"""
+
+M_SEARCH = 'M-SEARCH'
+NOTIFY = 'NOTIFY'
+RESPONSE = 'RESPONSE'
+
+MAX_DATAGRAM = 8192
+
+_START_LINES = {
+    b'M-SEARCH * HTTP/1.1': M_SEARCH,
+    b'NOTIFY * HTTP/1.1': NOTIFY,
+    b'HTTP/1.1 200 OK': RESPONSE,
+}
+
+# the only headers the server looks at
+HEADERS = ('st', 'mx', 'man', 'nt', 'nts', 'usn', 'location', 'cache-control', 'server')
+
+_HEADER_NAMES = {name.encode(): name for name in HEADERS}
+
+
+class SSDPMessage:
+    """A recognised SSDP datagram. `headers` is a dict with lower case names, built on first access."""
+    __slots__ = ('method', 'data', '_headers')
+
+    def __init__(self, method, data):
+        self.method = method
+        self.data = data
+        self._headers = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            headers = self._headers = {}
+            for line in self.data.split(b'\n'):
+                name, _, value = line.partition(b':')
+                name = _HEADER_NAMES.get(name.strip().lower())
+                if name:
+                    headers[name] = value.strip().decode('latin-1')
+        return self._headers
+
+    def get(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def __repr__(self):
+        return '<SSDPMessage %s %r>' % (self.method, self.headers)
+
+
+def parse_datagram(data):
+    """
+    :param data: bytes (or a memoryview) as read from the socket
+    :return: a SSDPMessage, or None if the datagram is not something we handle
+    """
+    if not data or len(data) > MAX_DATAGRAM:
+        return None
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    eol = data.find(b'\n')
+    if eol < 0:
+        return None
+    # the status line of a response may carry another reason phrase, but it is always 200
+    start = data[:eol].rstrip()
+    method = _START_LINES.get(start)
+    if method is None:
+        if start.startswith(b'HTTP/1.1 200 '):
+            method = RESPONSE
+        else:
+            return None
+    # headers stop at the first empty line, the body (if any) is ignored
+    end = data.find(b'\r\n\r\n', eol - 1)
+    if end < 0:
+        end = data.find(b'\n\n', eol)
+    return SSDPMessage(method, data[eol + 1:end] if end >= 0 else data[eol + 1:])
+
+
+def test_parse_datagram():
+    message = parse_datagram(b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\n'
+                             b'MAN: "ssdp:discover"\r\nmx:2\r\nST: ssdp:all\r\nUSER-AGENT: x\r\n\r\n')
+    assert message.method == M_SEARCH
+    assert message.headers == {'man': '"ssdp:discover"', 'mx': '2', 'st': 'ssdp:all'}
+
+    message = parse_datagram(b'NOTIFY * HTTP/1.1\nNT: upnp:rootdevice\nNTS: ssdp:alive\n'
+                             b'Location: http://10.0.0.2:80/d.xml\nCache-Control: max-age = 1800\n\n')
+    assert message.method == NOTIFY
+    assert message.get('location') == 'http://10.0.0.2:80/d.xml'
+    assert message.get('cache-control') == 'max-age = 1800'
+
+    assert parse_datagram(b'HTTP/1.1 200 Okay\r\nST: upnp:rootdevice\r\n\r\n').method == RESPONSE
+
+    for malformed in (b'', b'M-SEARCH', b'M-SEARCH\r\n\r\n', b'GET / HTTP/1.1\r\n\r\n', b'\r\n\r\n', b'x' * 10000):
+        assert parse_datagram(malformed) is None, malformed
+
+
+def test_parse_datagram_fuzz():
+    """Truncated, bit-flipped and spliced datagrams never raise."""
+    import random
+
+    seeds = [
+        b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\nST: ssdp:all\r\n\r\n',
+        b'NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nNT: upnp:rootdevice\r\nNTS: ssdp:byebye\r\n'
+        b'USN: uuid:abc::upnp:rootdevice\r\n\r\n',
+        b'HTTP/1.1 200 OK\r\nCACHE-CONTROL: max-age=1800\r\nEXT:\r\nLOCATION: http://10.0.0.2/d.xml\r\n\r\n',
+    ]
+    rnd = random.Random(0)
+    for _ in range(5000):
+        data = bytearray(rnd.choice(seeds))
+        for _ in range(rnd.randint(1, 8)):
+            mutation = rnd.random()
+            position = rnd.randrange(len(data)) if data else 0
+            if mutation < 0.4 and data:
+                data[position] = rnd.randrange(256)
+            elif mutation < 0.6:
+                del data[position:]
+            elif mutation < 0.8:
+                data[position:position] = rnd.choice((b'\r\n', b':', b' ', b'\x00', b'\r\n\r\n'))
+            else:
+                data += rnd.choice(seeds)
+        message = parse_datagram(memoryview(bytes(data)))
+        if message is not None:
+            assert message.method in (M_SEARCH, NOTIFY, RESPONSE)
+            assert set(message.headers) <= set(HEADERS)